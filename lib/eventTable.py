@@ -0,0 +1,113 @@
+import numpy as np
+
+"""
+A column table of the notes / chords / rests of a Part - one row per event, one NumPy array per musical attribute.
+AnalysePart fills it in one pass over the Part and then every count / total / per measure distribution is a bincount or unique over a column - rather than keeping a dictionary of lists of event indexes for every attribute.
+
+Attributes that aren't numbers (eg durations that might be Fractions, pitch names, chord names) are stored as codes - an index into a list of the values in the order they were first seen.
+"""
+
+# event_type column
+EVENT_NOTE = 0
+EVENT_CHORD = 1
+EVENT_REST = 2
+EVENT_UNPITCHED = 3
+EVENT_OTHER = 4  # eg ChordSymbol - it isn't analysed
+
+NO_VALUE = -1  # eg the midi pitch of a rest
+
+
+# value <-> code for a column of values that aren't numbers
+class Categories:
+    def __init__(self):
+        self.values = []  # in the order first seen - the code is the index
+        self._codes = {}
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self._codes[value] = code
+            self.values.append(value)
+        return code
+
+
+class PartEventTable:
+    # name, dtype
+    _COLUMNS = (
+        ('event_type', np.int8),
+        ('measure', np.int32),
+        ('duration', np.int32),  # code in self.durations
+        ('midi', np.int16),  # single notes
+        ('pitch_name', np.int32),  # code in self.pitch_names - single notes
+        ('interval', np.int16),  # semitones from the previous single note in the measure
+        ('has_interval', np.bool_),  # False for the first note in a measure / after a rest etc
+        ('accidentals', np.int16),  # displayed accidentals ie not in the key signature
+        ('pitch_count', np.int16),  # 1 for a single note / unpitched, the number of pitches for a chord
+        ('chord_pitches', np.int32),  # index in AnalysePart.chord_pitches_list
+        ('chord_intervals', np.int32),  # index in AnalysePart.chord_intervals_list
+        ('chord_name', np.int32),  # code in self.chord_names
+    )
+
+    def __init__(self):
+        self.durations = Categories()  # quarterLength - as music21 gives it ie float or Fraction
+        self.pitch_names = Categories()
+        self.chord_names = Categories()
+        self._rows = {name: [] for name, dtype in self._COLUMNS}
+        self.length = 0
+
+    def add(self, event_type, measure, quarter_length, midi=NO_VALUE, pitch_name=None, interval=None, accidentals=0, pitch_count=0, chord_pitches=NO_VALUE, chord_intervals=NO_VALUE, chord_name=None):
+        rows = self._rows
+        rows['event_type'].append(event_type)
+        rows['measure'].append(measure)
+        rows['duration'].append(self.durations.code(quarter_length))
+        rows['midi'].append(midi)
+        rows['pitch_name'].append(NO_VALUE if pitch_name is None else self.pitch_names.code(pitch_name))
+        rows['interval'].append(0 if interval is None else interval)
+        rows['has_interval'].append(interval is not None)
+        rows['accidentals'].append(accidentals)
+        rows['pitch_count'].append(pitch_count)
+        rows['chord_pitches'].append(chord_pitches)
+        rows['chord_intervals'].append(chord_intervals)
+        rows['chord_name'].append(NO_VALUE if chord_name is None else self.chord_names.code(chord_name))
+        self.length += 1
+
+    # turn the rows into NumPy columns - call once all the events have been added
+    def finish(self):
+        for name, dtype in self._COLUMNS:
+            setattr(self, name, np.array(self._rows[name], dtype=dtype))
+        self._rows = None
+        self.quarter_length = np.array([float(d) for d in self.durations.values], dtype=np.float64)[self.duration] if self.length > 0 else np.zeros(0)
+        # the measures that have events in, in order - and the row of each event in that list
+        self.measure_numbers, self.measure_rows = np.unique(self.measure, return_inverse=True)
+
+    def is_type(self, *event_types):
+        return np.isin(self.event_type, event_types)
+
+    # [[value, count]] for the rows in mask - ordered by descending count then by when the value was first used (like sorting a dictionary built in event order)
+    # values - the Categories the column is codes of.  None if the column is the value itself
+    def count_values(self, column, mask, values=None):
+        codes, first, counts = np.unique(column[mask], return_index=True, return_counts=True)
+        order = np.lexsort((first, -counts))
+        if values is None:
+            return [[code, count] for code, count in zip(codes[order].tolist(), counts[order].tolist())]
+        return [[values.values[code], count] for code, count in zip(codes[order].tolist(), counts[order].tolist())]
+
+    # total of weights (eg accidentals or 1 for each rest) for each measure in self.measure_numbers
+    def count_in_measures(self, weights):
+        return np.bincount(self.measure_rows, weights=weights, minlength=len(self.measure_numbers)).astype(np.int64)
+
+    # for each row in mask - how many earlier rows in mask have the same value in column.  NO_VALUE for rows not in mask
+    def occurrences(self, column, mask):
+        result = np.full(self.length, NO_VALUE, dtype=np.int64)
+        rows = np.flatnonzero(mask)
+        if len(rows) == 0:
+            return result
+        values = column[rows]
+        order = np.argsort(values, kind='stable')
+        sorted_values = values[order]
+        group_starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, len(rows)])
+        occurrence = np.arange(len(rows)) - np.repeat(group_starts, group_sizes)
+        result[rows[order]] = occurrence
+        return result
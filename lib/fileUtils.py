@@ -0,0 +1,58 @@
+import os
+import fcntl
+import hashlib
+import tempfile
+import contextlib
+
+"""
+Helpers for the files made from the scores - which are shared by the web requests, job workers and background threads of every process.
+
+A file is written to a temporary file in the same directory and then renamed over the real name - so another process never reads half a file.
+"""
+
+LOCK_BUCKETS = 64
+
+
+# held while a file is made - so concurrent requests (in any process) for the same file wait for the first one instead of all making it.
+# The lock is one of LOCK_BUCKETS lock files in lock_dir, picked by a hash of the path - so lock files don't pile up next to the files they are for.
+# Different paths can share a lock file - so never take another path_lock() while holding one
+@contextlib.contextmanager
+def path_lock(path, lock_dir):
+    bucket = int(hashlib.sha256(os.path.realpath(path).encode()).hexdigest(), 16) % LOCK_BUCKETS
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, "%d.lock" % bucket), 'w') as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+# a temporary file (open for writing bytes) in the same directory as path - see replace_file()
+def temporary_file_for(path):
+    return tempfile.NamedTemporaryFile("wb", delete=False, dir=os.path.dirname(path), suffix='.tmp')
+
+
+# moves the closed temporary file to path in one step
+def replace_file(temporary_filepath, path):
+    os.chmod(temporary_filepath, 0o644)  # NamedTemporaryFile is only readable by its owner
+    os.replace(temporary_filepath, path)
+
+
+# with atomic_write(path) as fh: - fh is a temporary file that replaces path if the block finishes, or is removed if it raises
+@contextlib.contextmanager
+def atomic_write(path):
+    fh = temporary_file_for(path)
+    try:
+        with fh:
+            yield fh
+        replace_file(fh.name, path)
+    except BaseException:
+        if os.path.exists(fh.name):
+            os.remove(fh.name)
+        raise
+
+
+def write_file(path, data):
+    with atomic_write(path) as fh:
+        fh.write(data)
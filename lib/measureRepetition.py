@@ -0,0 +1,189 @@
+import bisect
+
+"""
+Finds groups of measures that are repeated - eg bars 1 to 8 are used again at 9 to 16 and bars 1 to 4 are used again at 17 to 20.
+
+The measures of a part are treated as a string - each measure is a symbol, which is the index of the unique measure it matches (by pitch and rhythm, just rhythm or just intervals - see AnalysePart).
+Every repeated run of measures is a repeated substring, so we build a suffix array and LCP array of the string and read the repeats off the LCP intervals.
+Then the longest repeats are used first and a shorter repeat is only mentioned where it isn't already inside a longer one.
+
+The groups are returned in the format AnalysePart uses - a list of groups, each is a list of [start measure, end measure] for each time the group is used, eg [ [[1, 8], [9, 16]], [[1, 4], [17, 20]] ]
+MeasureGroupIndex answers "is this measure in a group" without looking through every group.
+"""
+
+
+# indexes_all eg AnalysePart.measure_analyse_indexes_all - {measure index, [index of the unique measure, occurrence]} in measure order
+# returns the measure numbers and the symbol of each measure.  Where measures are missing (eg a measure without notes) a unique symbol is put in so repeats don't run across the gap
+def make_measure_string(indexes_all):
+    measure_numbers = []
+    symbols = []
+    gap_symbol = -1
+    previous_measure = None
+    for measure_index, indexes in indexes_all.items():
+        if previous_measure is not None and measure_index != previous_measure + 1:
+            measure_numbers.append(None)
+            symbols.append(gap_symbol)
+            gap_symbol -= 1
+        measure_numbers.append(measure_index)
+        symbols.append(indexes[0])
+        previous_measure = measure_index
+    return measure_numbers, symbols
+
+
+# prefix doubling - each pass sorts the suffixes by their first 2k symbols using the ranks from sorting by the first k.  O(n log n)
+def suffix_array(symbols):
+    n = len(symbols)
+    if n == 0:
+        return []
+    symbol_ranks = {s: r for r, s in enumerate(sorted(set(symbols)))}
+    rank = [symbol_ranks[s] for s in symbols]
+    sa = sorted(range(n), key=lambda i: rank[i])
+    classes = len(symbol_ranks)
+    k = 1
+    while classes < n:
+        # sorted by the second k symbols - suffixes that don't have any come first
+        by_second = list(range(n - k, n)) + [i - k for i in sa if i >= k]
+        # then a stable counting sort by the first k symbols
+        starts = [0] * (classes + 1)
+        for r in rank:
+            starts[r + 1] += 1
+        for c in range(classes):
+            starts[c + 1] += starts[c]
+        sa = [0] * n
+        for i in by_second:
+            sa[starts[rank[i]]] = i
+            starts[rank[i]] += 1
+
+        new_rank = [0] * n
+        classes = 1
+        for j in range(1, n):
+            a = sa[j - 1]
+            b = sa[j]
+            if rank[a] != rank[b] or (rank[a + k] if a + k < n else -1) != (rank[b + k] if b + k < n else -1):
+                classes += 1
+            new_rank[b] = classes - 1
+        rank = new_rank
+        k *= 2
+    return sa
+
+
+# Kasai - lcp[j] is the length of the common prefix of the suffixes at sa[j-1] and sa[j].  lcp[0] = 0
+def lcp_array(symbols, sa):
+    n = len(symbols)
+    rank = [0] * n
+    for j, i in enumerate(sa):
+        rank[i] = j
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        if rank[i] > 0:
+            other = sa[rank[i] - 1]
+            while i + h < n and other + h < n and symbols[i + h] == symbols[other + h]:
+                h += 1
+            lcp[rank[i]] = h
+            if h > 0:
+                h -= 1
+        else:
+            h = 0
+    return lcp
+
+
+# returns [(length, [start positions])] for each repeated substring at least min_length long that can't be extended to the left or right without losing an occurrence
+# a repeat can overlap itself (eg 1 to 12 at 9 to 20) - then it is shortened so that at least two occurrences don't overlap (ie 1 to 8 at 9 to 16)
+def find_maximal_repeats(symbols, min_length=2):
+    sa = suffix_array(symbols)
+    lcp = lcp_array(symbols, sa)
+    n = len(symbols)
+    repeats = []
+    stack = [(0, 0)]  # (lcp, left bound) of the open lcp intervals
+    for j in range(1, n + 1):
+        current = lcp[j] if j < n else 0
+        left = j - 1
+        while current < stack[-1][0]:
+            length, left = stack.pop()
+            # every length between the enclosing interval's lcp and this one has the same occurrences
+            shortest = max(current, stack[-1][0]) + 1
+            positions = sorted(sa[left:j])
+            length = min(length, positions[-1] - positions[0])
+            if length >= max(shortest, min_length):
+                # left maximal - ie not always preceded by the same measure (in which case the longer repeat says it all)
+                if len(set(symbols[p - 1] if p > 0 else None for p in positions)) > 1:
+                    repeats.append((length, positions))
+        if current > stack[-1][0]:
+            stack.append((current, left))
+    return repeats
+
+
+# Fenwick tree of the furthest end of the occurrences starting at or before each position - so we can ask if a run is inside an occurrence that is already in a group
+class _CoveredRuns:
+    def __init__(self, size):
+        self.tree = [-1] * (size + 1)
+
+    def add(self, start, end):
+        i = start + 1
+        while i < len(self.tree):
+            if self.tree[i] < end:
+                self.tree[i] = end
+            i += i & -i
+
+    def covers(self, start, end):
+        furthest = -1
+        i = start + 1
+        while i > 0:
+            if self.tree[i] > furthest:
+                furthest = self.tree[i]
+            i -= i & -i
+        return furthest >= end
+
+
+# indexes_all eg AnalysePart.measure_analyse_indexes_all
+# returns groups of repeated measures (at least 2 measures long) eg [ [[1, 8], [9, 16]], [[1, 4], [17, 20]] ] ordered by the first measure of the group
+def find_measure_groups(indexes_all):
+    measure_numbers, symbols = make_measure_string(indexes_all)
+    covered = _CoveredRuns(len(symbols))
+    groups = []
+    for length, positions in sorted(find_maximal_repeats(symbols), key=lambda r: (-r[0], r[1][0])):
+        # occurrences of a group can't overlap each other eg 1 to 4 and 3 to 6
+        occurrences = []
+        for p in positions:
+            if len(occurrences) == 0 or p >= occurrences[-1] + length:
+                occurrences.append(p)
+        if len(occurrences) < 2:
+            continue
+
+        # don't mention the occurrences that are already inside a longer group - but always keep the first so we know where it was first used
+        later = [p for p in occurrences[1:] if not covered.covers(p, p + length - 1)]
+        if len(later) == 0:
+            continue
+        group_positions = [occurrences[0]] + later
+        for p in group_positions:
+            covered.add(p, p + length - 1)
+        groups.append([[measure_numbers[p], measure_numbers[p + length - 1]] for p in group_positions])
+
+    groups.sort(key=lambda g: (g[0][0], g[0][0] - g[0][1]))
+    return groups
+
+
+# every [start measure, end measure] from a list of measure groups - sorted by start with the furthest end so far
+# so contains() is a binary search rather than a look through every group
+class MeasureGroupIndex:
+    def __init__(self, groups_list):
+        ranges = sorted((mg[0], mg[1]) for mgl in groups_list for mg in mgl)
+        self.starts = [r[0] for r in ranges]
+        self.furthest_ends = []
+        furthest = None
+        for r in ranges:
+            if furthest is None or r[1] > furthest:
+                furthest = r[1]
+            self.furthest_ends.append(furthest)
+
+    # is the measure in any of the groups
+    def contains(self, measure_index):
+        return self.contains_both(measure_index, measure_index)
+
+    # are both measures in the same group.  Ie 1 to 4 is used at 5 to 8.  So 2 to is used at 6 to 8 - but you don't want to say that.
+    def contains_both(self, measure_index1, measure_index2):
+        first = min(measure_index1, measure_index2)
+        last = max(measure_index1, measure_index2)
+        i = bisect.bisect_right(self.starts, first) - 1
+        return i >= 0 and self.furthest_ends[i] >= last
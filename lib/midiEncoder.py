@@ -0,0 +1,150 @@
+import struct
+
+"""
+Writes Standard MIDI Files (type 1 - one track per part plus a tempo track) straight from lists of events - rather than building a music21 Stream and calling write('midi').
+music21 translates the whole stream (deep copy, expand repeats, strip ties, realise volumes, assign channels) every time it writes a file - which is slow when one request writes every segment / tempo / click variant.
+
+A track is a list of events - (tick, kind, data) where kind is one of the EVENT_ constants below.  The events don't need to be sorted.
+See MidiHandler for turning a score into these events once and then slicing them for each file.
+
+The notes of a file are the same at every speed - so a faster / slower copy of a file is made by scale_tempo() rewriting just its Set Tempo events.
+"""
+
+TICKS_PER_QUARTER = 10080  # the same as music21 - so tuplets etc are still whole ticks
+
+CLICK_CHANNEL = 9  # percussion
+CLICK_FIRST_BEAT_PITCH = 38  # D2 - the first beat of the bar
+CLICK_BEAT_PITCH = 42  # F#2 - the other beats
+CLICK_VELOCITY = 90  # the velocity music21 gives a note without any dynamics
+
+# kind of event.  At the same tick events are written in this order - so a note ending is written before a note starting again on the same pitch
+EVENT_TEMPO = 0  # data = microseconds per quarter note
+EVENT_TIME_SIGNATURE = 1  # data = (numerator, denominator)
+EVENT_TRACK_NAME = 2  # data = str
+EVENT_PROGRAM = 3  # data = (channel, program)
+EVENT_NOTE_OFF = 4  # data = (channel, pitch)
+EVENT_NOTE_ON = 5  # data = (channel, pitch, velocity)
+
+
+def quarter_length_to_ticks(quarter_length):
+    return int(round(quarter_length * TICKS_PER_QUARTER))
+
+
+# quarter_bpm - beats per minute where the beat is a quarter note
+def tempo_event(tick, quarter_bpm):
+    return (tick, EVENT_TEMPO, int(round(60000000 / quarter_bpm)))
+
+
+def note_events(start_tick, end_tick, channel, pitch, velocity):
+    return [(start_tick, EVENT_NOTE_ON, (channel, pitch, velocity)), (end_tick, EVENT_NOTE_OFF, (channel, pitch))]
+
+
+# MIDI variable length quantity - 7 bits per byte, most significant first, top bit set on all but the last byte
+def _variable_length(value):
+    data = bytearray([value & 0x7F])
+    value >>= 7
+    while value > 0:
+        data.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(data)
+
+
+def _event_bytes(kind, data):
+    if kind == EVENT_NOTE_ON:
+        channel, pitch, velocity = data
+        return bytes((0x90 | channel, max(0, min(pitch, 127)), max(1, min(velocity, 127))))  # velocity 0 would be a note off
+    elif kind == EVENT_NOTE_OFF:
+        channel, pitch = data
+        return bytes((0x80 | channel, max(0, min(pitch, 127)), 0))
+    elif kind == EVENT_PROGRAM:
+        channel, program = data
+        return bytes((0xC0 | channel, program & 0x7F))
+    elif kind == EVENT_TEMPO:
+        return b'\xFF\x51\x03' + min(data, 0xFFFFFF).to_bytes(3, 'big')
+    elif kind == EVENT_TIME_SIGNATURE:
+        numerator, denominator = data
+        # denominator as a power of 2, 24 midi clocks per metronome click, 8 32nd notes per quarter
+        return b'\xFF\x58\x04' + bytes((numerator, max(denominator.bit_length() - 1, 0), 24, 8))
+    elif kind == EVENT_TRACK_NAME:
+        name = data.encode('utf-8', 'replace')
+        return b'\xFF\x03' + _variable_length(len(name)) + name
+    raise ValueError("Unknown MIDI event kind %s" % kind)
+
+
+def encode_track(events):
+    data = bytearray()
+    previous_tick = 0
+    for tick, kind, event_data in sorted(events, key=lambda e: (e[0], e[1])):
+        data += _variable_length(tick - previous_tick)
+        data += _event_bytes(kind, event_data)
+        previous_tick = tick
+    data += b'\x00\xFF\x2F\x00'  # end of track
+    return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+
+# tracks - a list of tracks, each a list of events.  The first track should be the tempo track
+def encode_midi_file(tracks):
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), TICKS_PER_QUARTER)
+    return header + b''.join(encode_track(track) for track in tracks)
+
+
+# returns (value, position after it)
+def _read_variable_length(data, position):
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte & 0x80 == 0:
+            return value, position
+
+
+# a copy of a Standard MIDI File played at scale times the speed (eg 0.5 for half speed) - only the Set Tempo events are changed.
+# A file without any Set Tempo events plays at 120 beats per minute - so one is added at the start of the first track
+def scale_tempo(midi_data, scale):
+    data = bytearray(midi_data)
+    if data[:4] != b'MThd':
+        raise ValueError("Not a MIDI file")
+    position = 8 + struct.unpack('>I', data[4:8])[0]
+    found_tempo = False
+    first_track = None
+    while position + 8 <= len(data):
+        chunk_type = data[position:position+4]
+        chunk_end = position + 8 + struct.unpack('>I', data[position+4:position+8])[0]
+        position += 8
+        if chunk_type == b'MTrk':
+            if first_track is None:
+                first_track = position - 8
+            status = None
+            while position < chunk_end:
+                delta, position = _read_variable_length(data, position)
+                if data[position] & 0x80:
+                    status = data[position]
+                    position += 1
+                if status == 0xFF:
+                    meta_type = data[position]
+                    length, position = _read_variable_length(data, position + 1)
+                    if meta_type == 0x51 and length == 3:
+                        microseconds = int(data[position:position+3].hex(), 16)
+                        data[position:position+3] = max(1, min(int(round(microseconds / scale)), 0xFFFFFF)).to_bytes(3, 'big')
+                        found_tempo = True
+                    position += length
+                    status = None  # meta and sysex events cancel running status
+                elif status in (0xF0, 0xF7):
+                    length, position = _read_variable_length(data, position)
+                    position += length
+                    status = None
+                elif status is None:
+                    raise ValueError("MIDI data byte without a status")
+                elif status & 0xF0 in (0xC0, 0xD0):
+                    position += 1  # program change and channel pressure have one data byte
+                else:
+                    position += 2
+        position = chunk_end
+
+    if not found_tempo and first_track is not None:
+        tempo = b'\x00' + _event_bytes(EVENT_TEMPO, int(round(500000 / scale)))
+        length = struct.unpack('>I', data[first_track+4:first_track+8])[0] + len(tempo)
+        data[first_track+4:first_track+8] = struct.pack('>I', length)
+        data[first_track+8:first_track+8] = tempo
+    return bytes(data)
@@ -3,16 +3,33 @@ __author__ = 'PMarchant'
 import os
 import json
 import math
+import bisect
+import pickle
 import logging
 import logging.handlers
 import logging.config
-from tracemalloc import BaseFilter
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from music21 import *
-from talkingscores.settings import BASE_DIR, MEDIA_ROOT, STATIC_ROOT, STATIC_URL
+from talkingscores.settings import BASE_DIR, MEDIA_ROOT, STATIC_ROOT, STATIC_URL, MIDI_PREFETCH, LOCK_DIR
 from talkingscoreslib import Music21TalkingScore
+from lib.scoreCache import parsed_score_cache
+from lib.tempoMap import TempoMap
+from lib.fileUtils import path_lock, atomic_write, write_file
+from lib import midiEncoder
 
 logger = logging.getLogger("TSScore")
 
+TEMPOS = [50, 100, 150]  # percentages made for every file.  Any other tempo is made when it is asked for
+MIN_TEMPO = 10
+MAX_TEMPO = 400
+TIMELINE_VERSION = 1  # change when ScoreTimeline changes - so timelines pickled by an older version are made again
+
+
+# the query string of a midi request asks for something that can't be made - eg a tempo that isn't a number or a part that isn't in the score.  The midi view sends a 400
+class InvalidMidiRequest(Exception):
+    pass
+
 
 class MidiHandler:
     def __init__(self, get, folder, filename):
@@ -20,9 +37,16 @@ class MidiHandler:
         self.folder = folder
         self.filename = filename.replace(".mid", "")
 
+    # a whole number from the query string
+    def get_query_int(self, name):
+        try:
+            return int(self.queryString.get(name))
+        except (TypeError, ValueError):
+            raise InvalidMidiRequest(f"{name} must be a whole number")
+
     # get list of selected / unselected instruments from binary of number.  Leftmost value is always 1
     def get_selected_instruments(self):
-        bsi = int(self.queryString.get("bsi"))
+        bsi = self.get_query_int("bsi")
         self.selected_instruments = []
         while (bsi > 1):
             logger.debug(f"bsi = {bsi}")
@@ -40,12 +64,13 @@ class MidiHandler:
 
         instrument_index = -1
         prev_instrument = ""
-        for part_index, part in enumerate(self.score.flat.getInstruments()):
-            logger.debug(f"part_index = {part_index}")
-            logger.debug(part)
-            if part.partId != prev_instrument:
+        for part_index, part_id in enumerate(self.timeline.instrument_part_ids):
+            logger.debug(f"part_index = {part_index} part_id = {part_id}")
+            if part_id != prev_instrument:
                 instrument_index += 1
                 self.selected_instruement_parts.get(instrument_index)
+                if instrument_index >= len(self.selected_instruments):
+                    raise InvalidMidiRequest("bsi doesn't have a bit for each instrument")
 
             if (self.selected_instruments[instrument_index] == True):
                 self.all_selected_parts.append(part_index)
@@ -57,14 +82,14 @@ class MidiHandler:
                 self.all_unselected_parts.append(part_index)
                 self.selected_instruement_parts[instrument_index] = []
 
-            prev_instrument = part.partId
+            prev_instrument = part_id
 
         logger.debug(f"all_selected_parts = {self.all_selected_parts}")
         logger.debug(f"all_unselected_parts = {self.all_unselected_parts}")
         logger.debug(f"selected_instruement_parts = {self.selected_instruement_parts}")
 
         # play together - all / selected / unselected instruments
-        bpi = int(self.queryString.get("bpi"))
+        bpi = self.get_query_int("bpi")
         self.play_together_unselected = bpi & 1
         bpi = bpi >> 1
         self.play_together_selected = bpi & 1
@@ -80,171 +105,104 @@ class MidiHandler:
                 self.selected_instruments.append(False)
             bsi = bsi >> 1
 
-    def make_midi_files(self):
-        # todo - it is a bit slow for big musicxml files eg chaconne!
-        # todo maybe get the segment of all parts then get parts from that.
+    # loads the timeline of the score and works out the parts and measures the query string asks for.  Only done once - make_midi_file() and then make_midi_files() in the background share it
+    def load_timeline(self):
+        if hasattr(self, 'timeline'):
+            return
         xml_file_path = os.path.join(*(MEDIA_ROOT, self.folder, self.filename))  # todo - might not be secure
-        self.score = converter.parse(xml_file_path+".musicxml")  # todo - might be .xml instead of .musicxml
+        self.timeline = load_score_timeline(xml_file_path+".musicxml", self.folder)  # todo - might be .xml instead of .musicxml
         self.get_selected_instruments()
 
-        s = stream.Score(id='temp')
-
         if self.queryString.get("start") is None and self.queryString.get("end") is None:
             # todo - test for pickup bar
-            start = self.score.parts[0].getElementsByClass('Measure')[0].number
-            end = self.score.parts[0].getElementsByClass('Measure')[-1].number
-
+            self.start = self.timeline.measures[0].number
+            self.end = self.timeline.measures[-1].number
         else:
-            start = int(self.queryString.get("start"))
-            end = int(self.queryString.get("end"))
-
-        offset = self.score.parts[0].measure(start).offset
-
-        # in very rough tests (same bars) using the segment then getting parts from that (instead of original stream) saves 1 or 2 seconds with 2 parts 261 bars, 2,060kb.
-        # maybe a deep copy would be better?
-        self.scoreSegment = stream.Score(id='tempSegment')
-        for p in self.score.parts:
-            # fix with pickup bar
-            if start == 0 and end == 0:
-                end = 1
-            for m in p.measures(start, end).getElementsByClass('Measure'):
-                # todo - test with repeats
-                m.removeByClass('Repeat')
-            self.scoreSegment.insert(p.measures(start, end, ))
-            if start == 0 and end == 1:
-                end = 0
+            self.start = self.get_query_int("start")
+            self.end = self.get_query_int("end")
+        self.measure_range = self.timeline.get_measure_range(self.start, self.end)
+
+    # the part indexes played by the file the query string asks for
+    def get_query_parts(self):
+        if self.queryString.get("sel") == "sel":
+            return self.all_selected_parts
+        elif self.queryString.get("sel") == "un":
+            return self.all_unselected_parts
+        elif self.queryString.get("sel") == "all":
+            return list(range(len(self.timeline.parts)))
+        elif self.queryString.get("part") is not None:
+            part = self.get_query_int("part")
+            if part < 0 or part >= len(self.timeline.parts):
+                raise InvalidMidiRequest("There isn't a part %d" % part)
+            return [part]
+        elif self.queryString.get("ins") is not None:
+            parts_list = self.selected_instruement_parts.get(self.get_query_int("ins") - 1)
+            if not parts_list:
+                raise InvalidMidiRequest("There isn't a selected instrument %s" % self.queryString.get("ins"))
+            return parts_list
+        raise InvalidMidiRequest("The parts to play haven't been given")
+
+    # makes just the file the query string asks for
+    def make_midi_file(self, midi_filepath, tempo):
+        self.load_timeline()
+        midi_data = self.timeline.make_midi(self.get_query_parts(), self.measure_range, (tempo or 100)/100, self.queryString.get("c", "n") != 'n')
+        write_file(midi_filepath, midi_data)
+
+    # makes every file of the segment (all / selected / unselected / each instrument / each part, at each of TEMPOS, with and without the click track) that doesn't exist yet
+    def make_midi_files(self):
+        self.load_timeline()
+        start = self.start
+        end = self.end
+        measure_range = self.measure_range
 
         for click in ['n', 'be']:
-            self.tempo_shift = 0  # in a pickup bar - a rest is added to the start of bar 0 to make it a full bar - this offset needs adding to all future tempos
-            for tempo in [50, 100, 150]:
-                # play all parts together
-                if self.play_together_all:
-                    self.make_midi_together(start, end, offset, tempo, click, "all")
-
-                # play all selected parts together
-                if self.play_together_selected:
-                    self.make_midi_together(start, end, offset, tempo, click, "sel")
-
-                # play all unselected parts together
-                if self.play_together_unselected:
-                    self.make_midi_together(start, end, offset, tempo, click, "un")
-
-                # each instrument (with 1 or more parts) - if selected
-                for index, parts_list in enumerate(self.selected_instruement_parts.values()):
-                    if (len(parts_list) > 0):
-                        s = stream.Score(id='temp')
+            # play all parts together
+            if self.play_together_all:
+                self.make_midi_together(start, end, measure_range, click, "all")
+
+            # play all selected parts together
+            if self.play_together_selected:
+                self.make_midi_together(start, end, measure_range, click, "sel")
+
+            # play all unselected parts together
+            if self.play_together_unselected:
+                self.make_midi_together(start, end, measure_range, click, "un")
+
+            # each instrument (with 1 or more parts) - if selected
+            for index, parts_list in enumerate(self.selected_instruement_parts.values()):
+                if (len(parts_list) > 0):
+                    self.write_midi_files(parts_list, measure_range, click, start=start, end=end, ins=index+1)
+
+                    # now each separate part if the instrument has more than 1 part
+                    if (len(parts_list) > 1):
                         for pi in parts_list:
-                            s.insert(self.scoreSegment.parts[pi].measures(start, end, collect=('Clef', 'TimeSignature', 'Instrument', 'KeySignature')))
-                        self.insert_tempos(s, offset, tempo/100)
-                        self.insert_click_track(s, click)
-                        s.write('midi', self.make_midi_path_from_options(start=start, end=end, ins=index+1, tempo=tempo, click=click))
-
-                        # now each separate part if the instrument has more than 1 part
-                        if (len(parts_list) > 1):
-                            for pi in parts_list:
-                                s = stream.Score(id='temp')
-                                s.insert(self.scoreSegment.parts[pi].measures(start, end, collect=('Clef', 'TimeSignature', 'Instrument', 'KeySignature')))
-                                self.insert_tempos(s, offset, tempo/100)
-                                self.insert_click_track(s, click)
-                                s.write('midi', self.make_midi_path_from_options(start=start, end=end, part=pi, tempo=tempo, click=click))
+                            self.write_midi_files([pi], measure_range, click, start=start, end=end, part=pi)
 
     # make a midi file of all / selected / unselected instruments played together
-
-    def make_midi_together(self, start, end, offset, tempo, click, which_parts):
-        parts_in = []
+    def make_midi_together(self, start, end, measure_range, click, which_parts):
         if (which_parts == "sel"):
             parts_in = self.all_selected_parts
         elif (which_parts == "un"):
             parts_in = self.all_unselected_parts
-
-        s = stream.Score(id='temp')
-        for part_index, p in enumerate(self.scoreSegment.parts):
-            if which_parts == "all" or part_index in parts_in:
-                s.insert(p.measures(start, end, collect=('Clef', 'TimeSignature', 'Instrument', 'KeySignature')))
-        self.insert_tempos(s, offset, tempo/100)
-        self.insert_click_track(s, click)
-        s.write('midi', self.make_midi_path_from_options(start=start, end=end, sel=which_parts, tempo=tempo, click=click))
-
-    # If there is a pickup bar - add rests to the start - so the click track can start on beat 1
-    def insert_click_track(self, s, click):
-        if click == 'n':
-            return
-
-        # todo - use eg instrument.HiHatCymbal() etc after updating music21
-        clicktrack = stream.Stream()
-        # ins = instrument.Woodblock() # workds d#1 and d#5 ok ish.  beat 1 is too quiet
-        ins = instrument.Percussion()
-        ins.midiChannel = 9
-        clicktrack.insert(0, ins)
-        ts: meter.TimeSignature = None
-        shift_measure_offset = 0
-        for m in s.getElementsByClass(stream.Part)[0].getElementsByClass(stream.Measure):
-            if len(m.getElementsByClass(meter.TimeSignature)) > 0:
-                ts = m.getElementsByClass(meter.TimeSignature)[0]
-            else:
-                if (ts == None):
-                    ts: meter.TimeSignature = m.previous('TimeSignature')
-                # if the score didn't have a time signature - then just set it to 1/4 to get the first beat of each bar...
-                if (ts == None):
-                    ts = meter.TimeSignature('1/4')
-            clickmeasure = stream.Measure()
-            clickmeasure.mergeAttributes(m)
-            clickmeasure.duration = ts.barDuration
-            clickNote = note.Note('D2')
-            clickNote.duration = ts.getBeatDuration(0)  # specify beat number for complex time signatures...
-            clickmeasure.append(clickNote)
-            beatpos = ts.getBeatDuration(0).quarterLength
-            # if it is a pickup bar then add rests to bar 0 and shift the start offset of the future bars
-            # todo - slight cludge for if the bar doesn't have anything in it (no notes or rests) - possibly should add in the rests at the start of processing
-            if (m.duration.quarterLength < ts.barDuration.quarterLength and len(m.getElementsByClass(['Note', 'Rest'])) > 0):
-                rest_duration = ts.barDuration.quarterLength - m.duration.quarterLength
-                r = note.Rest()
-                r.duration.quarterLength = rest_duration
-                logger.debug(f"pickup bar - rest_duration = {rest_duration}")
-                for p in self.scoreSegment.parts:  # change the bar start offset for all future streams.  Add a rest in all streams (including this one)
-                    r = note.Rest()
-                    r.duration.quarterLength = rest_duration
-                    p.getElementsByClass(stream.Measure)[0].insertAndShift(0, r)
-                    for ms in p.getElementsByClass(stream.Measure)[1:]:
-                        ms.offset += rest_duration
-
-                    logger.debug(f"now added rest to parts - duration = {rest_duration} and measure 0 duration = {p.getElementsByClass(stream.Measure)[0].duration.quarterLength}")
-                for p in s.parts:  # change the bar start offsets for this stream
-                    for ms in p.getElementsByClass(stream.Measure)[1:]:
-                        ms.offset += rest_duration
-
-                shift_measure_offset = rest_duration
-                # update tempo offsets
-                for t in s.getElementsByClass(tempo.MetronomeMark):
-                    if (t.offset > 0):
-                        t.offset += shift_measure_offset
-
-                self.tempo_shift = rest_duration
-
-            for b in range(0, ts.beatCount-1):
-                clickNote = note.Note('F#2')
-                clickNote.duration = ts.getBeatDuration(beatpos)
-                beatpos += clickNote.duration.quarterLength
-                clickmeasure.append(clickNote)
-
-            clicktrack.append(clickmeasure)
-
-        s.insert(clicktrack)
-
-    # music21 might have a better way of doing this.
-    # s.insert(self.score.parts[int(self.queryString.get("part"))].measures(start,end, collect=('Clef', 'TimeSignature', 'Instrument', 'KeySignature', 'TempoIndication'))) - collect doesn't seem to do anything!
-    # If part 0 is included then tempos are already present.
-    def insert_tempos(self, stream, offset_start, scale):
-        for mmb in self.score.metronomeMarkBoundaries():
-            if (mmb[0] >= offset_start+stream.duration.quarterLength):  # ignore tempos that start after stream ends
-                return
-            if (mmb[1] > offset_start):  # if mmb ends during the segment
-                tempoNumber = Music21TalkingScore.fix_tempo_number(tempo=mmb[2]).number
-                if (mmb[0]) <= offset_start:  # starts before segment so insert it at the start of the stream
-                    # if there is a tempo already in the stream at offset 0 and we insert a different tempo - it seems to happen just before the original tempo so is ignored...
-                    stream.insert(0.001, tempo.MetronomeMark(number=tempoNumber*scale, referent=mmb[2].referent))
-                else:  # starts during segment so insert it part way through the stream
-                    stream.insert(mmb[0]-offset_start + self.tempo_shift, tempo.MetronomeMark(number=tempoNumber*scale, referent=mmb[2].referent))
+        else:
+            parts_in = range(len(self.timeline.parts))
+        self.write_midi_files(list(parts_in), measure_range, click, start=start, end=end, sel=which_parts)
+
+    # writes the file at each of TEMPOS (unless it already exists).  The file is only made once - the other tempos are copies with the tempo events rewritten
+    # measure_range - (first, last) index in self.timeline.measures.  click - n = none, be = beats.  path_options - see make_midi_path_from_options()
+    def write_midi_files(self, part_indexes, measure_range, click, **path_options):
+        midi_paths = {tempo: self.make_midi_path_from_options(click=click, tempo=tempo, **path_options) for tempo in TEMPOS}
+        midi_data = None
+        for tempo, midi_path in midi_paths.items():
+            if os.path.exists(midi_path):
+                continue
+            # a request for the same file might be making it - see get_or_make_midi_file()
+            with midi_file_lock(midi_path):
+                if os.path.exists(midi_path):
+                    continue
+                if midi_data is None:
+                    midi_data = self.timeline.make_midi(part_indexes, measure_range, 1, click != 'n')
+                write_file(midi_path, midi_data if tempo == 100 else midiEncoder.scale_tempo(midi_data, tempo/100))
 
     def make_midi_path_from_options(self, sel=None, part=None, ins=None, start=None, end=None, click=None, tempo=None):
         self.midiname = self.filename
@@ -267,28 +225,314 @@ class MidiHandler:
         logger.debug(f"midifilename = {self.midiname}")
         return os.path.join(BASE_DIR, STATIC_ROOT, "data", self.folder, self.midiname)
 
-    def get_or_make_midi_file(self):
-        self.midiname = self.filename
-        if (self.queryString.get("sel") != None):
-            self.midiname += "sel-"+self.queryString.get("sel")  # sel-sel, sel-all, sel-un
-        if (self.queryString.get("part") != None):
-            self.midiname += "p"+self.queryString.get("part")
-        if (self.queryString.get("ins") != None):
-            self.midiname += "i"+self.queryString.get("ins")
-        if (self.queryString.get("start") != None):
-            self.midiname += "s"+self.queryString.get("start")
-        if (self.queryString.get("end") != None):
-            self.midiname += "e"+self.queryString.get("end")
-        if (self.queryString.get("c") != None):
-            self.midiname += "c"+self.queryString.get("c")
-        if (self.queryString.get("t") != None):
-            self.midiname += "t"+self.queryString.get("t")
+    # the tempo (as a percentage) from the query string - or None if there isn't one
+    def get_tempo(self):
+        tempo = self.queryString.get("t")
+        if tempo is None:
+            return None
+        if not tempo.isdigit():
+            raise InvalidMidiRequest("Tempo must be a whole number")
+        tempo = int(tempo)
+        if tempo < MIN_TEMPO or tempo > MAX_TEMPO:
+            raise InvalidMidiRequest(f"Tempo must be between {MIN_TEMPO} and {MAX_TEMPO}%")
+        return tempo
 
-        self.midiname += ".mid"
+    def get_or_make_midi_file(self):
+        path_options = {
+            'sel': self.queryString.get("sel"),  # sel, all, un
+            'part': self.queryString.get("part"),
+            'ins': self.queryString.get("ins"),
+            'start': self.queryString.get("start"),
+            'end': self.queryString.get("end"),
+            'click': self.queryString.get("c"),
+        }
+        tempo = self.get_tempo()
+        midi_filepath = self.make_midi_path_from_options(tempo=tempo, **path_options)
         toReturn = self.midiname
-        midi_filepath = os.path.join(BASE_DIR, STATIC_ROOT, "data", self.folder, "%s" % (self.midiname))
         if not os.path.exists(midi_filepath):
-            logger.debug(f"midi file not found - {self.midiname} - making it...")
-            self.make_midi_files()
+            # if another request (in any process) is making the file - wait for it rather than making it again
+            with midi_file_lock(midi_filepath):
+                if not os.path.exists(midi_filepath):
+                    logger.debug(f"midi file not found - {toReturn} - making it...")
+                    base_filepath = self.make_midi_path_from_options(tempo=100, **path_options)
+                    if tempo is not None and tempo != 100 and os.path.exists(base_filepath):
+                        # a copy of the 100% file with the tempo events rewritten - without loading the score
+                        with open(base_filepath, 'rb') as fh:
+                            write_file(midi_filepath, midiEncoder.scale_tempo(fh.read(), tempo/100))
+                    else:
+                        self.make_midi_file(midi_filepath, tempo)
+                        # the other files of the segment will probably be asked for next
+                        if MIDI_PREFETCH:
+                            prefetch_midi_files(self)
 
         return toReturn
+
+
+# the ScoreTimeline of a score's musicxml file.  It is pickled next to the file (like the parsed score - see scoreCache) the first time it is made
+# so later midi requests - in any process - don't need the music21 score at all.  score_id is the hash of the file - so the pickle is named after it rather than hashing the file again
+def load_score_timeline(musicxml_filepath, score_id):
+    cache_filepath = os.path.join(os.path.dirname(os.path.realpath(musicxml_filepath)), f"{score_id}.timeline-{TIMELINE_VERSION}.p")
+    try:
+        with open(cache_filepath, 'rb') as fh:
+            return pickle.load(fh)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.exception("Unable to read score timeline %s - making it again" % cache_filepath)
+
+    timeline = ScoreTimeline(parsed_score_cache.load(musicxml_filepath))
+    try:
+        with atomic_write(cache_filepath) as fh:
+            pickle.dump(timeline, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        logger.exception("Unable to write score timeline %s" % cache_filepath)
+    return timeline
+
+
+# held while a midi file is made - by requests and by prefetching.  See path_lock()
+def midi_file_lock(midi_filepath):
+    return path_lock(midi_filepath, LOCK_DIR)
+
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=1)
+_prefetch_lock = threading.Lock()
+_prefetch_pending = set()
+
+
+# makes the rest of the files of midi_handler's segment in a background thread - using the score it has already loaded.
+# Only one at a time is made for a segment
+def prefetch_midi_files(midi_handler):
+    key = (midi_handler.folder, midi_handler.filename, midi_handler.start, midi_handler.end, midi_handler.queryString.get("bsi"), midi_handler.queryString.get("bpi"))
+    with _prefetch_lock:
+        if key in _prefetch_pending:
+            return
+        _prefetch_pending.add(key)
+
+    def prefetch():
+        try:
+            midi_handler.make_midi_files()
+        except Exception:
+            logger.exception(f"Unable to prefetch the midi files for {key}")
+        finally:
+            with _prefetch_lock:
+                _prefetch_pending.discard(key)
+
+    _prefetch_executor.submit(prefetch)
+
+
+# a measure of ScoreTimeline - offsets and durations are in quarter notes
+class TimelineMeasure:
+    def __init__(self, number, offset, duration, bar_duration, beat_durations, time_signature, has_notes_or_rests):
+        self.number = number
+        self.offset = offset
+        self.duration = duration  # the actual length eg a pickup bar is shorter than bar_duration
+        self.bar_duration = bar_duration  # the length of a full bar in the time signature
+        self.beat_durations = beat_durations  # the length of each beat - for the click track
+        self.time_signature = time_signature  # (numerator, denominator)
+        self.has_notes_or_rests = has_notes_or_rests
+
+
+# a part of ScoreTimeline.  notes = [(start offset, end offset, midi pitch, velocity)] sorted by start
+class TimelinePart:
+    def __init__(self, name, program, percussion, notes):
+        self.name = name
+        self.program = program
+        self.percussion = percussion
+        self.notes = notes
+        self.starts = [n[0] for n in notes]
+        self.longest = max((n[1] - n[0] for n in notes), default=0)  # so a note that starts before a segment but is still playing can be found
+
+    # the notes playing between the offsets - ie a slice of the notes found by a binary search
+    def get_notes(self, start, end):
+        first = bisect.bisect_left(self.starts, start - self.longest)
+        last = bisect.bisect_left(self.starts, end)
+        return [n for n in self.notes[first:last] if n[1] > start or (n[0] == n[1] and n[0] >= start)]
+
+
+# Everything needed to write the midi files of a score - taken from the music21 score in one pass.
+# Then each file (segment / tempo / click / parts) is just a slice of these lists handed to midiEncoder - rather than a new music21 Stream written with write('midi')
+class ScoreTimeline:
+    def __init__(self, score):
+        self.measures = self.make_measures(score.parts[0])
+        self.measure_numbers = [m.number for m in self.measures]
+        self.measure_numbers_in_order = self.measure_numbers == sorted(self.measure_numbers)
+        self.make_click_track()
+        self.instrument_part_ids = [ins.partId for ins in score.flat.getInstruments()]  # see MidiHandler.get_selected_instruments
+        self.parts = [self.make_part(part) for part in score.parts]
+        # (start offset, end offset, beats per minute where a beat is a quarter note)
+        tempos = []
+        sounding = {}  # start offset, tempo of a playback only mark (ie <sound tempo=...>) - which is played rather than the written mark at the same offset
+        for start, end, mm in TempoMap.from_score(score).tempos:
+            if mm.number is None and mm.numberSounding is not None:
+                sounding[start] = mm.numberSounding * mm.referent.quarterLength
+            if end > start:
+                mm = Music21TalkingScore.fix_tempo_number(tempo=mm)
+                tempos.append((start, end, sounding.get(start, mm.number * mm.referent.quarterLength)))
+        self.tempo_map = TempoMap(tempos)
+
+    def make_measures(self, part):
+        measures = []
+        beat_durations_cache = {}  # time signature ratio, beat durations
+        part_measures = list(part.getElementsByClass(stream.Measure))
+        # like Part.measure() - if every measure is numbered 0 then use the position instead
+        numbered = any(m.number != 0 for m in part_measures)
+        ts = None
+        for position, m in enumerate(part_measures):
+            if len(m.getElementsByClass(meter.TimeSignature)) > 0:
+                ts = m.getElementsByClass(meter.TimeSignature)[0]
+            # if the score didn't have a time signature - then just set it to 1/4 to get the first beat of each bar...
+            if ts is None:
+                ts = meter.TimeSignature('1/4')
+
+            beat_durations = beat_durations_cache.get(ts.ratioString)
+            if beat_durations is None:
+                beat_durations = [ts.getBeatDuration(0).quarterLength]  # specify beat number for complex time signatures...
+                for b in range(0, ts.beatCount-1):
+                    beat_durations.append(ts.getBeatDuration(sum(beat_durations)).quarterLength)
+                beat_durations_cache[ts.ratioString] = beat_durations
+
+            measures.append(TimelineMeasure(m.number if numbered else position + 1, float(m.getOffsetBySite(part)), float(m.duration.quarterLength), float(ts.barDuration.quarterLength),
+                                            [float(d) for d in beat_durations], (ts.numerator, ts.denominator), len(m.getElementsByClass(['Note', 'Rest'])) > 0))
+        return measures
+
+    # the click track of the whole score - [(start tick, end tick, pitch)] of every beat of every measure in order.  A segment's click track is a slice of it.
+    # A beat that would run past the end of a short measure (eg a bar split by a repeat) isn't clicked
+    def make_click_track(self):
+        self.clicks = []
+        for m in self.measures:
+            measure_end = m.offset + m.duration
+            beat_offset = m.offset
+            for beat, beat_duration in enumerate(m.beat_durations):
+                if beat_offset >= measure_end:
+                    break
+                pitch = midiEncoder.CLICK_FIRST_BEAT_PITCH if beat == 0 else midiEncoder.CLICK_BEAT_PITCH
+                self.clicks.append((midiEncoder.quarter_length_to_ticks(beat_offset), midiEncoder.quarter_length_to_ticks(min(beat_offset + beat_duration, measure_end)), pitch))
+                beat_offset += beat_duration
+        self.click_ticks = [c[0] for c in self.clicks]
+
+    # the click track of the measures in measure_range - as events for midiEncoder.  shift - the padding before a pickup bar (see make_midi)
+    def get_click_events(self, measure_range, shift):
+        first, last = measure_range
+        segment_start = midiEncoder.quarter_length_to_ticks(self.measures[first].offset)
+        segment_end = midiEncoder.quarter_length_to_ticks(self.measures[last].offset + self.measures[last].duration)
+        shift_ticks = midiEncoder.quarter_length_to_ticks(shift)
+        events = [(0, midiEncoder.EVENT_TRACK_NAME, "click")]
+        slice_start = segment_start
+        if shift > 0:
+            # a whole bar of clicks - that ends where the pickup bar ends
+            beat_tick = 0
+            for beat, beat_duration in enumerate(self.measures[first].beat_durations):
+                pitch = midiEncoder.CLICK_FIRST_BEAT_PITCH if beat == 0 else midiEncoder.CLICK_BEAT_PITCH
+                beat_ticks = midiEncoder.quarter_length_to_ticks(beat_duration)
+                events += midiEncoder.note_events(beat_tick, beat_tick + beat_ticks, midiEncoder.CLICK_CHANNEL, pitch, midiEncoder.CLICK_VELOCITY)
+                beat_tick += beat_ticks
+            slice_start = midiEncoder.quarter_length_to_ticks(self.measures[first].offset + self.measures[first].duration)
+
+        move = shift_ticks - segment_start
+        for start, end, pitch in self.clicks[bisect.bisect_left(self.click_ticks, slice_start):bisect.bisect_left(self.click_ticks, segment_end)]:
+            events += midiEncoder.note_events(start + move, end + move, midiEncoder.CLICK_CHANNEL, pitch, midiEncoder.CLICK_VELOCITY)
+        return events
+
+    # the score is our own copy from the cache - so it is changed in place
+    def make_part(self, part):
+        # tied notes are played as one note and the dynamics give the velocities - like music21 does when writing midi
+        part.stripTies(inPlace=True, matchByPitch=True)
+        volume.realizeVolume(part)
+
+        ins = part.getInstrument()
+        program = 0
+        percussion = False
+        if ins is not None:
+            if ins.midiProgram is not None:
+                program = ins.midiProgram
+            percussion = isinstance(ins, instrument.UnpitchedPercussion) or ins.midiChannel == midiEncoder.CLICK_CHANNEL
+
+        notes = []
+        flat = part.flatten()
+        for n in flat.notes:
+            if isinstance(n, harmony.ChordSymbol):
+                continue  # chord symbols aren't played
+            start = float(flat.elementOffset(n))
+            end = start + float(n.duration.quarterLength)
+            if n.isChord:
+                for component in n.notes:
+                    velocity_volume = component.volume if n.hasComponentVolumes() else n.volume
+                    notes.append((start, end, self.get_midi_pitch(component, ins), int(round(velocity_volume.cachedRealized * 127))))
+            else:
+                notes.append((start, end, self.get_midi_pitch(n, ins), int(round(n.volume.cachedRealized * 127))))
+        notes.sort(key=lambda n: n[0])
+        return TimelinePart(part.partName or "", program, percussion, notes)
+
+    def get_midi_pitch(self, n, ins):
+        if isinstance(n, note.Unpitched):
+            if isinstance(n.storedInstrument, instrument.UnpitchedPercussion) and n.storedInstrument.percMapPitch is not None:
+                return n.storedInstrument.percMapPitch
+            if isinstance(ins, instrument.UnpitchedPercussion) and ins.percMapPitch is not None:
+                return ins.percMapPitch
+            return 60  # eg lossy instrument recognition from musicxml
+        return n.pitch.midi
+
+    # (first, last) index in self.measures of the measures numbered start to end
+    def get_measure_range(self, start, end):
+        if self.measure_numbers_in_order:
+            first = min(bisect.bisect_left(self.measure_numbers, start), len(self.measures)-1)
+            last = max(first, bisect.bisect_right(self.measure_numbers, end) - 1)
+            return first, last
+        first = 0
+        while first < len(self.measures)-1 and self.measures[first].number < start:
+            first += 1
+        last = first
+        while last < len(self.measures)-1 and self.measures[last+1].number <= end:
+            last += 1
+        return first, last
+
+    # the bytes of a midi file of the parts for the measures in measure_range
+    # scale - tempo multiplier eg 0.5 for half speed.  click - add a click track on the beats
+    def make_midi(self, part_indexes, measure_range, scale, click):
+        first, last = measure_range
+        segment_start = self.measures[first].offset
+        segment_end = self.measures[last].offset + self.measures[last].duration
+
+        # If there is a pickup bar - everything is moved later so the click track can start on beat 1
+        shift = 0.0
+        if click and self.measures[first].duration < self.measures[first].bar_duration and self.measures[first].has_notes_or_rests:
+            shift = self.measures[first].bar_duration - self.measures[first].duration
+            logger.debug(f"pickup bar - shift = {shift}")
+
+        # anything before the segment (eg the start of a tied note) is moved to the start of the segment
+        def to_ticks(offset):
+            return midiEncoder.quarter_length_to_ticks(max(offset, segment_start) - segment_start + shift)
+
+        tempo_track = []
+        for start, end, quarter_bpm in self.tempo_map.overlapping(segment_start, segment_end - segment_start):
+            # the tempo at the start of the segment is also the tempo of the clicks before a pickup
+            tempo_tick = 0 if start <= segment_start else to_ticks(start)
+            tempo_track.append(midiEncoder.tempo_event(tempo_tick, quarter_bpm * scale))
+        previous_time_signature = None
+        for m in self.measures[first:last+1]:
+            if m.time_signature != previous_time_signature:
+                tempo_track.append((to_ticks(m.offset), midiEncoder.EVENT_TIME_SIGNATURE, m.time_signature))
+                previous_time_signature = m.time_signature
+        tracks = [tempo_track]
+
+        channel = 0
+        for part_index in part_indexes:
+            part = self.parts[part_index]
+            if part.percussion:
+                part_channel = midiEncoder.CLICK_CHANNEL
+            else:
+                part_channel = channel
+                channel += 1
+                if channel == midiEncoder.CLICK_CHANNEL:
+                    channel += 1
+                channel = channel % 16
+            track = [(0, midiEncoder.EVENT_TRACK_NAME, part.name), (0, midiEncoder.EVENT_PROGRAM, (part_channel, part.program))]
+            # a tied note that starts before the segment is played from the start of the segment
+            for start, end, pitch, velocity in part.get_notes(segment_start, segment_end):
+                track += midiEncoder.note_events(to_ticks(start), to_ticks(min(end, segment_end)), part_channel, pitch, velocity)
+            tracks.append(track)
+
+        if click:
+            tracks.append(self.get_click_events(measure_range, shift))
+
+        return midiEncoder.encode_midi_file(tracks)
@@ -6,7 +6,11 @@ import pprint
 import logging
 import logging.handlers
 import logging.config
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from music21 import *
+from lib.measureRepetition import find_measure_groups, MeasureGroupIndex
+from lib.eventTable import PartEventTable, EVENT_NOTE, EVENT_CHORD, EVENT_REST, EVENT_UNPITCHED, EVENT_OTHER
 
 logger = logging.getLogger("TSScore")
 
@@ -14,8 +18,8 @@ logger = logging.getLogger("TSScore")
 This code attempts to identify common elements in the music, along with their distribution and look for patterns or repetition.
 The basic idea is to make a separate index (or bucket) of each musical attribute we want to consider eg pitch / rhythm / interval / chord name etc.  
 
-To do this - we give some musical attributes a Dictionary - eg for pitch, the key is eg the midi pitch and the value is a List of all the indexes of those events in the Part.  
-Other musical attributes use a List to store what they are - because they are not a suitable datatype for a Dictionary key - eg the pitches in a chord; where each element is a List of pitches.  Then, similar to before, we use a dictionary but the key is the index in that List and again the value is a List of all the indexes of those events in the Part.
+To do this - each event in the Part is a row in a PartEventTable (see eventTable) with a column for each musical attribute - eg the midi pitch, the duration, the interval from the previous note.
+Some musical attributes are not a suitable datatype for a column - eg the pitches in a chord; where each element is a List of pitches.  So there is a List of each unique chord and the column is the index in that List.
 
 We then have an AnalyseIndex class which combines the indexes of all the musical attributes for each event.
 There is a List of AnalyseIndex instances where each one corresponds to eg a note / chord / rest etc in the Part.  And this stores the index of the type of musical attribute eg the A4 notes when looking at pitch, along with the index of this particular event from the dictionary of all the A4 notes.
@@ -31,7 +35,7 @@ class AnalyseIndex:
         self.event_index = ei
         self.event_type = ''  # n c r - note / chord / rest
 
-        # [the particular eg chord_interval_index, the occurance of that particular event in eg AnalysePart.chord_pitches_dictionary]
+        # [the particular eg chord_interval_index, the occurance of that particular event ie how many earlier events had the same eg chord pitches]
         self.chord_interval_index = [-1, -1]
         self.chord_pitches_index = [-1, -1]
         self.chord_name_index = ['', -1]
@@ -44,6 +48,28 @@ class AnalyseIndex:
         self.rhythm_chord_index = [-1, -1]
         self.rhythm_rest_index = [-1, -1]
 
+    # a hashable key - events with the same key match each other when comparing by compare_type
+    # compare_type - 0 = all, 1=rhythm, 2=intervals
+    def get_key(self, compare_type):
+        if compare_type == 0:
+            # the same event type then the important attributes of that particular event type
+            if self.event_type == 'n':
+                return (self.event_type, self.rhythm_note_index[0], self.pitch_number_index[0])
+            elif self.event_type == 'c':
+                return (self.event_type, self.rhythm_chord_index[0], self.chord_pitches_index[0])
+            elif self.event_type == 'r':
+                return (self.event_type, self.rhythm_rest_index[0])
+            return (self.event_type,)
+        elif compare_type == 1:
+            # rest durations must match.  Chords / single notes are interchangeable - but their durations must match
+            # only rests have a rhythm_rest_index so a rest never matches a note or chord
+            return (self.rhythm_chord_index[0], self.rhythm_note_index[0], self.rhythm_rest_index[0])
+        else:
+            # one might have a chord or play a note in octaves - and this will say the intervals don't match - because it is expecting single notes...
+            if self.event_type == 'n':
+                return (self.event_type, self.interval_index[0])
+            return (self.event_type,)
+
     def print_info(self):
         print("EventIndex..." + str(self.event_index) + " - type " + self.event_type)
         if (self.event_type == 'n'):
@@ -61,6 +87,10 @@ class AnalyseSection:
         self.analyse_indexes = []  # all the notes etc in the section
         self.section_start_event_indexes = []  # the event indexes each time this section starts
 
+    # sections match if all their events match in order
+    def get_key(self, compare_type):
+        return tuple(ai.get_key(compare_type) for ai in self.analyse_indexes)
+
     def print_info(self):
         print("section length = " + str(len(self.analyse_indexes)))
         # for ai in self.analyse_indexes:
@@ -75,7 +105,8 @@ class MusicAnalyser:
     repetition_right_hand = ""
     repetition_left_hand = ""
 
-    def setScore(self, ts):
+    # workers - the number of processes to analyse the parts in.  1 analyses them one after another in this process
+    def setScore(self, ts, workers=1):
         self.ts = ts
         self.score = ts.score
         part_index = 0
@@ -85,24 +116,40 @@ class MusicAnalyser:
         self.repetition_in_contexts = {}  # key = part index
         self.general_summary = ""
 
-        analyse_index = 0
+        selected_part_indexes = []
         for ins in ts.part_instruments:
             if ins in ts.selected_instruments:
                 start_part = ts.part_instruments[ins][1]
                 instrument_len = ts.part_instruments[ins][2]
-                for part_index in range(start_part, start_part+instrument_len):
-                    self.analyse_parts.append(AnalysePart())
-                    self.analyse_parts[analyse_index].set_part(self.score.parts[part_index])
-                    summary = self.analyse_parts[analyse_index].describe_summary()
-                    summary += self.analyse_parts[analyse_index].describe_repetition_summary()
-                    self.repetition_in_contexts[part_index] = (self.analyse_parts[analyse_index].describe_repetition_in_context())
-                    self.summary_parts.append(summary)
+                selected_part_indexes.extend(range(start_part, start_part+instrument_len))
 
-                    # self.repetition_parts.append(self.analyse_parts[analyse_index].describe_repetition())
-                    analyse_index = analyse_index + 1
+        if workers > 1 and len(selected_part_indexes) > 1:
+            self.analyse_parts_in_processes(selected_part_indexes, workers)
+        else:
+            for part_index in selected_part_indexes:
+                analyse_part = AnalysePart()
+                analyse_part.set_part(self.score.parts[part_index])
+                self.analyse_parts.append(analyse_part)
+                summary = analyse_part.describe_summary()
+                summary += analyse_part.describe_repetition_summary()
+                self.repetition_in_contexts[part_index] = (analyse_part.describe_repetition_in_context())
+                self.summary_parts.append(summary)
+
+                # self.repetition_parts.append(analyse_part.describe_repetition())
 
         self.general_summary += self.describe_general_summary()
 
+    # the parts don't depend on each other - so each is analysed in its own process.
+    # The workers are sent the events of the part (see part_events) rather than a pickled music21 Part - which is big and slow to pickle.
+    # The AnalyseParts stay in the workers - so self.analyse_parts is left empty - and just the descriptions come back, merged in part order
+    def analyse_parts_in_processes(self, part_indexes, workers):
+        parts_events = [part_events(self.score.parts[part_index]) for part_index in part_indexes]
+        with ProcessPoolExecutor(max_workers=min(workers, len(part_indexes))) as executor:
+            results = list(executor.map(analyse_part_events, parts_events))
+        for part_index, (summary, repetition_in_context) in zip(part_indexes, results):
+            self.summary_parts.append(summary)
+            self.repetition_in_contexts[part_index] = repetition_in_context
+
     # summarise time / key / tempo changes
     def describe_general_summary(self):
         num_measures = len(self.score.parts[0].getElementsByClass('Measure'))
@@ -206,78 +253,16 @@ class AnalysePart:
         0.0: 'grace notes',
     }
 
-    def compare_sections(self, s1: AnalyseSection, s2: AnalyseSection, compare_type):
-        to_return = True
-        if (len(s1.analyse_indexes) != len(s2.analyse_indexes)):
-            to_return = False
-        else:
-            for i in range(len(s1.analyse_indexes)):
-                if (compare_type == 0 and self.compare_indexes(s1.analyse_indexes[i], s2.analyse_indexes[i]) == False):
-                    to_return = False
-                    break
-                elif (compare_type == 1 and self.compare_indexes_rhythm(s1.analyse_indexes[i], s2.analyse_indexes[i]) == False):
-                    to_return = False
-                    break
-                elif (compare_type == 2 and self.compare_indexes_intervals(s1.analyse_indexes[i], s2.analyse_indexes[i]) == False):
-                    to_return = False
-                    break
-        return to_return
-
-    # one might have a chord or play a note in octaves - and this will say the intervals don't match - because it is expecting single notes...
-    def compare_indexes_intervals(self, ai1: AnalyseIndex, ai2: AnalyseIndex):
-        to_return = True
-        if not (ai1.event_type == ai2.event_type):
-            to_return = False
-        elif (ai1.event_type == 'n'):
-            if (ai1.interval_index[0] != ai2.interval_index[0]):
-                to_return = False
-
-        return to_return
-
-    # rest durations must match.  Chords / single notes are interchangeable - but their durations must match
-    def compare_indexes_rhythm(self, ai1: AnalyseIndex, ai2: AnalyseIndex):
-        to_return = True
-        if (ai1.event_type == 'r' and not ai2.event_type == 'r'):
-            to_return = False
-        elif ((ai1.event_type == 'n' or ai1.event_type == 'c') and ai2.event_type == 'r'):
-            to_return = False
-        elif ((ai1.rhythm_chord_index[0] != ai2.rhythm_chord_index[0])):
-            to_return = False
-        elif ((ai1.rhythm_note_index[0] != ai2.rhythm_note_index[0])):
-            to_return = False
-        elif ((ai1.rhythm_rest_index[0] != ai2.rhythm_rest_index[0])):
-            to_return = False
-
-        return to_return
-
-    # Check for the same event type then compare the important attributes of that particular event type
-    def compare_indexes(self, ai1: AnalyseIndex, ai2: AnalyseIndex):
-        to_return = True
-        if not (ai1.event_type == ai2.event_type):
-            to_return = False
-        elif (ai1.event_type == 'n'):
-            if (ai1.rhythm_note_index[0] != ai2.rhythm_note_index[0]):
-                to_return = False
-            if (ai1.pitch_number_index[0] != ai2.pitch_number_index[0]):
-                to_return = False
-        elif (ai1.event_type == 'c'):
-            if (ai1.rhythm_chord_index[0] != ai2.rhythm_chord_index[0]):
-                to_return = False
-            if (ai1.chord_pitches_index[0] != ai2.chord_pitches_index[0]):
-                to_return = False
-        elif (ai1.event_type == 'r'):
-            if (ai1.rhythm_rest_index[0] != ai2.rhythm_rest_index[0]):
-                to_return = False
-        return to_return
-
     def __init__(self):
         self.analyse_indexes_list = []  # a list of AnalyseIndex - each unique event}
         self.analyse_indexes_dictionary = {}  # {index of event, [List of event indexes]
         self.analyse_indexes_all = {}  # {event index, [index from analyse_indexes_list, index from analyse_indexes_dictionary]}
+        self.analyse_indexes_lookup = {}  # {AnalyseIndex.get_key(0), index in analyse_indexes_list}
 
         self.measure_indexes = {}  # the event index (from the Part) of the first event of each meausre.  A dictionary instead of a list because there might be a pickup bar
 
         self.measure_analyse_indexes_list = []  # each element represents a unique measure as an AnalyseSection - which includes a list of AnalyseIndexes
+        self.measure_analyse_indexes_lookup = {}  # {AnalyseSection.get_key(), index in measure_analyse_indexes_list}
         self.measure_analyse_indexes_dictionary = {}  # {index in measure_analyse_indexes_list, [list of measure indexes]}
         self.measure_analyse_indexes_all = {}  # the index of every measure within measure_analyse_indexes_list {meausre_index, [index from measure_analyse_indexes_list, index from measure_analyse_indexes_dictionary]}
         self.repeated_measures_lists = []  # List of lists of measure indexes where measures match [[1, 3, 6], [2, 4]]
@@ -285,6 +270,7 @@ class AnalysePart:
         self.repeated_measures_not_in_groups_dictionary = {}  # repeated measures that aren't in a group.  measure index, list of measures it is repeated at
 
         self.measure_rhythm_analyse_indexes_list = []  # each element is an AnalyseSection for a unique measure (containing a list of AnalyseIndex) - but ignoring pitch and intervals etc
+        self.measure_rhythm_analyse_indexes_lookup = {}  # {AnalyseSection.get_key(), index in measure_rhythm_analyse_indexes_list}
         self.measure_rhythm_analyse_indexes_dictionary = {}  # index of each measure occurrence with particular rhythm
         self.measure_rhythm_analyse_indexes_all = {}  # the index of every measure within measure_rhythm_analyse_indexes_list
         self.repeated_measures_lists_rhythm = []  # where the rhythm matches - but the measure isn't already a full match. [[1, 3, 6], [2, 4]]
@@ -292,42 +278,35 @@ class AnalysePart:
         self.repeated_rhythm_measures_not_full_match_not_in_groups_dictionary = {}  # measure index, list of measures it is repeated at
 
         self.measure_intervals_analyse_indexes_list = []  # each element is an AnalyseSection for a unique measure (containing a list of AnalyseIndex) - but ignoring rhythm etc
+        self.measure_intervals_analyse_indexes_lookup = {}  # {AnalyseSection.get_key(), index in measure_intervals_analyse_indexes_list}
         self.measure_intervals_analyse_indexes_dictionary = {}  # index of each measure occurrence with particular intervals
         self.measure_intervals_analyse_indexes_all = {}  # the index of every measure within measure_intervals_analyse_indexes_list
         self.repeated_measures_lists_intervals = []  # where the intervals match - but the measure isn't already a full match. [[1, 3, 6], [2, 4]]
         self.measure_intervals_not_full_match_groups_list = []  # [ [[1, 4], [9, 12]], [[7, 8], [15, 16]] ]
         self.repeated_intervals_measures_not_full_match_not_in_groups_dictionary = {}  # measure index, list of measures it is repeated at
 
-        self.pitch_number_dictionary = {}  # midi pitch number, list of event indexes
-        for i in range(128):
-            self.pitch_number_dictionary[i] = []
-        self.pitch_name_dictionary = {}  # pitch name (without octave), [event indexes]
-        self.interval_dictionary = {}  # interval (in semitones +x / -x / 0), [event indexes]
-        self.rhythm_note_dictionary = {}  # duration (in fractions of quarter notes) of single notes, [event indexes]
-        self.rhythm_rest_dictionary = {}  # duration (in fractions of quarter notes) of rests, [event indexes]
-        self.rhythm_chord_dictionary = {}  # duration (in fractions of quarter notes) of chords, [event indexes]
+        self.event_table = None  # PartEventTable - a row for each event in the Part
 
-        self.count_accidentals_in_measures = {}  # {measure number, number of accidentals in it}
-        self.count_gracenotes_in_measures = {}  # {measure number, number of accidentals in it}
-        self.count_rests_in_measures = {}  # {measure number, number of accidentals in it}
+        self.count_accidentals_in_measures = None  # number of accidentals in each measure of event_table.measure_numbers
+        self.count_gracenotes_in_measures = None  # number of grace notes in each measure of event_table.measure_numbers
+        self.count_rests_in_measures = None  # number of rests in each measure of event_table.measure_numbers
 
         self.chord_pitches_list = []  # each unique chord based on pitches (midi number)
-        self.chord_pitches_dictionary = {}  # index in chord_pitches_list, [event indexes]
+        self.chord_pitches_lookup = {}  # tuple of chord pitches, index in chord_pitches_list
         self.chord_intervals_list = []  # each unique chord based on the intervals in it
-        self.chord_intervals_dictionary = {}  # index in chord_intervals_list, [event indexes]
-        self.chord_common_name_dictionary = {}  # chord name, [event indexes]
+        self.chord_intervals_lookup = {}  # tuple of chord intervals, index in chord_intervals_list
 
-        self.count_pitches = []  # [[pitch number, count]] ordered by descending count. produced by count_dictionary()
-        self.count_pitch_names = []  # [[pitch name, count]] ordered by descending count. produced by count_dictionary()
-        self.count_intervals = []  # [[interval +x / -x / 0, count]] ordered by descending count. produced by count_dictionary()
+        self.count_pitches = []  # [[pitch number, count]] ordered by descending count
+        self.count_pitch_names = []  # [[pitch name, count]] ordered by descending count
+        self.count_intervals = []  # [[interval +x / -x / 0, count]] ordered by descending count
         self.count_intervals_abs = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]  # count of intervals (unison to 2 octaves) - ignore ascending or descending
-        self.count_chord_pitches = []  # [[key from chord_pitches_dictionary, count]] ordered by descending count. produced by count_dictionary()
-        self.count_chord_intervals = []  # [[key from chord_intervals_dictionary, count]] ordered by descending count. produced by count_dictionary()
-        self.count_chord_common_names = []  # [[chord common name, count]] ordered by descending count. produced by count_dictionary()
+        self.count_chord_pitches = []  # [[index in chord_pitches_list, count]] ordered by descending count
+        self.count_chord_intervals = []  # [[index in chord_intervals_list, count]] ordered by descending count
+        self.count_chord_common_names = []  # [[chord common name, count]] ordered by descending count
         self.count_notes_in_chords = {2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 7: 0, 8: 0, 9: 0, 10: 0}  # {number of notes in chord, number of occurances}
-        self.count_rhythm_note = []  # [[duration of individual note, count]] ordered by descending count. produced by count_dictionary()
-        self.count_rhythm_rest = []  # [[duration of rest, count]] ordered by descending count. produced by count_dictionary()
-        self.count_rhythm_chord = []  # [[duration of chord, count]] ordered by descending count. produced by count_dictionary()
+        self.count_rhythm_note = []  # [[duration of individual note, count]] ordered by descending count
+        self.count_rhythm_rest = []  # [[duration of rest, count]] ordered by descending count
+        self.count_rhythm_chord = []  # [[duration of chord, count]] ordered by descending count
 
         # used for calculating percentages etc
         self.total_note_duration = 0
@@ -345,70 +324,59 @@ class AnalysePart:
         self.possible_accidental_count = 0  # each note - on its own or part of a chord
 
         self.part = None
+        self.measure_count = 0  # number of measures in the part
 
     # if a section doesn't contain any consecutive notes - then it doesn't contain any intervals...
-    # since all the interval indexes default to None so we check this first otherwise compare_sections will think it is a match for intervals!
+    # since all the interval indexes default to None so we check this first otherwise the interval keys of sections without intervals would all match!
     def does_section_contain_intervals(self, section: AnalyseSection):
         for ai in section.analyse_indexes:
             if (ai.interval_index[0] != None):
                 return True
         return False
 
+    # add a measure to eg measure_analyse_indexes_list if there isn't already a matching one - and record where the measure is used
     # compare_type - 0 = all, 1=rhythm, 2=intervals
-    def find_section(self, section_to_find: AnalyseSection, sections_to_search, compare_type):
-        i = 0
-        for s in sections_to_search:
-            if self.compare_sections(s, section_to_find, compare_type):
-                return i
-            i += 1
-        return -1
+    def add_measure_section(self, section: AnalyseSection, measure_index, compare_type, sections_list, sections_lookup, sections_dictionary, sections_all):
+        key = section.get_key(compare_type)
+        index = sections_lookup.get(key)
+        if index is None:
+            sections_list.append(section)
+            index = len(sections_list)-1
+            sections_lookup[key] = index
+            sections_dictionary[index] = [measure_index]
+            sections_all[measure_index] = [index, 0]
+        else:
+            sections_dictionary[index].append(measure_index)
+            sections_all[measure_index] = [index, len(sections_dictionary[index])-1]
+
+    # add the measure to the lists of unique measures, unique rhythms and unique intervals
+    def add_measure(self, section: AnalyseSection, measure_index):
+        self.add_measure_section(section, measure_index, 0, self.measure_analyse_indexes_list, self.measure_analyse_indexes_lookup, self.measure_analyse_indexes_dictionary, self.measure_analyse_indexes_all)
+        # measures with matching rhythm
+        self.add_measure_section(section, measure_index, 1, self.measure_rhythm_analyse_indexes_list, self.measure_rhythm_analyse_indexes_lookup, self.measure_rhythm_analyse_indexes_dictionary, self.measure_rhythm_analyse_indexes_all)
+        # measures with matching intervals
+        if (self.does_section_contain_intervals(section)):
+            self.add_measure_section(section, measure_index, 2, self.measure_intervals_analyse_indexes_list, self.measure_intervals_analyse_indexes_lookup, self.measure_intervals_analyse_indexes_dictionary, self.measure_intervals_analyse_indexes_all)
 
     def find_analyse_index(self, ai):
-        ai_index = 0
-        for a in self.analyse_indexes_list:
-            if self.compare_indexes(ai, a):
-                return ai_index
-            ai_index += 1
-        return -1
+        return self.analyse_indexes_lookup.get(ai.get_key(0), -1)
 
     # find chord (based on midi pitches) in self.chord_pitches_list
-    def find_chord(self, chord):
-        chord_index = 0
-        find = sorted(p.midi for p in chord.pitches)
-        for c in self.chord_pitches_list:
-            if c == find:
-                return chord_index
-            chord_index += 1
-        return -1
+    def find_chord(self, chord_pitches):
+        return self.chord_pitches_lookup.get(tuple(sorted(chord_pitches)), -1)
 
     # find chord (based on intervals) in self.chord_intervals_list
     def find_chord_intervals(self, chord_intervals):
-        chord_index = 0
-        for c in self.chord_intervals_list:
-            if c == chord_intervals:
-                return chord_index
-            chord_index += 1
-        return -1
+        return self.chord_intervals_lookup.get(tuple(chord_intervals), -1)
 
     # return a sorted list of ascending intervals from lowest note - don't include 0
     # major triad = [4, 7]
-    def make_chord_intervals(self, chord):
-        p1 = chord.pitches[0].midi
-        pitches = sorted(p.midi for p in chord.pitches[1:])
+    def make_chord_intervals(self, chord_pitches):
+        p1 = chord_pitches[0]
+        pitches = sorted(chord_pitches[1:])
         intervals = [p-p1 for p in pitches]
         return intervals
 
-    # measure_index = when is this measure next used
-    # from_all eg self.measure_analyse_indexes_all = {} # the index of every measure within measure_analyse_indexes_list {meausre_index, [index from measure_analyse_indexes_list, index from measure_analyse_indexes_dictionary]}
-    # from_indexes_dictionary eg self.measure_analyse_indexes_dictionary = {} # {index in measure_analyse_indexes_list, [list of measure indexes]}
-    # returns the measure number or -1 if not found.
-    def when_is_measure_next_used(self, measure_index, from_all, from_indexes_dictionary):
-        mia = from_indexes_dictionary[from_all[measure_index][0]]
-        if len(mia)-1 > from_all[measure_index][1]:
-            return mia[from_all[measure_index][1]+1]
-        else:
-            return -1
-
     # from_list = list of lists where measure (eg rhythm) is repeated - eg [[1, 3, 6], [2, 4]] ie measure 1 is used at 3 and 6.  Measure 2 is used at 4.
     # basically depending which list is passed in - see if two measures have the same rhythm / intervals etc
     def are_measures_in(self, group_list, measure_index1, measure_index2):
@@ -417,30 +385,6 @@ class AnalysePart:
                 return True
         return False
 
-    # do two measures have matching pitch / rhythm / intervals etc
-    def is_measure_used_at(self, indexes_all, current_measure_index, check_measure_index):
-        # todo - these two checks are in case a measure doesn't have anything in then won't be added as a key to the dictionary...
-        if not check_measure_index in indexes_all:
-            return False
-        elif not current_measure_index in indexes_all:
-            return False
-        else:
-            if (indexes_all[current_measure_index][0] == indexes_all[check_measure_index][0]):
-                return True
-            else:
-                return False
-
-    # mg = start and end measure in group [1,4]
-    # mg_lists = list of lists of measure groups eg [ [[1,4],[5,8]], [[9,10],[11,12]] ]
-    def find_measure_group(self, mg, mg_lists):
-        mg_index = 0
-        for measure_groups in mg_lists:
-            for group in measure_groups:
-                if mg == group:
-                    return mg_index
-            mg_index += 1
-        return -1
-
     # from_measures_dictionary will be eg measure_analyse_indexes_dictionary eg {0: [1,3], 1:[2,4]}
     # not_full_match - when true, find eg rhythm or interval measures that are not a complete match
     # returns eg [[1, 3], [2, 4]]
@@ -460,73 +404,23 @@ class AnalysePart:
     # find repeated measures that aren't already in a group
     def calculate_repeated_measures_not_in_groups(self, measures_list, groups_list):
         output_dictionary = {}
+        group_index = MeasureGroupIndex(groups_list)
         for measure_indexes in measures_list:
             if len(measure_indexes) > 1:  # the measure is used more than once
                 measures = []
                 for measure_index in measure_indexes:
-                    if not self.in_measure_groups(measure_index, groups_list):
+                    if not group_index.contains(measure_index):
                         measures.append(measure_index)
 
                 if len(measures) > 1:
                     output_dictionary[measures[0]] = measures[1:]
         return output_dictionary
 
-    # is a measure already in a list of measure groups
-    def in_measure_groups(self, measure_index, groups_list):
-        for mgl in groups_list:
-            for mg in mgl:
-                if measure_index >= mg[0] and measure_index <= mg[1]:
-                    return True
-        return False
-
-    # are both measures already in the same group.  Ie 1 to 4 is used at 5 to 8.  So 2 to is used at 6 to 8 - but you don't want to say that.
-    def are_measures_in_same_group(self, measure_index1, measure_index2, groups_list):
-        for mgl in groups_list:
-            for mg in mgl:
-                if measure_index1 >= mg[0] and measure_index1 <= mg[1] and measure_index2 >= mg[0] and measure_index2 <= mg[1]:
-                    return True
-        return False
-
     # from_indexes_all eg self.measure_analyse_indexes_all - {meausre_index, [index from measure_analyse_indexes_list, index from measure_analyse_indexes_dictionary]}
-    # from_indexes_dictionary eg measure_analyse_indexes_dictionary - {index in measure_analyse_indexes_list, [list of measure indexes]}
-    # returns eg self.measure_groups_list = [] #groups of repeated measures [ [[1, 4], [9, 12]], [[5, 6], [7,8]] ]
-    # TODO - improve so it the first measure in the group can be used more than once
-    def calculate_measure_groups(self, from_indexes_all, from_indexes_dictionary):
-        to_list = []
-        next_used_at = 1
-        group_size = 1
-        gap = 1
-        skip = 0
-        for look_at_measure in from_indexes_all:
-            # if measures 1 to 4 are repeated then don't mention that 2 to 4 and 3 to 4 are also repeated!
-            if (skip > 0):
-                skip -= 1
-                continue
-
-            # see when the current measure is next used
-            next_used_at = self.when_is_measure_next_used(look_at_measure, from_indexes_all, from_indexes_dictionary)
-            if next_used_at > -1:
-                gap = next_used_at - look_at_measure
-                # eg if 4 is used at 6, check if 5 is used at 7
-                if gap > 1:
-                    group_size = 1
-                    while (group_size < gap and (look_at_measure + group_size + gap) in from_indexes_all) and (self.is_measure_used_at(from_indexes_all, look_at_measure + group_size, look_at_measure + group_size + gap)):
-                        group_size += 1
-
-                    group_size -= 1
-
-                    # if a group of bars is actually repeated
-                    if (group_size > 0):
-                        measure_group = [look_at_measure, look_at_measure + group_size]
-                        measure_group_index = self.find_measure_group(measure_group, to_list)
-                        if (measure_group_index == -1):  # ie need to add 1st and 2nd occurance.  When you come to 2nd and 3rd occurance - the 2nd occurance will already have been added.  Does it this way to avoid not adding the final occurance
-                            to_list.append([measure_group])
-                            to_list[len(to_list)-1].append([look_at_measure + gap, look_at_measure + gap + group_size])
-                        else:
-                            to_list[measure_group_index].append([look_at_measure + gap, look_at_measure + gap + group_size])
-
-                        skip = group_size  # not great as it overlooks possible smaller gruops within large groups eg it will find 1 t 8 being used at 9 to 16 but miss 1 to 4 being used at 17 to 20.
-        return to_list
+    # returns eg self.measure_groups_list = [] #groups of repeated measures [ [[1, 8], [9, 16]], [[1, 4], [17, 20]] ]
+    # see measureRepetition - it finds every repeated group, including smaller groups within larger groups
+    def calculate_measure_groups(self, from_indexes_all):
+        return find_measure_groups(from_indexes_all)
 
     def describe_repetition_percentage(self, percent):
         if percent > 99:
@@ -554,30 +448,20 @@ class AnalysePart:
             output += str(v)
         return output
 
-    # count_in_measures = a dictionary {measure index, number of eg rests accidentals in that measure}
+    # count_in_measures = the number of eg rests / accidentals in each measure of self.event_table.measure_numbers
     # total = the total number of rests / accidentals
 
     def describe_distribution(self, count_in_measures, total):
         distribution = ""
+        measure_numbers = self.event_table.measure_numbers
+        measure_percents = (count_in_measures/total)*100
 
-        # make a dictionary of percentages for each measure then sort by percent descending
-        measure_percents = {}
-        for k, c in count_in_measures.items():
-            if c > 0:
-                measure_percents[k] = (c/total)*100
-        sorted_percent = dict(sorted(measure_percents.items(), reverse=True, key=lambda item: item[1]))
-
-        # get any measures with more than a high percent (eg 20%) to name individually
-        ms = []
-        to_pop = []  # can't pop during for loop
-        for m, p in sorted_percent.items():
-            if p > 20:
-                ms.append(m)
-                to_pop.append(m)
-        percent_remaining = 100
-        for tp in to_pop:
-            percent_remaining -= measure_percents[tp]
-            measure_percents.pop(tp)
+        # get any measures with more than a high percent (eg 20%) to name individually - sorted by percent descending
+        by_percent = np.argsort(-measure_percents, kind='stable')
+        named = by_percent[measure_percents[by_percent] > 20]
+        ms = measure_numbers[named].tolist()
+        percent_remaining = 100 - measure_percents[named].sum()
+        remaining = (count_in_measures > 0) & (measure_percents <= 20)
 
         if len(ms) > 0:
             distribution += " mostly in bar"
@@ -587,20 +471,13 @@ class AnalysePart:
             distribution += self.comma_and_list(ms)
 
         # now see if the remaining measures are mostly in a particular quarter
-        if len(measure_percents) > 0:
+        if remaining.any():
             if not distribution == "":
                 distribution += " and "
-            dist = {0: 0, 1: 0, 2: 0, 3: 0}
-            for index, mp in measure_percents.items():
-                if (index > len(count_in_measures)*0.75):
-                    dist[3] += (mp/percent_remaining)*100
-                elif (index > len(count_in_measures)*0.5):
-                    dist[2] += (mp/percent_remaining)*100
-                elif (index > len(count_in_measures)*0.25):
-                    dist[1] += (mp/percent_remaining)*100
-                else:
-                    dist[0] += (mp/percent_remaining)*100
-            sorted_dist = sorted(dist.items(), reverse=True, key=lambda item: item[1])
+            index = measure_numbers[remaining]
+            quarter = np.select([index > len(count_in_measures)*0.75, index > len(count_in_measures)*0.5, index > len(count_in_measures)*0.25], [3, 2, 1], 0)
+            dist = np.bincount(quarter, weights=(measure_percents[remaining]/percent_remaining)*100, minlength=4)
+            sorted_dist = sorted(enumerate(dist.tolist()), reverse=True, key=lambda item: item[1])
             positions = " "
             # if over half are in one quarter - mention it
             if sorted_dist[0][1] > 50:
@@ -610,7 +487,7 @@ class AnalysePart:
                 positions += self._position_map[sorted_dist[0][0]] + " and " + self._position_map[sorted_dist[1][0]]
             else:
                 # not in any two quarters - so just say how many bars
-                positions += "in " + str(len(measure_percents)) + " bars throughout"
+                positions += "in " + str(int(remaining.sum())) + " bars throughout"
 
             distribution += positions
 
@@ -908,7 +785,7 @@ class AnalysePart:
         if temp != "":
             repetition += "The repeated sections of just rhythm / intervals are " + temp + " measures long.  "
 
-        if (len(self.part.getElementsByClass('Measure')) > 1):
+        if (self.measure_count > 1):
             repetition += "There are " + str(len(self.measure_analyse_indexes_list)) + " unique measures - "
             repetition += " of these, " + str(len(self.measure_rhythm_analyse_indexes_list)) + " measures have unique rhythm "
             repetition += " and " + str(len(self.measure_intervals_analyse_indexes_list)) + " measures have unique intervals...  "
@@ -1114,253 +991,96 @@ class AnalysePart:
 
     def set_part(self, p):
         self.part = p
-
-        event_index = 0
-        previous_note_pitch = -1  # needed to work out intervals
-        current_measure = -1
+        self.set_events(part_events(p))
+
+    # events - see part_events.  The analysis only needs these - not the music21 Part - so it can be done in another process
+    def set_events(self, events):
+        self.measure_count = events['measure_count']
+        self.event_table = self.make_event_table(events['events'])
+        table = self.event_table
+
+        # AnalyseIndex for each event - the occurrences are how many earlier events had the same eg pitch
+        is_note = table.event_type == EVENT_NOTE
+        is_chord = table.event_type == EVENT_CHORD
+        is_rest = table.event_type == EVENT_REST
+        is_single = is_note | (table.event_type == EVENT_UNPITCHED)
+        not_grace = table.quarter_length > 0.0  # grace notes are counted separately
+        columns = {
+            'event_type': table.event_type.tolist(),
+            'measure': table.measure.tolist(),
+            'duration': table.duration.tolist(),
+            'midi': table.midi.tolist(),
+            'pitch_name': table.pitch_name.tolist(),
+            'interval': table.interval.tolist(),
+            'has_interval': table.has_interval.tolist(),
+            'chord_pitches': table.chord_pitches.tolist(),
+            'chord_intervals': table.chord_intervals.tolist(),
+            'chord_name': table.chord_name.tolist(),
+            'rhythm_rest': table.occurrences(table.duration, is_rest).tolist(),
+            'rhythm_chord': table.occurrences(table.duration, is_chord & not_grace).tolist(),
+            'rhythm_note': table.occurrences(table.duration, is_single & not_grace).tolist(),
+            'pitch_number_occurrence': table.occurrences(table.midi, is_note).tolist(),
+            'pitch_name_occurrence': table.occurrences(table.pitch_name, is_note).tolist(),
+            'interval_occurrence': table.occurrences(table.interval, table.has_interval).tolist(),
+            'chord_pitches_occurrence': table.occurrences(table.chord_pitches, is_chord).tolist(),
+            'chord_intervals_occurrence': table.occurrences(table.chord_intervals, is_chord).tolist(),
+            'chord_name_occurrence': table.occurrences(table.chord_name, is_chord).tolist(),
+        }
+        durations = table.durations.values
+
+        current_measure = None
         measure_analyse_indexes = AnalyseSection()
-        measure_accidentals = 0  # count
-        measure_gracenotes = 0  # count
-        measure_rests = 0  # count
-        for n in self.part.flat.notesAndRests:
+        for event_index in range(table.length):
             # the start of a new measure
-            if (n.measureNumber > current_measure):
-                # todo - if a measure doesn't have any notes or rests then it won't be added to measure_indexes etc and will cause errors later when looking for groups etc
-                self.measure_indexes[n.measureNumber] = event_index
-                current_measure = n.measureNumber
+            if columns['measure'][event_index] != current_measure:
                 if (len(measure_analyse_indexes.analyse_indexes) > 0):  # first time through will be empty
-                    self.count_accidentals_in_measures[current_measure-1] = measure_accidentals
-                    measure_accidentals = 0
-                    self.count_gracenotes_in_measures[current_measure-1] = measure_gracenotes
-                    measure_gracenotes = 0
-                    self.count_rests_in_measures[current_measure-1] = measure_rests
-                    measure_rests = 0
-
-                    index = self.find_section(measure_analyse_indexes, self.measure_analyse_indexes_list, 0)
-                    if index == -1:
-                        self.measure_analyse_indexes_list.append(measure_analyse_indexes)
-                        index = len(self.measure_analyse_indexes_list)-1
-                        self.measure_analyse_indexes_dictionary[index] = [current_measure-1]
-                        self.measure_analyse_indexes_all[current_measure-1] = [index, 0]
-                    else:
-                        self.measure_analyse_indexes_dictionary[index].append(current_measure-1)
-                        self.measure_analyse_indexes_all[current_measure-1] = [index, len(self.measure_analyse_indexes_dictionary[index])-1]
-
-                    # measures with matching rhythm
-                    index = self.find_section(measure_analyse_indexes, self.measure_rhythm_analyse_indexes_list, 1)
-                    if index == -1:
-                        self.measure_rhythm_analyse_indexes_list.append(measure_analyse_indexes)
-                        index = len(self.measure_rhythm_analyse_indexes_list)-1
-                        self.measure_rhythm_analyse_indexes_dictionary[index] = [current_measure-1]
-                        self.measure_rhythm_analyse_indexes_all[current_measure-1] = [index, 0]
-                    else:
-                        self.measure_rhythm_analyse_indexes_dictionary[index].append(current_measure-1)
-                        self.measure_rhythm_analyse_indexes_all[current_measure-1] = [index, len(self.measure_rhythm_analyse_indexes_dictionary[index])-1]
-
-                    # measures with matching intervals
-                    if (self.does_section_contain_intervals(measure_analyse_indexes)):
-                        index = self.find_section(measure_analyse_indexes, self.measure_intervals_analyse_indexes_list, 2)
-                        if index == -1:
-                            self.measure_intervals_analyse_indexes_list.append(measure_analyse_indexes)
-                            index = len(self.measure_intervals_analyse_indexes_list)-1
-                            self.measure_intervals_analyse_indexes_dictionary[index] = [current_measure-1]
-                            self.measure_intervals_analyse_indexes_all[current_measure-1] = [index, 0]
-                        else:
-                            self.measure_intervals_analyse_indexes_dictionary[index].append(current_measure-1)
-                            self.measure_intervals_analyse_indexes_all[current_measure-1] = [index, len(self.measure_intervals_analyse_indexes_dictionary[index])-1]
-
+                    self.add_measure(measure_analyse_indexes, current_measure)
                     measure_analyse_indexes = AnalyseSection()
-                    previous_note_pitch = -1  # reset interval comparison for each measure
+                current_measure = columns['measure'][event_index]
 
             ai = AnalyseIndex(event_index)
-            if n.isRest:
+            event_type = columns['event_type'][event_index]
+            if event_type == EVENT_REST:
                 ai.event_type = 'r'
-                measure_rests += 1
-                d = n.duration.quarterLength
-                if self.rhythm_rest_dictionary.get(d) == None:
-                    self.rhythm_rest_dictionary[d] = [event_index]
-                else:
-                    self.rhythm_rest_dictionary[d].append(event_index)
-                ai.rhythm_rest_index = [d, len(self.rhythm_rest_dictionary.get(d))-1]
-
-                previous_note_pitch = -1
-                self.total_rest_duration += d
-                self.rest_count += 1
-            elif n.isChord and type(n).__name__ != 'ChordSymbol':
-                # todo - maybe analyse ChordSymbol too - it won't cause an error - just thinks they are grace notes and affects counting notes / pitches / repetition etc
+                ai.rhythm_rest_index = [durations[columns['duration'][event_index]], columns['rhythm_rest'][event_index]]
+            elif event_type == EVENT_CHORD:
                 ai.event_type = 'c'
-
-                d = n.duration.quarterLength
-                if d == 0.0:
-                    measure_gracenotes += len(n.pitches)
-                    self.gracenote_count += len(n.pitches)
-
-                if d > 0.0:  # bigger than a grace note because they are counted separately
-                    if self.rhythm_chord_dictionary.get(d) == None:
-                        self.rhythm_chord_dictionary[d] = [event_index]
-                    else:
-                        self.rhythm_chord_dictionary[d].append(event_index)
-                    ai.rhythm_chord_index = [d, len(self.rhythm_chord_dictionary.get(d))-1]
-
-                if len(n.pitches) < 11:  # unlikely as not enough fingers - but best to check!
-                    self.count_notes_in_chords[len(n.pitches)] += 1
-
-                index = self.find_chord(n)
-                if index == -1:
-                    self.chord_pitches_list.append(sorted(p.midi for p in n.pitches))
-                    index = len(self.chord_pitches_list)-1
-                    self.chord_pitches_dictionary[index] = [event_index]
-                else:
-                    self.chord_pitches_dictionary[index].append(event_index)
-                ai.chord_pitches_index = [index, len(self.chord_pitches_dictionary.get(index))-1]
-
-                chord_intervals = self.make_chord_intervals(n)
-                index = self.find_chord_intervals(chord_intervals)
-                if index == -1:
-                    self.chord_intervals_list.append(chord_intervals)
-                    index = len(self.chord_intervals_list)-1
-                    self.chord_intervals_dictionary[index] = [event_index]
-                else:
-                    self.chord_intervals_dictionary[index].append(event_index)
-                ai.chord_interval_index = [index, len(self.chord_intervals_dictionary.get(index))-1]
-
-                common_name = n.commonName
-                # music21 describes eg A, D, E as a quatral trichord - ie E, A, D are perfect fourths - but I prefer Suspended 4ths or 2nds...
-                if chord_intervals == [0, 5, 7]:
-                    common_name = "Suspended 4th"
-                elif chord_intervals == [0, 2, 7]:
-                    common_name = "Suspended 2nd"
-                if self.chord_common_name_dictionary.get(common_name) == None:
-                    self.chord_common_name_dictionary[common_name] = [event_index]
-                else:
-                    self.chord_common_name_dictionary[common_name].append(event_index)
-                ai.chord_name_index = [common_name, len(self.chord_common_name_dictionary.get(common_name))-1]
-
-                # count accidentals in the chord
-                for p in n.pitches:
-                    if p.accidental is not None and p.accidental.displayStatus == True:
-                        measure_accidentals += 1
-                        self.accidental_count += 1
-                self.possible_accidental_count += len(n.pitches)
-
-                self.total_chord_duration += d
-                self.chord_count += 1
-            elif n.isChord == False:
-                if isinstance(n, note.Unpitched):
+                if columns['rhythm_chord'][event_index] > -1:
+                    ai.rhythm_chord_index = [durations[columns['duration'][event_index]], columns['rhythm_chord'][event_index]]
+                ai.chord_pitches_index = [columns['chord_pitches'][event_index], columns['chord_pitches_occurrence'][event_index]]
+                ai.chord_interval_index = [columns['chord_intervals'][event_index], columns['chord_intervals_occurrence'][event_index]]
+                ai.chord_name_index = [table.chord_names.values[columns['chord_name'][event_index]], columns['chord_name_occurrence'][event_index]]
+            elif event_type == EVENT_NOTE or event_type == EVENT_UNPITCHED:
+                if event_type == EVENT_UNPITCHED:
                     ai.event_type = 'u'
                 else:
-
                     ai.event_type = 'n'
-
-                    if n.pitch.accidental is not None and n.pitch.accidental.displayStatus == True:
-                        measure_accidentals += 1
-                        self.accidental_count += 1
-                    self.possible_accidental_count += 1
-
-                    self.pitch_number_dictionary[n.pitch.midi].append(event_index)
-                    ai.pitch_number_index = [n.pitch.midi, len(self.pitch_number_dictionary[n.pitch.midi])-1]
-
-                    if self.pitch_name_dictionary.get(n.pitch.name) == None:
-                        self.pitch_name_dictionary[n.pitch.name] = [event_index]
-                    else:
-                        self.pitch_name_dictionary[n.pitch.name].append(event_index)
-                    ai.pitch_name_index = [n.pitch.name, len(self.pitch_name_dictionary[n.pitch.name])-1]
-
-                    # intervals
-                    if (previous_note_pitch > -1):
-                        interval = n.pitch.midi-previous_note_pitch
-                        if self.interval_dictionary.get(interval) == None:
-                            self.interval_dictionary[interval] = [event_index]
-                        else:
-                            self.interval_dictionary[interval].append(event_index)
-                        ai.interval_index = [interval, len(self.interval_dictionary.get(interval))-1]
-
-                        if interval > 0:
-                            self.interval_ascending_count += 1
-                        elif interval < 0:
-                            self.interval_descending_count += 1
-                        else:
-                            self.interval_unison_count += 1
-                        self.interval_count += 1
-
-                        interval_abs = abs(interval)
-                        if interval_abs < 24:
-                            self.count_intervals_abs[interval_abs] += 1
-
-                # duration
-                d = n.duration.quarterLength  # numeric value
-                if d == 0.0:
-                    measure_gracenotes += 1
-                    self.gracenote_count += 1
-                    print("I'm a grace note note...")
-                    print(n)
-                if d > 0.0:  # bigger than a grace note because they are counted separately
-                    if self.rhythm_note_dictionary.get(d) == None:
-                        self.rhythm_note_dictionary[d] = [event_index]
-                    else:
-                        self.rhythm_note_dictionary[d].append(event_index)
-                    ai.rhythm_note_index = [d, len(self.rhythm_note_dictionary.get(d))-1]
-
-                if isinstance(n, note.Unpitched):
-                    previous_note_pitch = -1
-                else:
-                    previous_note_pitch = n.pitch.midi
-                self.total_note_duration += d
-                self.note_count += 1
+                    ai.pitch_number_index = [columns['midi'][event_index], columns['pitch_number_occurrence'][event_index]]
+                    ai.pitch_name_index = [table.pitch_names.values[columns['pitch_name'][event_index]], columns['pitch_name_occurrence'][event_index]]
+                    if columns['has_interval'][event_index]:
+                        ai.interval_index = [columns['interval'][event_index], columns['interval_occurrence'][event_index]]
+                if columns['rhythm_note'][event_index] > -1:
+                    ai.rhythm_note_index = [durations[columns['duration'][event_index]], columns['rhythm_note'][event_index]]
 
             # AnalyseIndex - ie is it a unique event
             index = self.find_analyse_index(ai)
             if index == -1:
                 self.analyse_indexes_list.append(ai)
                 index = len(self.analyse_indexes_list)-1
+                self.analyse_indexes_lookup[ai.get_key(0)] = index
                 self.analyse_indexes_dictionary[index] = [event_index]
                 self.analyse_indexes_all[event_index] = [index, 0]
             else:
                 self.analyse_indexes_dictionary[index].append(event_index)
                 self.analyse_indexes_all[event_index] = [index, len(self.analyse_indexes_dictionary[index])-1]
 
-            # self.analyse_indexes.append(ai)
             measure_analyse_indexes.analyse_indexes.append(ai)
-            event_index = event_index + 1
 
         # add last measure
         if (len(measure_analyse_indexes.analyse_indexes) > 0):
-            self.count_accidentals_in_measures[current_measure-1] = measure_accidentals
-            self.count_gracenotes_in_measures[current_measure-1] = measure_gracenotes
-            self.count_rests_in_measures[current_measure-1] = measure_rests
-
-            index = self.find_section(measure_analyse_indexes, self.measure_analyse_indexes_list, 0)
-            if index == -1:
-                self.measure_analyse_indexes_list.append(measure_analyse_indexes)
-                index = len(self.measure_analyse_indexes_list)-1
-                self.measure_analyse_indexes_dictionary[index] = [current_measure]
-                self.measure_analyse_indexes_all[current_measure] = [index, 0]
-            else:
-                self.measure_analyse_indexes_dictionary[index].append(current_measure)
-                self.measure_analyse_indexes_all[current_measure] = [index, len(self.measure_analyse_indexes_dictionary[index])-1]
-
-            # measures with matching rhythm
-            index = self.find_section(measure_analyse_indexes, self.measure_rhythm_analyse_indexes_list, 1)
-            if index == -1:
-                self.measure_rhythm_analyse_indexes_list.append(measure_analyse_indexes)
-                index = len(self.measure_rhythm_analyse_indexes_list)-1
-                self.measure_rhythm_analyse_indexes_dictionary[index] = [current_measure]
-                self.measure_rhythm_analyse_indexes_all[current_measure] = [index, 0]
-            else:
-                self.measure_rhythm_analyse_indexes_dictionary[index].append(current_measure)
-                self.measure_rhythm_analyse_indexes_all[current_measure] = [index, len(self.measure_rhythm_analyse_indexes_dictionary[index])-1]
+            self.add_measure(measure_analyse_indexes, current_measure)
 
-            # measures with matching intervals
-            if (self.does_section_contain_intervals(measure_analyse_indexes)):
-                index = self.find_section(measure_analyse_indexes, self.measure_intervals_analyse_indexes_list, 2)
-                if index == -1:
-                    self.measure_intervals_analyse_indexes_list.append(measure_analyse_indexes)
-                    index = len(self.measure_intervals_analyse_indexes_list)-1
-                    self.measure_intervals_analyse_indexes_dictionary[index] = [current_measure]
-                    self.measure_intervals_analyse_indexes_all[current_measure] = [index, 0]
-                else:
-                    self.measure_intervals_analyse_indexes_dictionary[index].append(current_measure)
-                    self.measure_intervals_analyse_indexes_all[current_measure] = [index, len(self.measure_intervals_analyse_indexes_dictionary[index])-1]
+        self.count_events()
 
         print("\n Done set_part() - note count = " + str(self.note_count) + " chord count = " + str(self.chord_count) + " rest count = " + str(self.rest_count) + "...")
 
@@ -1368,34 +1088,17 @@ class AnalysePart:
         print(self.measure_analyse_indexes_all)
 
         self.repeated_measures_lists = self.calculate_repeated_measures_lists(self.measure_analyse_indexes_dictionary, False)
-        self.measure_groups_list = self.calculate_measure_groups(self.measure_analyse_indexes_all, self.measure_analyse_indexes_dictionary)
+        self.measure_groups_list = self.calculate_measure_groups(self.measure_analyse_indexes_all)
         self.repeated_measures_not_in_groups_dictionary = self.calculate_repeated_measures_not_in_groups(self.measure_analyse_indexes_dictionary.values(), self.measure_groups_list)
 
         self.repeated_measures_lists_rhythm = self.calculate_repeated_measures_lists(self.measure_rhythm_analyse_indexes_dictionary, True)
-        self.measure_rhythm_not_full_match_groups_list = self.calculate_measure_groups(self.measure_rhythm_analyse_indexes_all, self.measure_rhythm_analyse_indexes_dictionary)
+        self.measure_rhythm_not_full_match_groups_list = self.calculate_measure_groups(self.measure_rhythm_analyse_indexes_all)
         self.repeated_rhythm_measures_not_full_match_not_in_groups_dictionary = self.calculate_repeated_measures_not_in_groups(self.repeated_measures_lists_rhythm, self.measure_rhythm_not_full_match_groups_list)
 
         self.repeated_measures_lists_intervals = self.calculate_repeated_measures_lists(self.measure_intervals_analyse_indexes_dictionary, True)
-        self.repeated_intervals_measures_not_full_match_not_in_groups_dictionary = self.calculate_repeated_measures_not_in_groups(self.repeated_measures_lists_intervals, self.measure_intervals_not_full_match_groups_list)
+        self.measure_intervals_not_full_match_groups_list = self.calculate_measure_groups(self.measure_intervals_analyse_indexes_all)
         self.repeated_intervals_measures_not_full_match_not_in_groups_dictionary = self.calculate_repeated_measures_not_in_groups(self.repeated_measures_lists_intervals, self.measure_intervals_not_full_match_groups_list)
 
-        # make lists of index and totals then sort by totals for eg most common pitch / rhythm etc
-        self.count_pitches = self.count_dictionary(self.pitch_number_dictionary)
-        self.count_pitch_names = self.count_dictionary(self.pitch_name_dictionary)
-        self.count_intervals = self.count_dictionary(self.interval_dictionary)
-        self.count_chord_common_names = self.count_dictionary(self.chord_common_name_dictionary)
-
-        self.count_rhythm_note = self.count_dictionary(self.rhythm_note_dictionary)
-        self.count_rhythm_rest = self.count_dictionary(self.rhythm_rest_dictionary)
-        self.count_rhythm_chord = self.count_dictionary(self.rhythm_chord_dictionary)
-        self.rename_count_list_keys(self.count_rhythm_note, self._DURATION_MAP)
-        self.rename_count_list_keys(self.count_rhythm_rest, self._DURATION_MAP)
-        self.rename_count_list_keys(self.count_rhythm_chord, self._DURATION_MAP)
-
-        # dictionaries with list indexes as keys
-        self.count_chord_pitches = self.count_dictionary(self.chord_pitches_dictionary)
-        self.count_chord_intervals = self.count_dictionary(self.chord_intervals_dictionary)
-
     # count_list is like count_rhythm_note [[duration of individual note, count]] ordered by descending count.
     # duration is a decimal number of quarter notes ie 0.5 for an eight note -
     # swaps numeric duration for words
@@ -1405,11 +1108,153 @@ class AnalysePart:
             if item[0] in key_names:
                 item[0] = key_names.get(item[0])
 
-    # d = {key, [list]} eg pitch_name_dictionary
-    # returns eg [[C#, 5], [A,3]]
-    def count_dictionary(self, d):
-        sorted_list = []
-        for k, v in d.items():
-            sorted_list.append([k, len(v)])
-        sorted_list.sort(reverse=True, key=lambda item: item[1])
-        return sorted_list
+    # one pass over the events of the part - filling a row of the event table for each
+    def make_event_table(self, events):
+        table = PartEventTable()
+        previous_note_pitch = -1  # needed to work out intervals
+        current_measure = -1
+        for measure_number, event_type, d, midi, pitch_name, accidentals, chord_pitches, common_name in events:
+            # the start of a new measure
+            if (measure_number > current_measure):
+                # todo - if a measure doesn't have any notes or rests then it won't be added to measure_indexes etc and will cause errors later when looking for groups etc
+                self.measure_indexes[measure_number] = table.length
+                current_measure = measure_number
+                previous_note_pitch = -1  # reset interval comparison for each measure
+
+            if event_type == EVENT_REST:
+                table.add(EVENT_REST, current_measure, d)
+                previous_note_pitch = -1
+            elif event_type == EVENT_CHORD:
+                index = self.find_chord(chord_pitches)
+                if index == -1:
+                    self.chord_pitches_list.append(sorted(chord_pitches))
+                    index = len(self.chord_pitches_list)-1
+                    self.chord_pitches_lookup[tuple(self.chord_pitches_list[index])] = index
+                chord_pitches_index = index
+
+                chord_intervals = self.make_chord_intervals(chord_pitches)
+                index = self.find_chord_intervals(chord_intervals)
+                if index == -1:
+                    self.chord_intervals_list.append(chord_intervals)
+                    index = len(self.chord_intervals_list)-1
+                    self.chord_intervals_lookup[tuple(chord_intervals)] = index
+                chord_intervals_index = index
+
+                # music21 describes eg A, D, E as a quatral trichord - ie E, A, D are perfect fourths - but I prefer Suspended 4ths or 2nds...
+                if chord_intervals == [0, 5, 7]:
+                    common_name = "Suspended 4th"
+                elif chord_intervals == [0, 2, 7]:
+                    common_name = "Suspended 2nd"
+
+                table.add(EVENT_CHORD, current_measure, d, accidentals=accidentals, pitch_count=len(chord_pitches), chord_pitches=chord_pitches_index, chord_intervals=chord_intervals_index, chord_name=common_name)
+            elif event_type == EVENT_UNPITCHED:
+                table.add(EVENT_UNPITCHED, current_measure, d, pitch_count=1)
+                previous_note_pitch = -1
+            elif event_type == EVENT_NOTE:
+                interval = None
+                if (previous_note_pitch > -1):
+                    interval = midi-previous_note_pitch
+                table.add(EVENT_NOTE, current_measure, d, midi=midi, pitch_name=pitch_name, interval=interval, accidentals=accidentals, pitch_count=1)
+                previous_note_pitch = midi
+            else:
+                table.add(EVENT_OTHER, current_measure, d)
+
+        table.finish()
+        return table
+
+    # the totals, counts and per measure counts used to describe the part - all from the event table
+    def count_events(self):
+        table = self.event_table
+        is_note = table.event_type == EVENT_NOTE
+        is_chord = table.event_type == EVENT_CHORD
+        is_rest = table.event_type == EVENT_REST
+        is_single = is_note | (table.event_type == EVENT_UNPITCHED)  # unpitched notes are counted as notes
+        is_grace = (table.quarter_length == 0.0) & (is_single | is_chord)
+
+        self.note_count = int(is_single.sum())
+        self.chord_count = int(is_chord.sum())
+        self.rest_count = int(is_rest.sum())
+        self.total_note_duration = float(table.quarter_length[is_single].sum())
+        self.total_chord_duration = float(table.quarter_length[is_chord].sum())
+        self.total_rest_duration = float(table.quarter_length[is_rest].sum())
+
+        intervals = table.interval[table.has_interval].astype(np.int64)
+        self.interval_count = len(intervals)
+        self.interval_ascending_count = int((intervals > 0).sum())
+        self.interval_descending_count = int((intervals < 0).sum())
+        self.interval_unison_count = int((intervals == 0).sum())
+        intervals_abs = np.abs(intervals)
+        self.count_intervals_abs = np.bincount(intervals_abs[intervals_abs < 24], minlength=25).tolist()
+
+        self.accidental_count = int(table.accidentals.sum())
+        self.possible_accidental_count = int(table.pitch_count[is_note | is_chord].sum())
+        self.gracenote_count = int(table.pitch_count[is_grace].sum())
+
+        self.count_accidentals_in_measures = table.count_in_measures(table.accidentals)
+        self.count_gracenotes_in_measures = table.count_in_measures(np.where(is_grace, table.pitch_count, 0))
+        self.count_rests_in_measures = table.count_in_measures(is_rest.astype(np.int64))
+
+        # make lists of values and totals sorted by totals for eg most common pitch / rhythm etc
+        pitch_counts = np.bincount(table.midi[is_note].astype(np.int64), minlength=128)
+        self.count_pitches = [[pitch, int(pitch_counts[pitch])] for pitch in np.argsort(-pitch_counts, kind='stable').tolist()]
+        self.count_pitch_names = table.count_values(table.pitch_name, is_note, table.pitch_names)
+        self.count_intervals = table.count_values(table.interval, table.has_interval)
+        self.count_chord_common_names = table.count_values(table.chord_name, is_chord, table.chord_names)
+
+        not_grace = ~is_grace
+        self.count_rhythm_note = table.count_values(table.duration, is_single & not_grace, table.durations)
+        self.count_rhythm_rest = table.count_values(table.duration, is_rest, table.durations)
+        self.count_rhythm_chord = table.count_values(table.duration, is_chord & not_grace, table.durations)
+        self.rename_count_list_keys(self.count_rhythm_note, self._DURATION_MAP)
+        self.rename_count_list_keys(self.count_rhythm_rest, self._DURATION_MAP)
+        self.rename_count_list_keys(self.count_rhythm_chord, self._DURATION_MAP)
+
+        # list indexes as values
+        self.count_chord_pitches = table.count_values(table.chord_pitches, is_chord)
+        self.count_chord_intervals = table.count_values(table.chord_intervals, is_chord)
+
+        chord_sizes, chord_size_counts = np.unique(table.pitch_count[is_chord & (table.pitch_count < 11)], return_counts=True)  # unlikely to have more than 10 as not enough fingers - but best to check!
+        for chord_size, count in zip(chord_sizes.tolist(), chord_size_counts.tolist()):
+            self.count_notes_in_chords[chord_size] = count
+
+
+# the notes, chords and rests of a music21 Part as plain values - so they can be pickled cheaply and sent to another process.
+# {'measure_count': number of measures, 'events': [(measure number, event type, quarterLength, midi, pitch name, displayed accidentals, chord midi pitches, chord common name)]}
+def part_events(part):
+    events = []
+    for n in part.flat.notesAndRests:
+        d = n.duration.quarterLength  # numeric value
+        if n.isRest:
+            events.append((n.measureNumber, EVENT_REST, d, -1, None, 0, None, None))
+        elif n.isChord and type(n).__name__ != 'ChordSymbol':
+            # todo - maybe analyse ChordSymbol too - it won't cause an error - just thinks they are grace notes and affects counting notes / pitches / repetition etc
+            # count accidentals in the chord
+            accidentals = 0
+            for p in n.pitches:
+                if p.accidental is not None and p.accidental.displayStatus == True:
+                    accidentals += 1
+            events.append((n.measureNumber, EVENT_CHORD, d, -1, None, accidentals, tuple(p.midi for p in n.pitches), n.commonName))
+        elif n.isChord == False:
+            if isinstance(n, note.Unpitched):
+                events.append((n.measureNumber, EVENT_UNPITCHED, d, -1, None, 0, None, None))
+            else:
+                accidentals = 0
+                if n.pitch.accidental is not None and n.pitch.accidental.displayStatus == True:
+                    accidentals = 1
+                events.append((n.measureNumber, EVENT_NOTE, d, n.pitch.midi, n.pitch.name, accidentals, None, None))
+
+            if d == 0.0:
+                print("I'm a grace note note...")
+                print(n)
+        else:
+            events.append((n.measureNumber, EVENT_OTHER, d, -1, None, 0, None, None))
+    return {'measure_count': len(part.getElementsByClass('Measure')), 'events': events}
+
+
+# runs in a worker process - see MusicAnalyser.analyse_parts_in_processes
+def analyse_part_events(events):
+    analyse_part = AnalysePart()
+    analyse_part.set_events(events)
+    summary = analyse_part.describe_summary()
+    summary += analyse_part.describe_repetition_summary()
+    return summary, analyse_part.describe_repetition_in_context()
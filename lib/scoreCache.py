@@ -0,0 +1,102 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import music21
+from music21 import converter, freezeThaw
+from lib.fileUtils import write_file
+
+logger = logging.getLogger("TSScore")
+
+"""
+Parsing a big MusicXML file is the slowest part of handling a score - and one upload used to be parsed for validation, the options page, the talking score and again for every batch of midi files.
+So the parsed score is pickled once and stored next to the uploaded file (ie MEDIA_ROOT/<id>/) - named after the hash of the file contents, so copies of the same file share it.
+A small in memory LRU of the pickled bytes sits in front of the files on disk.
+
+The pickled bytes are kept rather than the Score itself because callers modify the score they are given (eg the midi code removes repeats and inserts rests) so each call gets its own copy.
+"""
+
+
+def hash_file(filepath, blocksize=65536):
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as fh:
+        buf = fh.read(blocksize)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = fh.read(blocksize)
+    return hasher.hexdigest()
+
+
+class ParsedScoreCache:
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self._frozen_scores = OrderedDict()  # {file hash, pickled score} least recently used first
+        self._lock = threading.Lock()
+
+    # the music21 version is part of the name - a pickle from a different version might not thaw properly
+    def get_cache_filepath(self, file_hash, cache_dir):
+        return os.path.join(cache_dir, f"{file_hash}.m21-{music21.VERSION_STR}.p")
+
+    # returns a music21 Score for the musicxml file - only parsing it if it isn't already cached
+    # cache_dir defaults to the directory of the musicxml file
+    def load(self, musicxml_filepath, cache_dir=None):
+        file_hash = hash_file(musicxml_filepath)
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.realpath(musicxml_filepath))
+        cache_filepath = self.get_cache_filepath(file_hash, cache_dir)
+
+        frozen = self._get_from_memory(file_hash)
+        if frozen is not None:
+            return converter.thawStr(frozen)
+
+        frozen = self._read_from_disk(cache_filepath)
+        if frozen is not None:
+            try:
+                score = converter.thawStr(frozen)
+                self._put_in_memory(file_hash, frozen)
+                return score
+            except Exception:
+                # eg a damaged file, or pickled with a different version of a module music21 uses - so it is replaced below
+                logger.exception("Unable to read parsed score cache %s - parsing the score again" % cache_filepath)
+
+        logger.info("Parsing %s" % musicxml_filepath)
+        # forceSource - so music21 doesn't keep its own pickle in its scratch directory as well
+        score = converter.parse(musicxml_filepath, forceSource=True)
+        # fastButUnsafe avoids a deep copy but leaves score unusable - so everyone gets a thawed copy below
+        frozen = freezeThaw.StreamFreezer(score, fastButUnsafe=True).writeStr()
+        self._write_to_disk(cache_filepath, frozen)
+        self._put_in_memory(file_hash, frozen)
+        return converter.thawStr(frozen)
+
+    def _get_from_memory(self, file_hash):
+        with self._lock:
+            frozen = self._frozen_scores.get(file_hash)
+            if frozen is not None:
+                self._frozen_scores.move_to_end(file_hash)
+            return frozen
+
+    def _put_in_memory(self, file_hash, frozen):
+        with self._lock:
+            self._frozen_scores[file_hash] = frozen
+            self._frozen_scores.move_to_end(file_hash)
+            while len(self._frozen_scores) > self.max_entries:
+                self._frozen_scores.popitem(last=False)
+
+    def _read_from_disk(self, cache_filepath):
+        try:
+            with open(cache_filepath, 'rb') as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_to_disk(self, cache_filepath, frozen):
+        try:
+            os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+            write_file(cache_filepath, frozen)
+        except OSError:
+            # the cache is just an optimisation - so carry on without it
+            logger.exception("Unable to write parsed score cache %s" % cache_filepath)
+
+
+parsed_score_cache = ParsedScoreCache()
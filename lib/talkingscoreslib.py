@@ -10,56 +10,230 @@ __author__ = 'BTimms'
 import os
 import json
 import math
+import bisect
+import functools
+import itertools
+import collections
+import dataclasses
 import pprint
 import logging
 import logging.handlers
 import logging.config
+from concurrent.futures import ProcessPoolExecutor
 from music21 import *
 from lib.musicAnalyser import *
+from lib.scoreCache import parsed_score_cache
+from lib.tempoMap import TempoMap
+from lib import templateEnvironment
 us = environment.UserSettings()
 us['warnings'] = 0
 logger = logging.getLogger("TSScore")
 
-global settings
-
 
+# The options for describing a score - from the options page (see the .opts file next to the score).
+# It is immutable and each Music21TalkingScore / TSEvent has its own - so several scores can be rendered at the same time in one process.
+# Use dataclasses.replace() to change an option
+@dataclasses.dataclass(frozen=True)
+class RenderOptions:
+    pitch_before_duration: bool = False
+    describe_by: str = 'beat'
+    hands_together: bool = True
+    bars_at_a_time: int = 4
+    play_all: bool = True
+    play_selected: bool = True
+    play_unselected: bool = True
+    instruments: tuple = ()  # 1 based keys of Music21TalkingScore.part_instruments
+    pitch_description: str = 'noteName'
+    rhythm_description: str = 'british'
+    dot_position: str = 'before'
+    rhythm_announcement: str = 'onChange'
+    octave_description: str = 'name'
+    octave_position: str = 'before'
+    octave_announcement: str = 'onChange'
+    colour_position: str = 'None'
+    colour_pitch: bool = False
+    colour_rhythm: bool = False
+    colour_octave: bool = False
+
+    # options = the dictionary saved in the .opts file
+    @classmethod
+    def from_options(cls, options):
+        return cls(
+            bars_at_a_time=int(options["bars_at_a_time"]),
+            play_all=options["play_all"],
+            play_selected=options["play_selected"],
+            play_unselected=options["play_unselected"],
+            instruments=tuple(options["instruments"]),
+            pitch_description=options["pitch_description"],
+            rhythm_description=options["rhythm_description"],
+            dot_position=options["dot_position"],
+            rhythm_announcement=options["rhythm_announcement"],
+            octave_description=options["octave_description"],
+            octave_position=options["octave_position"],
+            octave_announcement=options["octave_announcement"],
+            colour_position=options["colour_position"],
+            colour_pitch=options["colour_pitch"],
+            colour_rhythm=options["colour_rhythm"],
+            colour_octave=options["colour_octave"],
+        )
+
+    # values = dataclasses.asdict() of a RenderOptions - eg after being saved as JSON
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**dict(values, instruments=tuple(values["instruments"])))
+
+
+# The words (and colour spans) for rendering events with one RenderOptions.  They used to be worked out from the options for every event as it was rendered -
+# now each pitch / octave / duration is worked out once and each event keeps the final fragments.  Use get_render_profile() - there is one profile for each RenderOptions
+class RenderProfile:
+    _FIGURE_NOTE_COLOURS = {"C": "red", "D": "brown", "E": "grey", "F": "blue", "G": "black", "A": "yellow", "B": "green"}
+    _FIGURE_NOTE_CONTRAST_TEXT_COLOURS = {"C": "white", "D": "white", "E": "white", "F": "white", "G": "white", "A": "black", "B": "white"}
+
+    # the tables are filled in for these up front - anything else is worked out the first time it is used
+    _STEPS = "CDEFGAB"
+    _ACCIDENTALS = (None, 'sharp', 'flat', 'natural', 'double-sharp', 'double-flat')
+    _OCTAVES = range(0, 10)
+    _DOTS = range(0, 4)
+
+    def __init__(self, options):
+        self.options = options
+        self._coloured = set()  # the element types ("pitch", "rhythm", "octave") that are coloured
+        if options.colour_position in ("background", "text"):
+            for element_type, colour in (("pitch", options.colour_pitch), ("rhythm", options.colour_rhythm), ("octave", options.colour_octave)):
+                if colour == True:
+                    self._coloured.add(element_type)
+
+        self._pitches = {}  # (step, displayed accidental) -> (pitch name, rendered pitch)
+        self._octaves = {}  # (octave, step) -> (octave name, rendered octave)
+        self._durations = {}  # (duration type, dots) -> duration
+        self._rhythms = {}  # (duration type, dots, step) -> rendered duration of a note
+        for step in self._STEPS:
+            for accidental in self._ACCIDENTALS:
+                self.pitch(step, accidental)
+            for octave in self._OCTAVES:
+                self.octave(octave, step)
+        for duration_type in Music21TalkingScore._DURATION_MAP:
+            for dots in self._DOTS:
+                for step in self._STEPS:
+                    self.rhythm(duration_type, dots, step)
+
+    # text in the colour of the figure note for the step - if the options colour that type of element
+    def colour(self, text, step, element_type):
+        if element_type not in self._coloured:
+            return text
+        if self.options.colour_position == "background":
+            return "<span style='color:" + self._FIGURE_NOTE_CONTRAST_TEXT_COLOURS[step] + "; background-color:" + self._FIGURE_NOTE_COLOURS[step] + ";'>" + text + "</span>"
+        return "<span style='color:" + self._FIGURE_NOTE_COLOURS[step] + ";'>" + text + "</span>"
+
+    # accidental - its full name (eg "sharp") if it is displayed, otherwise None
+    def pitch(self, step, accidental):
+        entry = self._pitches.get((step, accidental))
+        if entry is None:
+            if self.options.pitch_description == "colourNotes":
+                pitch_name = Music21TalkingScore._PITCH_FIGURENOTES_MAP.get(step, "?")
+            elif self.options.pitch_description == "none":
+                pitch_name = ""
+            elif self.options.pitch_description == "phonetic":
+                pitch_name = Music21TalkingScore._PITCH_PHONETIC_MAP.get(step, "?")
+            else:  # noteName
+                pitch_name = step
+            if accidental is not None and pitch_name != "":
+                pitch_name = f"{pitch_name} {accidental}"
+            entry = (pitch_name, self.colour(pitch_name, step, "pitch"))
+            self._pitches[(step, accidental)] = entry
+        return entry
+
+    def octave(self, octave, step):
+        entry = self._octaves.get((octave, step))
+        if entry is None:
+            if self.options.octave_description == "figureNotes":
+                octave_name = Music21TalkingScore._OCTAVE_FIGURENOTES_MAP.get(octave, "?")
+            elif self.options.octave_description == "name":
+                octave_name = Music21TalkingScore._OCTAVE_MAP.get(octave, "?")
+            elif self.options.octave_description == "none":
+                octave_name = ""
+            else:  # number
+                octave_name = str(octave)
+            entry = (octave_name, self.colour(octave_name, step, "octave"))
+            self._octaves[(octave, step)] = entry
+        return entry
+
+    # eg "dotted crotchet" - or "crotchet dotted " with dot_position "after"
+    def duration(self, duration_type, dots):
+        duration = self._durations.get((duration_type, dots))
+        if duration is None:
+            if self.options.rhythm_description == "none":
+                duration_name = ""
+                dots_name = ""
+            else:
+                if self.options.rhythm_description == "american":
+                    duration_name = duration_type
+                else:  # british
+                    duration_name = Music21TalkingScore._DURATION_MAP.get(duration_type, f'Unknown duration {duration_type}')
+                dots_name = Music21TalkingScore._DOTS_MAP.get(dots)
+            duration = duration_name
+            if self.options.dot_position == "before":
+                duration = dots_name + duration
+            elif self.options.dot_position == "after":
+                duration += " " + dots_name
+            self._durations[(duration_type, dots)] = duration
+        return duration
+
+    # the duration of a note - in the colour of its pitch
+    def rhythm(self, duration_type, dots, step):
+        rendered = self._rhythms.get((duration_type, dots, step))
+        if rendered is None:
+            rendered = self.colour(self.duration(duration_type, dots), step, "rhythm")
+            self._rhythms[(duration_type, dots, step)] = rendered
+        return rendered
+
+    def make_pitch(self, pitch):
+        step = pitch.name[0]
+        accidental = pitch.accidental.fullName if pitch.accidental and pitch.accidental.displayStatus else None
+        pitch_name, rendered_pitch = self.pitch(step, accidental)
+        octave_name, rendered_octave = self.octave(pitch.octave, step)
+        return TSPitch(pitch_name, octave_name, pitch.ps, step, self.options, rendered_pitch, rendered_octave)
+
+
+# RenderOptions is immutable so it can be the key.  A few profiles are kept - eg for the scores being rendered at the same time
+@functools.lru_cache(maxsize=16)
+def get_render_profile(options):
+    return RenderProfile(options)
+
+
+_DEFAULT_RENDER_OPTIONS = RenderOptions()
+
+
+# A segment of a long score has lots of events - so they use __slots__ rather than each having a __dict__, and only hold strings / numbers (not the music21 objects they were made from)
 class TSEvent(object, metaclass=ABCMeta):
-    duration = None
-    tuplets = ""
-    endTuplets = ""
-    beat = None
-    bar = None
-    part = None
-    tie = None
-
-    def render_colourful_output(self, text, pitchLetter, elementType):
-        figureNoteColours = {"C": "red", "D": "brown", "E": "grey", "F": "blue", "G": "black", "A": "yellow", "B": "green"}
-        figureNoteContrastTextColours = {"C": "white", "D": "white", "E": "white", "F": "white", "G": "white", "A": "black", "B": "white"}
-        toRender = text
-
-        if settings["colourPosition"] != "None":
-            doColours = False
-            if (elementType == "pitch" and settings["colourPitch"] == True):
-                doColours = True
-            if (elementType == "rhythm" and settings["colourRhythm"] == True):
-                doColours = True
-            if (elementType == "octave" and settings["colourOctave"] == True):
-                doColours = True
-
-            if doColours == True:
-                if settings["colourPosition"] == "background":
-                    toRender = "<span style='color:" + figureNoteContrastTextColours[pitchLetter] + "; background-color:" + figureNoteColours[pitchLetter] + ";'>" + text + "</span>"
-                elif settings["colourPosition"] == "text":
-                    toRender = "<span style='color:" + figureNoteColours[pitchLetter] + ";'>" + text + "</span>"
-
-        return toRender
-
-    def render(self, context=None, noteLetter=None):
+    __slots__ = ('duration', 'tuplets', 'endTuplets', 'tie', 'options', 'rendered_duration')
+
+    def __init__(self):
+        self.duration = None
+        self.tuplets = ""
+        self.endTuplets = ""
+        self.tie = None
+        self.options = _DEFAULT_RENDER_OPTIONS  # set by Music21TalkingScore when it makes the event
+        self.rendered_duration = None  # the duration in the colour of the note's pitch - see RenderProfile.rhythm()
+
+    # the slots of the class and its bases - so an event is pickled (eg by the segment worker processes) as a tuple of their values rather than a dict of name / value
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._state_slots = tuple(slot for klass in reversed(cls.__mro__) for slot in klass.__dict__.get('__slots__', ()))
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self._state_slots)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self._state_slots, state):
+            setattr(self, slot, value)
+
+    def render(self, context=None):
         rendered_elements = []
-        if (context is None or context.duration != self.duration or self.tuplets != "" or settings['rhythmAnnouncement'] == "everyNote"):
+        if (context is None or context.duration != self.duration or self.tuplets != "" or self.options.rhythm_announcement == "everyNote"):
             rendered_elements.append(self.tuplets)
-            if (noteLetter != None):
-                rendered_elements.append(self.render_colourful_output(self.duration, noteLetter, "rhythm"))
+            if self.rendered_duration is not None:
+                rendered_elements.append(self.rendered_duration)
             else:
                 rendered_elements.append(self.duration)
         rendered_elements.append(self.endTuplets)
@@ -70,10 +244,10 @@ class TSEvent(object, metaclass=ABCMeta):
 
 
 class TSDynamic(TSEvent):
-    short_name = None
-    long_name = None
+    __slots__ = ('short_name', 'long_name')
 
     def __init__(self, long_name=None, short_name=None):
+        super(TSDynamic, self).__init__()
         if (long_name != None):
             self.long_name = long_name.capitalize()
         else:
@@ -86,30 +260,34 @@ class TSDynamic(TSEvent):
 
 
 class TSPitch(TSEvent):
-    pitch_name = None
-    octave = None
-    pitch_letter = None  # used for looking up colour based on pitch and fixes sharp / flat problem when modulus and the pitch number
-
-    def __init__(self, pitch_name, octave, pitch_number, pitch_letter):
+    # pitch_letter - used for looking up colour based on pitch and fixes sharp / flat problem when modulus and the pitch number
+    __slots__ = ('pitch_name', 'octave', 'pitch_number', 'pitch_letter', 'rendered_pitch', 'rendered_octave')
+
+    # rendered_pitch / rendered_octave - pitch_name / octave as they are rendered ie with any colour.  See RenderProfile.make_pitch()
+    def __init__(self, pitch_name, octave, pitch_number, pitch_letter, options=None, rendered_pitch=None, rendered_octave=None):
+        super(TSPitch, self).__init__()
+        if options is not None:
+            self.options = options
         self.pitch_name = pitch_name
         self.octave = octave
         self.pitch_number = pitch_number
         self.pitch_letter = pitch_letter
+        self.rendered_pitch = pitch_name if rendered_pitch is None else rendered_pitch
+        self.rendered_octave = octave if rendered_octave is None else rendered_octave
 
     def render(self, context=None):
-        global settings
         rendered_elements = []
-        if settings['octavePosition'] == "before":
+        if self.options.octave_position == "before":
             rendered_elements.append(self.render_octave(context))
-        rendered_elements.append(self.render_colourful_output(self.pitch_name, self.pitch_letter, "pitch"))
-        if settings['octavePosition'] == "after":
+        rendered_elements.append(self.rendered_pitch)
+        if self.options.octave_position == "after":
             rendered_elements.append(self.render_octave(context))
 
         return rendered_elements
 
     def render_octave(self, context=None):
         show_octave = False
-        if settings['octaveAnnouncement'] == "brailleRules":
+        if self.options.octave_announcement == "brailleRules":
             if context == None:
                 show_octave = True
             else:
@@ -124,22 +302,22 @@ class TSPitch(TSEvent):
                 # if it is more than a 5th, say octave
                 else:
                     show_octave = True
-        elif settings['octaveAnnouncement'] == "everyNote":
+        elif self.options.octave_announcement == "everyNote":
             show_octave = True
-        elif settings['octaveAnnouncement'] == "firstNote" and context == None:
+        elif self.options.octave_announcement == "firstNote" and context == None:
             show_octave = True
-        elif settings['octaveAnnouncement'] == "onChange":
+        elif self.options.octave_announcement == "onChange":
             if context == None or (context != None and context.octave != self.octave):
                 show_octave = True
 
         if show_octave:
-            return self.render_colourful_output(self.octave, self.pitch_letter, "octave")
+            return self.rendered_octave
         else:
             return ""
 
 
 class TSUnpitched(TSEvent):
-    pitch = None
+    __slots__ = ()
 
     def render(self, context=None):
         rendered_elements = []
@@ -151,7 +329,7 @@ class TSUnpitched(TSEvent):
 
 
 class TSRest(TSEvent):
-    pitch = None
+    __slots__ = ()
 
     def render(self, context=None):
         rendered_elements = []
@@ -163,23 +341,31 @@ class TSRest(TSEvent):
 
 
 class TSNote(TSEvent):
-    pitch = None
-    expressions = []
+    __slots__ = ('pitch', 'expressions')
+
+    def __init__(self):
+        super(TSNote, self).__init__()
+        self.pitch = None
+        self.expressions = ()  # the names of the music21 expressions eg "trill"
 
     def render(self, context=None):
         rendered_elements = []
         # Render the expressions
-        for exp in self.expressions:
-            rendered_elements.append(exp.name + ', ')
+        for expression_name in self.expressions:
+            rendered_elements.append(expression_name + ', ')
         # Render the duration
-        rendered_elements.append(' '.join(super(TSNote, self).render(context, self.pitch.pitch_letter)))
+        rendered_elements.append(' '.join(super(TSNote, self).render(context)))
         # Render the pitch
         rendered_elements.append(' '.join(self.pitch.render(getattr(context, 'pitch', None))))
         return rendered_elements
 
 
 class TSChord(TSEvent):
-    pitches = []
+    __slots__ = ('pitches',)
+
+    def __init__(self):
+        super(TSChord, self).__init__()
+        self.pitches = []
 
     def name(self):
         return ''
@@ -194,6 +380,59 @@ class TSChord(TSEvent):
         return [', '.join(rendered_elements)]
 
 
+# The events of a part for a segment - one dict of (bar, beat, voice, description order) -> [events] in the order they were added, rather than nested dicts for every bar, beat and voice.
+# items() groups them the way talkingscore_segment.html loops over them - (bar, {beat: {voice: {description order: [events]}}}) with each in the order it was first added
+class PartEvents(object):
+    __slots__ = ('_events',)
+
+    def __init__(self):
+        self._events = {}
+
+    def add(self, bar, beat, voice, description_order, event):
+        self._events.setdefault((bar, beat, voice, description_order), []).append(event)
+
+    def items(self):
+        bars = {}
+        for (bar, beat, voice, description_order), events in self._events.items():
+            bars.setdefault(bar, {}).setdefault(beat, {}).setdefault(voice, {})[description_order] = events
+        return bars.items()
+
+
+# an entry in Music21TalkingScore.measure_indexes - the time and key signatures are the ones in force during the measure
+class TSMeasure(object):
+    def __init__(self, measure, offset, time_signature, key_signature):
+        self.measure = measure
+        self.offset = offset
+        self.time_signature = time_signature
+        self.key_signature = key_signature
+
+
+# the hairpin spanners of one part - sorted by the measure they start in and the measure they end in
+# so a segment can find the ones that start or end in it with a binary search rather than looking through every spanner in the part
+class TSSpannerIndex(object):
+    def __init__(self, spanners):
+        entries = []  # (first measure, last measure, position in the part's spanner bundle, spanner)
+        for position, spanner in enumerate(spanners):
+            first = spanner.getFirst()
+            last = spanner.getLast()
+            if first is None or last is None or first.measureNumber is None or last.measureNumber is None:
+                continue
+            entries.append((first.measureNumber, last.measureNumber, position, spanner))
+
+        self.by_start = sorted(entries, key=lambda e: (e[0], e[2]))
+        self.starts = [e[0] for e in self.by_start]
+        self.by_end = sorted(entries, key=lambda e: (e[1], e[2]))
+        self.ends = [e[1] for e in self.by_end]
+
+    # spanners that start or end in bars start_bar to end_bar - in the order they are in the part
+    def get_spanners_for_bar_range(self, start_bar, end_bar):
+        found = {}
+        for keys, entries in ((self.starts, self.by_start), (self.ends, self.by_end)):
+            for i in range(bisect.bisect_left(keys, start_bar), bisect.bisect_right(keys, end_bar)):
+                found[entries[i][2]] = entries[i][3]
+        return [found[position] for position in sorted(found)]
+
+
 class TalkingScoreBase(object, metaclass=ABCMeta):
     @abstractmethod
     def get_title(self):
@@ -264,14 +503,57 @@ class Music21TalkingScore(TalkingScoreBase):
         'B': 'bravo',
     }
 
-    last_tempo_inserted_index = 0  # insert_tempos() doesn't need to recheck MetronomeMarkBoundaries that have already been used
     music_analyser = None
+    tempo_map = None
 
-    def __init__(self, musicxml_filepath):
+    # cache_dir - where to keep the parsed score, defaults to the directory of the musicxml file
+    # options - RenderOptions, defaults to RenderOptions() eg for just getting the info about a score
+    def __init__(self, musicxml_filepath, cache_dir=None, options=None):
         self.filepath = os.path.realpath(musicxml_filepath)
-        self.score = converter.parse(musicxml_filepath)
+        self.cache_dir = cache_dir
+        self.options = options if options is not None else RenderOptions()
+        self.score = parsed_score_cache.load(musicxml_filepath, cache_dir)
+        self.build_measure_indexes()
+        self.build_spanner_indexes()
         super(Music21TalkingScore, self).__init__()
 
+    # Part.measure(n) searches through the whole part each time - so index the measures of each part once.
+    # measure_indexes[part index] = {measure number, TSMeasure}.  The number is the first measure with that number (like Part.measure() returns) and suffixed numbers eg "12X1" are included as strings
+    def build_measure_indexes(self):
+        self.measure_indexes = []
+        for part in self.score.parts:
+            measure_index = {}
+            measures = list(part.getElementsByClass(stream.Measure))
+            # like music21 - if every measure is numbered 0 then use the position instead
+            numbered = any(m.number != 0 for m in measures)
+            time_signature = None
+            key_signature = None
+            for position, m in enumerate(measures):
+                if len(m.getElementsByClass(meter.TimeSignature)) > 0:
+                    time_signature = m.getElementsByClass(meter.TimeSignature)[0]
+                elif time_signature is None:
+                    time_signature = m.getTimeSignatures()[0]
+                if len(m.getElementsByClass(key.KeySignature)) > 0:
+                    key_signature = m.getElementsByClass(key.KeySignature)[0]
+
+                entry = TSMeasure(m, m.getOffsetBySite(part), time_signature, key_signature)
+                number = m.number if numbered else position + 1
+                measure_index.setdefault(number, entry)
+                if m.numberSuffix:
+                    measure_index.setdefault(str(number) + m.numberSuffix, entry)
+            self.measure_indexes.append(measure_index)
+
+    # returns the TSMeasure or None if the part doesn't have a measure with that number
+    def get_measure(self, part_index, number):
+        return self.measure_indexes[part_index].get(number)
+
+    # only crescendos and diminuendos are described at the moment - so they are the only spanners indexed
+    def build_spanner_indexes(self):
+        self.spanner_indexes = []
+        for part in self.score.parts:
+            hairpins = [sp for sp in part.spanners.elements if type(sp).__name__ in ('Crescendo', 'Diminuendo')]
+            self.spanner_indexes.append(TSSpannerIndex(hairpins))
+
     def get_title(self):
         if self.score.metadata.title is not None:
             return self.score.metadata.title
@@ -331,16 +613,13 @@ class Music21TalkingScore(TalkingScoreBase):
             return te.content
 
     def get_initial_tempo(self):
-        global settings
-        try:
-            settings
-        except NameError:
-            settings = None
-        if settings == None:
-            settings = {}
-            settings['dotPosition'] = "before"
-            settings['rhythmDescription'] = "british"
-        return self.describe_tempo(self.score.metronomeMarkBoundaries()[0][2])
+        return self.describe_tempo(self.get_tempo_map().tempos[0][2])
+
+    # the tempos of the score - only worked out once
+    def get_tempo_map(self):
+        if self.tempo_map is None:
+            self.tempo_map = TempoMap.from_score(self.score)
+        return self.tempo_map
 
     # some tempos have soundingNumber set but not number
     # we would get an error trying to scale a tempo.number of None
@@ -366,12 +645,11 @@ class Music21TalkingScore(TalkingScoreBase):
 
     # the referent is the beat duration ie are you counting crotchets or minims etc
     def describe_tempo_referent(self, tempo):
-        global settings
         tempo_text = ""
-        if settings['dotPosition'] == "before":
+        if self.options.dot_position == "before":
             tempo_text = self._DOTS_MAP.get(tempo.referent.dots)
         tempo_text += self.map_duration(tempo.referent)
-        if settings['dotPosition'] == "after":
+        if self.options.dot_position == "after":
             tempo_text += " " + self._DOTS_MAP.get(tempo.referent.dots)
 
         return tempo_text
@@ -417,14 +695,13 @@ class Music21TalkingScore(TalkingScoreBase):
         return instrument_names
 
     def compare_parts_with_selected_instruments(self):
-        global settings
         self.selected_instruments = []  # 1 based list of keys from part_instruments eg [1, 4]
         self.unselected_instruments = []  # eg [2,3]
         self.binary_selected_instruments = 1  # bitwise representation of all instruments - 0=not included, 1=included
         self.selected_part_names = []  # eg ["recorder", "piano - left hand", "piano - right hand"]
         for ins in self.part_instruments.keys():
             self.binary_selected_instruments = self.binary_selected_instruments << 1
-            if ins in settings['instruments']:
+            if ins in self.options.instruments:
                 self.selected_instruments.append(ins)
                 self.binary_selected_instruments += 1
             else:
@@ -441,25 +718,29 @@ class Music21TalkingScore(TalkingScoreBase):
 
         print("selected_part_names = " + str(self.selected_part_names))
 
+        play_all = self.options.play_all
+        play_selected = self.options.play_selected
+        play_unselected = self.options.play_unselected
         if len(self.unselected_instruments) == 0:  # All instruments selected - so no unselected instruments to play
-            settings['playUnselected'] = False
-        if len(self.selected_instruments) == len(self.part_instruments) and settings['playAll'] == True:  # played by Play All
-            settings['playSelected'] = False
+            play_unselected = False
+        if len(self.selected_instruments) == len(self.part_instruments) and play_all == True:  # played by Play All
+            play_selected = False
         if len(self.selected_instruments) == 1:  # played by individual part
-            settings['playSelected'] = False
+            play_selected = False
         if len(self.part_instruments) == 1:
-            settings['playAll'] = False
+            play_all = False
+        self.options = dataclasses.replace(self.options, play_all=play_all, play_selected=play_selected, play_unselected=play_unselected)
 
         # todo - these maybe shouldn't really be part of score...
         self.binary_play_all = 1  # placeholder,all,selected,unslected
         self.binary_play_all = self.binary_play_all << 1
-        if settings['playAll'] == True:
+        if self.options.play_all == True:
             self.binary_play_all += 1
         self.binary_play_all = self.binary_play_all << 1
-        if settings['playSelected'] == True:
+        if self.options.play_selected == True:
             self.binary_play_all += 1
         self.binary_play_all = self.binary_play_all << 1
-        if settings['playUnselected'] == True:
+        if self.options.play_unselected == True:
             self.binary_play_all += 1
 
         print("selected_instruments = " + str(self.selected_instruments))
@@ -476,35 +757,27 @@ class Music21TalkingScore(TalkingScoreBase):
 
         return bars_for_parts
 
+    # returns PartEvents
     def get_events_for_bar_range(self, start_bar, end_bar, part_index):
-        events_by_bar = {}
-
-        # using collect=('TimeSignature') is slow.  It is almost twice as fast to use a dictionary of time signatures and insert at the start of each segment.
-        measures = self.score.parts[part_index].measures(start_bar, end_bar)
-        if measures.measure(start_bar) != None and len(measures.measure(start_bar).getElementsByClass(meter.TimeSignature)) == 0:
-            measures.measure(start_bar).insert(0, self.timeSigs[start_bar])
+        events_by_bar = PartEvents()
 
+        # the measures are the score's own rather than a copy from .measures() - so the time signature of a bar is found from the measures before it in the part and nothing needs inserting
         logger.info(f'Processing part - {part_index} - bars {start_bar} to {end_bar}')
         # Iterate over the bars one at a time
-        # pickup bar has to request measures 0 to 1 above otherwise it returns an measures just has empty parts - so now restrict it just to bar 0...
+        # the pickup bar is requested as measures 0 to 1 - so restrict it just to bar 0...
         if start_bar == 0 and end_bar == 1:
             end_bar = 0
         for bar_index in range(start_bar, end_bar + 1):
-            measure = measures.measure(bar_index)
+            measure = self.get_measure(part_index, bar_index)
             if measure is not None:
-                self.update_events_for_measure(measure, events_by_bar)
+                self.update_events_for_measure(measure.measure, events_by_bar)
 
         # Iterate over the spanners
         # todo - mention slurs?  Make it an option?
         # todo - this looks at spanners per part so eg crescendos are described for the right hand but not the left of a piano...
-        # todo - it is a bit inefficient.  It looks spanners from the start of the part for each segment...
-        for spanner in self.score.parts[part_index].spanners.elements:
+        for spanner in self.spanner_indexes[part_index].get_spanners_for_bar_range(start_bar, end_bar):
             first = spanner.getFirst()
             last = spanner.getLast()
-            if first.measureNumber is None or last.measureNumber is None:
-                continue
-            elif first.measureNumber > end_bar:  # all remaining spanners are after this segment so break the for loop
-                break
 
             spanner_type = type(spanner).__name__
             if spanner_type == 'Crescendo' or spanner_type == 'Diminuendo':
@@ -513,38 +786,30 @@ class Music21TalkingScore(TalkingScoreBase):
 
                 if first.measureNumber >= start_bar and first.measureNumber <= end_bar:
                     event = TSDynamic(long_name=f'{spanner_type} start')
-                    events_by_bar\
-                        .setdefault(first.measureNumber, {})\
-                        .setdefault(first.beat, {})\
-                        .setdefault(voice, {})\
-                        .setdefault(description_order, [])\
-                        .append(event)
+                    events_by_bar.add(first.measureNumber, first.beat, voice, description_order, event)
 
                 if last.measureNumber >= start_bar and last.measureNumber <= end_bar:
                     event = TSDynamic(long_name=f'{spanner_type} end')
                     # todo -  Note - THIS WILL NOT HANDLE CRESCENDOS/DIMINUENDOS THAT SPAN MEASURES
-                    events_by_bar\
-                        .setdefault(last.measureNumber, {})\
-                        .setdefault(last.beat + last.duration.quarterLength - 1, {})\
-                        .setdefault(voice, {})\
-                        .setdefault(description_order, [])\
-                        .append(event)
+                    events_by_bar.add(last.measureNumber, last.beat + last.duration.quarterLength - 1, voice, description_order, event)
 
         return events_by_bar
 
     def update_events_for_measure(self, measure, events, voice: int = 1):
+        profile = get_render_profile(self.options)
         previous_beat = 1
-        for element in measure.elements:
+        # iterate the stream rather than measure.elements - iterating sets each element's activeSite to this measure/voice.  Otherwise an element can still have the activeSite from an earlier .flat and element.beat is worked out from the wrong offset
+        for element in measure:
             element_type = type(element).__name__
             event = None
             if element_type == 'Note':
                 event = TSNote()
-                event.pitch = TSPitch(self.map_pitch(element.pitch), self.map_octave(element.pitch.octave), element.pitch.ps, element.pitch.name[0])
+                event.pitch = profile.make_pitch(element.pitch)
                 description_order = 1
                 if element.tie:
                     event.tie = element.tie.type
 
-                event.expressions = element.expressions
+                event.expressions = tuple(expression.name for expression in element.expressions)
             elif element_type == 'Unpitched':
                 event = TSUnpitched()
                 description_order = 1
@@ -554,7 +819,7 @@ class Music21TalkingScore(TalkingScoreBase):
 
             elif element_type == 'Chord':
                 event = TSChord()
-                event.pitches = [TSPitch(self.map_pitch(element_pitch), self.map_octave(element_pitch.octave), element_pitch.ps, element_pitch.name[0]) for element_pitch in element.pitches]
+                event.pitches = [profile.make_pitch(element_pitch) for element_pitch in element.pitches]
                 description_order = 1
                 if element.tie:
                     event.tie = element.tie.type
@@ -571,7 +836,7 @@ class Music21TalkingScore(TalkingScoreBase):
 
             # This test isn't WORKING
             # if TSEvent.__class__ in event.__class__.__bases__:
-            event.duration = ""
+            event.options = self.options
             if (len(element.duration.tuplets) > 0):
                 if (element.duration.tuplets[0].type == "start"):
                     if (element.duration.tuplets[0].fullName == "Triplet"):
@@ -581,11 +846,9 @@ class Music21TalkingScore(TalkingScoreBase):
                 elif (element.duration.tuplets[0].type == "stop" and element.duration.tuplets[0].fullName != "Triplet"):
                     event.endTuplets = "end tuplet "
 
-            if settings['dotPosition'] == "before":
-                event.duration += self.map_dots(element.duration.dots)
-            event.duration += self.map_duration(element.duration)
-            if settings['dotPosition'] == "after":
-                event.duration += " " + self.map_dots(element.duration.dots)
+            event.duration = profile.duration(element.duration.type, element.duration.dots)
+            if element_type == 'Note':
+                event.rendered_duration = profile.rhythm(element.duration.type, element.duration.dots, element.pitch.name[0])
 
             if (math.floor(element.beat) == math.floor(previous_beat)):  # eg was 1 now 1.5 ie same beat
                 beat = previous_beat
@@ -595,12 +858,7 @@ class Music21TalkingScore(TalkingScoreBase):
                 beat = element.beat
             previous_beat = beat
 
-            events\
-                .setdefault(measure.measureNumber, {})\
-                .setdefault(beat, {})\
-                .setdefault(voice, {})\
-                .setdefault(description_order, [])\
-                .append(event)
+            events.add(measure.measureNumber, beat, voice, description_order, event)
 
     def group_chord_pitches_by_octave(self, chord):
         chord_pitches_by_octave = {}
@@ -755,108 +1013,57 @@ class Music21TalkingScore(TalkingScoreBase):
     # TODO need to make more efficient when working with multiple parts ie more than just the left hand piano part
     # music21 might have a better way of doing this.  If part 0 is included then tempos are already present.
     def insert_tempos(self, stream, offset_start):
-        if (self.last_tempo_inserted_index > 0):  # one tempo change might need to be in many segments - especially the last tempo change in the score
-            self.last_tempo_inserted_index -= 1
-        for mmb in self.score.metronomeMarkBoundaries()[self.last_tempo_inserted_index:]:
-            if (mmb[0] >= offset_start+stream.duration.quarterLength):  # ignore tempos that start after stream ends
-                return
-            if (mmb[1] > offset_start):  # if mmb ends during the segment
-                if (mmb[0]) <= offset_start:  # starts before segment so insert it at the start of the stream
-                    stream.insert(0, tempo.MetronomeMark(number=mmb[2].number))
-                    self.last_tempo_inserted_index += 1
-                else:  # starts during segment so insert it part way through the stream
-                    stream.insert(mmb[0]-offset_start, tempo.MetronomeMark(number=mmb[2].number))
-                    self.last_tempo_inserted_index += 1
-
-    def map_octave(self, octave):
-        global settings
-        if settings['octaveDescription'] == "figureNotes":
-            return self._OCTAVE_FIGURENOTES_MAP.get(octave, "?")
-        elif settings['octaveDescription'] == "name":
-            return self._OCTAVE_MAP.get(octave, "?")
-        elif settings['octaveDescription'] == "none":
-            return ""
-        elif settings['octaveDescription'] == "number":
-            return str(octave)
-
-        # return f"{self._PITCH_MAP.get(pitch[-1], '')} {pitch[0]}"
-
-    def map_pitch(self, pitch):
-        global settings
-        if settings['pitchDescription'] == "colourNotes":
-            pitch_name = self._PITCH_FIGURENOTES_MAP.get(pitch.name[0], "?")
-        if settings['pitchDescription'] == "noteName":
-            pitch_name = pitch.name[0]
-        elif settings['pitchDescription'] == "none":
-            pitch_name = ""
-        elif settings['pitchDescription'] == "phonetic":
-            pitch_name = self._PITCH_PHONETIC_MAP.get(pitch.name[0], "?")
-
-        if pitch.accidental and pitch.accidental.displayStatus and pitch_name != "":
-            pitch_name = f"{pitch_name} {pitch.accidental.fullName}"
-        return pitch_name
+        for mmb in self.get_tempo_map().overlapping(offset_start, stream.duration.quarterLength):
+            if (mmb[0]) <= offset_start:  # starts before segment so insert it at the start of the stream
+                stream.insert(0, tempo.MetronomeMark(number=mmb[2].number))
+            else:  # starts during segment so insert it part way through the stream
+                stream.insert(mmb[0]-offset_start, tempo.MetronomeMark(number=mmb[2].number))
 
     def map_duration(self, duration):
-        global settings
-        if settings['rhythmDescription'] == "american":
+        if self.options.rhythm_description == "american":
             return duration.type
-        elif settings['rhythmDescription'] == "british":
+        elif self.options.rhythm_description == "british":
             return self._DURATION_MAP.get(duration.type, f'Unknown duration {duration.type}')
-        elif settings['rhythmDescription'] == "none":
-            return ""
-
-    def map_dots(self, dots):
-        if settings['rhythmDescription'] == "none":
+        elif self.options.rhythm_description == "none":
             return ""
-        else:
-            return self._DOTS_MAP.get(dots)
 
 
 class HTMLTalkingScoreFormatter():
 
-    def __init__(self, talking_score):
-        global settings
-
+    # analysis_workers - the number of processes MusicAnalyser uses to analyse the selected parts
+    # segment_workers - the number of processes used to describe the segments (ie bars at a time) of the score
+    # progress - optional function(stage, current=None, total=None) called as the score is processed - eg progress("rendering", 3, 20)
+    # options - the RenderOptions to describe the score with.  Defaults to reading the .opts file next to the score
+    def __init__(self, talking_score, analysis_workers=1, segment_workers=1, progress=None, options=None):
         self.score: Music21TalkingScore = talking_score
-
-        options_path = self.score.filepath + '.opts'
-        with open(options_path, "r") as options_fh:
-            options = json.load(options_fh)
-        settings = {
-            'pitchBeforeDuration': False,
-            'describeBy': 'beat',
-            'handsTogether': True,
-            'barsAtATime': int(options["bars_at_a_time"]),
-            'playAll': options["play_all"],
-            'playSelected': options["play_selected"],
-            'playUnselected': options["play_unselected"],
-            'instruments': options["instruments"],
-            'pitchDescription': options["pitch_description"],
-            'rhythmDescription': options["rhythm_description"],
-            'dotPosition': options["dot_position"],
-            'rhythmAnnouncement': options["rhythm_announcement"],
-            'octaveDescription': options["octave_description"],
-            'octavePosition': options["octave_position"],
-            'octaveAnnouncement': options["octave_announcement"],
-            'colourPosition': options["colour_position"],
-            'colourPitch': options["colour_pitch"],
-            'colourRhythm': options["colour_rhythm"],
-            'colourOctave': options["colour_octave"],
-        }
-
-    def generateHTML(self, output_path="", web_path=""):
-        global settings
-        from jinja2 import Environment, FileSystemLoader
-        env = Environment(loader=FileSystemLoader(os.path.dirname(__file__)))
-        template = env.get_template('talkingscore.html')
+        self.analysis_workers = analysis_workers
+        self.segment_workers = segment_workers
+        self.progress = progress
+
+        if options is None:
+            options_path = self.score.filepath + '.opts'
+            with open(options_path, "r") as options_fh:
+                options = RenderOptions.from_options(json.load(options_fh))
+        self.score.options = options
+
+    # segments_url - if given the segments (ie bars at a time) aren't described now.  The page has a placeholder for each one which it fetches from segments_url as it is needed - see render_segments().
+    # So the page of a long score is made in about the time the summaries take.  get_segment_context() is what render_segments() needs from making the page
+    def generateHTML(self, output_path="", web_path="", segments_url=None):
+        return "".join(self.stream_html(output_path, web_path, segments_url))
+
+    # the page as an iterator of strings - each segment is described as the template gets to it, so the whole page is never in memory.
+    # The score is analysed before this returns - so an error there is raised here rather than part way through the page
+    def stream_html(self, output_path="", web_path="", segments_url=None):
+        template = templateEnvironment.get_template('talkingscore.html')
 
         self.score.get_instruments()
         self.score.compare_parts_with_selected_instruments()
         print("Settings...")
-        print(settings)
+        print(self.score.options)
 
+        self.report_progress("analysing")
         self.music_analyser = MusicAnalyser()
-        self.music_analyser.setScore(self.score)
+        self.music_analyser.setScore(self.score, workers=self.analysis_workers)
         start = self.score.score.parts[0].getElementsByClass('Measure')[0].number
         end = self.score.score.parts[0].getElementsByClass('Measure')[-1].number
         selected_instruments_midis = {}
@@ -869,24 +1076,73 @@ class HTMLTalkingScoreFormatter():
         midiUnselected = self.score.generate_midi_filename_sel(prefix="/midis/" + os.path.basename(web_path) + "/", output_path=output_path, range_start=start, range_end=end, sel="un")
         full_score_midis = {'selected_instruments_midis': selected_instruments_midis, 'midi_all': midiAll, 'midi_sel': midiSelected, 'midi_un': midiUnselected}
 
-        return template.render({'settings': settings,
-                                'basic_information': self.get_basic_information(),
-                                'preamble': self.get_preamble(),
-                                'full_score_midis': full_score_midis,
-                                'music_segments': self.get_music_segments(output_path, web_path, ),
-                                'instruments': self.score.part_instruments,
-                                'part_names': self.score.part_names,
-                                'binary_selected_instruments': self.score.binary_selected_instruments,
-                                'binary_play_all': self.score.binary_play_all,
-                                'play_all': settings['playAll'],
-                                'play_selected': settings['playSelected'],
-                                'play_unselected': settings['playUnselected'],
-                                'time_and_keys': self.time_and_keys,
-                                'parts_summary': self.music_analyser.summary_parts,
-                                'general_summary': self.music_analyser.general_summary,
-                                'repetition_in_contexts': self.music_analyser.repetition_in_contexts,
-                                'selected_part_names': self.score.selected_part_names,
-                                })
+        self.time_and_keys = self.get_time_and_keys()
+        if segments_url is None:
+            music_segments = self.get_music_segments(output_path, web_path)
+            segment_placeholders = []
+        else:
+            self.bar_ranges = self.get_segment_bar_ranges()
+            music_segments = []
+            segment_placeholders = [dict(self.get_segment_labels(start_bar, end_bar), from_bar=start_bar) for start_bar, end_bar in self.bar_ranges]
+
+        return template.generate(dict(self.get_segment_template_variables(self.music_analyser.repetition_in_contexts),
+                                      settings=self.score.options,
+                                      basic_information=self.get_basic_information(),
+                                      preamble=self.get_preamble(),
+                                      full_score_midis=full_score_midis,
+                                      music_segments=music_segments,
+                                      segment_placeholders=segment_placeholders,
+                                      segments_url=segments_url,
+                                      parts_summary=self.music_analyser.summary_parts,
+                                      general_summary=self.music_analyser.general_summary,
+                                      selected_part_names=self.score.selected_part_names,
+                                      ))
+
+    # what talkingscore_segment.html uses - as well as the segment
+    def get_segment_template_variables(self, repetition_in_contexts):
+        return {'instruments': self.score.part_instruments,
+                'part_names': self.score.part_names,
+                'binary_selected_instruments': self.score.binary_selected_instruments,
+                'binary_play_all': self.score.binary_play_all,
+                'play_all': self.score.options.play_all,
+                'play_selected': self.score.options.play_selected,
+                'play_unselected': self.score.options.play_unselected,
+                'time_and_keys': self.time_and_keys,
+                'repetition_in_contexts': repetition_in_contexts,
+                }
+
+    # the bar ranges of the segments, the options and what describing them needs from analysing the whole score - after generateHTML(segments_url=...).
+    # Only uses lists / strings / numbers so it can be saved as JSON - the bar numbers that are keys are saved as [key, value] pairs.
+    # The segments are described with these options (see RenderOptions.from_dict) rather than the .opts file - which may have been saved again since the page was made
+    def get_segment_context(self):
+        return {'bar_ranges': self.bar_ranges,
+                'options': dataclasses.asdict(self.score.options),
+                'time_and_keys': list(self.time_and_keys.items()),
+                'repetition_in_contexts': [[part_index, list(repetitions.items())] for part_index, repetitions in self.music_analyser.repetition_in_contexts.items()],
+                }
+
+    # [(start bar, end bar, html)] of the segments in bar_ranges - for a page made with generateHTML(segments_url=...).  context is its get_segment_context()
+    # and the formatter should have been made with its options
+    # Only these segments are described - so the memory used doesn't grow with the length of the score
+    def render_segments(self, bar_ranges, context, output_path="", web_path=""):
+        template = templateEnvironment.get_template('talkingscore_segment.html')
+        self.score.get_instruments()
+        self.score.compare_parts_with_selected_instruments()
+        self.get_segment_bar_ranges()  # fills timeSigs
+        self.time_and_keys = {bar: descriptions for bar, descriptions in context['time_and_keys']}
+        repetition_in_contexts = {part_index: {bar: description for bar, description in repetitions} for part_index, repetitions in context['repetition_in_contexts']}
+        variables = self.get_segment_template_variables(repetition_in_contexts)
+
+        prefix = "/midis/" + os.path.basename(web_path) + "/"
+        rendered = []
+        for start_bar, end_bar in bar_ranges:
+            segment = self.make_music_segment(start_bar, end_bar, self.describe_segment(start_bar, end_bar), prefix, output_path)
+            rendered.append((start_bar, end_bar, template.render(dict(variables, segment=segment))))
+        return rendered
+
+    def report_progress(self, stage, current=None, total=None):
+        if self.progress is not None:
+            self.progress(stage, current, total)
 
     def get_basic_information(self):
         return {
@@ -903,102 +1159,168 @@ class HTMLTalkingScoreFormatter():
             'number_of_parts': self.score.get_number_of_parts(),
         }
 
+    # yields the segments (see make_music_segment) one at a time - so only the segments being described are in memory.  Needs self.time_and_keys
     def get_music_segments(self, output_path, web_path):
         print("web path = ")
         print(web_path)
         print("base name webpath = ")
         print(os.path.basename(web_path))
 
-        global settings
         logger.info("Start of get_music_segments")
-        music_segments = []
-        number_of_bars = self.score.get_number_of_bars()
-
         t1s = time.time()
-        self.time_and_keys = {}  # index is bar number, key = "Time sig x of y - 4 4..."
+
+        bar_ranges = self.get_segment_bar_ranges()
+        self.report_progress("rendering", 0, len(bar_ranges))
+        if self.segment_workers > 1 and len(bar_ranges) > 1:
+            segments_descriptions = self.describe_segments_in_processes(bar_ranges)
+        else:
+            segments_descriptions = (self.describe_segment(start_bar, end_bar) for start_bar, end_bar in bar_ranges)
+
+        prefix = "/midis/" + os.path.basename(web_path) + "/"
+        for count, ((start_bar, end_bar), selected_instruments_descriptions) in enumerate(zip(bar_ranges, segments_descriptions)):
+            yield self.make_music_segment(start_bar, end_bar, selected_instruments_descriptions, prefix, output_path)
+            if self.segment_workers <= 1 or len(bar_ranges) <= 1:
+                self.report_progress("rendering", count + 1, len(bar_ranges))
+
+        logger.info("End of get_music_segments")
+        t1e = time.time()
+        print("described parts etc = " + str(t1e-t1s))
+
+    # index is bar number, key = "Time sig x of y - 4 4..."
+    def get_time_and_keys(self):
+        time_and_keys = {}
         total = len(self.score.score.parts[0].flat.getElementsByClass('TimeSignature'))
         for count, ts in enumerate(self.score.score.parts[0].flat.getElementsByClass('TimeSignature')):
             description = "Time signature - " + str(count+1) + " of " + str(total) + " is " + self.score.describe_time_signature(ts) + ".  "
-            self.time_and_keys.setdefault(ts.measureNumber, []).append(description)
+            time_and_keys.setdefault(ts.measureNumber, []).append(description)
 
         total = len(self.score.score.parts[0].flat.getElementsByClass('KeySignature'))
         for count, ks in enumerate(self.score.score.parts[0].flat.getElementsByClass('KeySignature')):
             description = "Key signature - " + str(count+1) + " of " + str(total) + " is " + self.score.describe_key_signature(ks) + ".  "
-            self.time_and_keys.setdefault(ks.measureNumber, []).append(description)
+            time_and_keys.setdefault(ks.measureNumber, []).append(description)
+        return time_and_keys
+
+    # the start_bar / end_bar shown for a segment - the pickup bar is described as bars 0 to 1
+    def get_segment_labels(self, start_bar, end_bar):
+        if start_bar == 0:
+            return {'start_bar': '0 - pickup', 'end_bar': '0 - pickup'}
+        return {'start_bar': start_bar, 'end_bar': end_bar}
+
+    # the segment talkingscore_segment.html renders - its descriptions (see describe_segment) and the urls of its midi files
+    def make_music_segment(self, start_bar, end_bar, selected_instruments_descriptions, prefix, output_path):
+        # the pickup bar is described as bars 0 to 1 - but only plays bar 0
+        if start_bar == 0:
+            midi_end_bar = 0
+        else:
+            midi_end_bar = end_bar
+
+        selected_instruments_midis = {}
+        for index, ins in enumerate(self.score.selected_instruments):
+            logger.debug(f"adding to selected_instruments_midis - index = {index} and ins = {ins}")
+            midis = self.score.generate_midi_filenames(prefix=prefix, range_start=start_bar, range_end=midi_end_bar, output_path=output_path, add_instruments=[ins], postfix_filename="ins"+str(index))
+            selected_instruments_midis[ins] = {"ins": ins,  "midi": midis[0], "midi_parts": midis[1]}
+
+        midiAll = self.score.generate_midi_filename_sel(prefix=prefix, output_path=output_path, range_start=start_bar, range_end=midi_end_bar, sel="all")
+        midiSelected = self.score.generate_midi_filename_sel(prefix=prefix, output_path=output_path, range_start=start_bar, range_end=midi_end_bar, sel="sel")
+        midiUnselected = self.score.generate_midi_filename_sel(prefix=prefix, output_path=output_path, range_start=start_bar, range_end=midi_end_bar, sel="un")
+
+        return dict(self.get_segment_labels(start_bar, end_bar), selected_instruments_descriptions=selected_instruments_descriptions, selected_instruments_midis=selected_instruments_midis,
+                    midi_all=midiAll, midi_sel=midiSelected, midi_un=midiUnselected)
+
+    # the cheap first pass over the score - works out the [start bar, end bar] of each segment and fills self.score.timeSigs which describing the segments needs
+    # a pickup bar is the segment [0, 1]
+    def get_segment_bar_ranges(self):
+        bar_ranges = []
+        number_of_bars = self.score.get_number_of_bars()
 
         self.score.timeSigs = {}  # key=bar number.  Value = timeSig
         previous_ts = self.score.score.parts[0].getElementsByClass('Measure')[0].getTimeSignatures()[0]
 
         # pickup bar
-        if self.score.score.parts[0].getElementsByClass('Measure')[0].number != self.score.score.parts[0].measures(1, 2).getElementsByClass('Measure')[0].number:
+        bar_one = self.score.get_measure(0, 1) or self.score.get_measure(0, 2)
+        if self.score.score.parts[0].getElementsByClass('Measure')[0].number != bar_one.measure.number:
             previous_ts = self.score.score.parts[0].getElementsByClass('Measure')[0].getElementsByClass(meter.TimeSignature)[0]
             self.score.timeSigs[0] = previous_ts
             # todo - where should spanners and dynamics etc go?
-            selected_instruments_descriptions = {}  # key = instrument index, {[part descriptions]}
-
-            selected_instruments_midis = {}
-            for index, ins in enumerate(self.score.selected_instruments):
-                logger.debug(f"enumerate selected instruments... index = {index} and ins ={ins}")
-                midis = self.score.generate_midi_filenames(prefix="/midis/" + os.path.basename(web_path) + "/", range_start=0, range_end=0, output_path=output_path, add_instruments=[ins], postfix_filename="ins"+str(index))
-                selected_instruments_midis[ins] = {"ins": ins,  "midi": midis[0], "midi_parts": midis[1]}
-                selected_instruments_descriptions[ins] = self.score.generate_part_descriptions(instrument=ins, start_bar=0, end_bar=1)
-            midiAll = self.score.generate_midi_filename_sel(prefix="/midis/" + os.path.basename(web_path) + "/", output_path=output_path, range_start=0, range_end=0, sel="all")
-            midiSelected = self.score.generate_midi_filename_sel(prefix="/midis/" + os.path.basename(web_path) + "/", output_path=output_path, range_start=0, range_end=0, sel="sel")
-            midiUnselected = self.score.generate_midi_filename_sel(prefix="/midis/" + os.path.basename(web_path) + "/", output_path=output_path, range_start=0, range_end=0, sel="un")
-
-            music_segment = {'start_bar': '0 - pickup', 'end_bar': '0 - pickup', 'selected_instruments_descriptions': selected_instruments_descriptions, 'selected_instruments_midis': selected_instruments_midis,  'midi_all': midiAll, 'midi_sel': midiSelected, 'midi_un': midiUnselected}
-            music_segments.append(music_segment)
+            bar_ranges.append([0, 1])
             number_of_bars -= 1
 
         # everything except the pickup
-        for bar_index in range(1, number_of_bars+1, settings['barsAtATime']):
-            end_bar_index = bar_index + settings['barsAtATime'] - 1
+        bars_at_a_time = self.score.options.bars_at_a_time
+        for bar_index in range(1, number_of_bars+1, bars_at_a_time):
+            end_bar_index = bar_index + bars_at_a_time - 1
             if end_bar_index > number_of_bars:
                 end_bar_index = number_of_bars
 
             # cludge to not have None bars - but will actually ignore some...
             # todo - we get the number of bars just by the length and use that as the maximum bar number.  However- sometimes bars are called "X1" for half bars next to a repeat.  Or Finale re-uses bar numbers for sections - so need a better way of getting each bar...
-            if (self.score.score.parts[0].measure(bar_index) == None):
+            if (self.score.get_measure(0, bar_index) == None):
                 print("start bar is none...")
                 break
-            while (end_bar_index >= 1 and self.score.score.parts[0].measure(end_bar_index+1) == None):
+            while (end_bar_index >= 1 and self.score.get_measure(0, end_bar_index) == None):
                 end_bar_index = end_bar_index - 1
                 print("end bar index was too big - now " + str(end_bar_index))
             # if there is only 1 bar - and it isn't a pickup bar
-            if end_bar_index == 0 and self.score.score.parts[0].measure(0) == None:
+            if end_bar_index == 0 and self.score.get_measure(0, 0) == None:
                 end_bar_index = 1
             for checkts in range(bar_index, end_bar_index+1):
-                if (self.score.score.parts[0].measure(bar_index) == None):
-                    print("bar " + str(bar_index) + " is None...")
-                elif len(self.score.score.parts[0].measure(bar_index).getElementsByClass(meter.TimeSignature)) > 0:
-                    previous_ts = self.score.score.parts[0].measure(bar_index).getElementsByClass(meter.TimeSignature)[0]
+                measure = self.score.get_measure(0, checkts)
+                if (measure == None):
+                    print("bar " + str(checkts) + " is None...")
+                else:
+                    previous_ts = measure.time_signature
                 self.score.timeSigs[checkts] = previous_ts
 
-            # for offset, events in events_for_bar_range.iteritems():
-            # events_ordered_by_beat = OrderedDict(sorted(events_for_bar_range.items(), key=lambda t: t[0]))
+            bar_ranges.append([bar_index, end_bar_index])
 
-            # pp = pprint.PrettyPrinter(indent=4)
-            # pp.pprint(events_by_bar_and_beat)
+        return bar_ranges
 
-            selected_instruments_descriptions = {}  # key = instrument index,
-            selected_instruments_midis = {}
-            for index, ins in enumerate(self.score.selected_instruments):
-                logger.debug(f"adding to selected_instruments_descriptions - index = {index} and ins = {ins}")
-                midis = self.score.generate_midi_filenames(prefix="/midis/" + os.path.basename(web_path) + "/", range_start=bar_index, range_end=end_bar_index, output_path=output_path, add_instruments=[ins], postfix_filename="ins"+str(index))
-                selected_instruments_midis[ins] = {"ins": ins,  "midi": midis[0], "midi_parts": midis[1]}
-                selected_instruments_descriptions[ins] = self.score.generate_part_descriptions(instrument=ins, start_bar=bar_index, end_bar=end_bar_index)
-
-            midiAll = self.score.generate_midi_filename_sel(prefix="/midis/" + os.path.basename(web_path) + "/", output_path=output_path, range_start=bar_index, range_end=end_bar_index, sel="all")
-            midiSelected = self.score.generate_midi_filename_sel(prefix="/midis/" + os.path.basename(web_path) + "/", output_path=output_path, range_start=bar_index, range_end=end_bar_index, sel="sel")
-            midiUnselected = self.score.generate_midi_filename_sel(prefix="/midis/" + os.path.basename(web_path) + "/", output_path=output_path, range_start=bar_index, range_end=end_bar_index, sel="un")
-
-            music_segment = {'start_bar': bar_index, 'end_bar': end_bar_index,  'selected_instruments_descriptions': selected_instruments_descriptions, 'selected_instruments_midis': selected_instruments_midis, 'midi_all': midiAll, 'midi_sel': midiSelected, 'midi_un': midiUnselected}
-            music_segments.append(music_segment)
-
-        logger.info("End of get_music_segments")
-        t1e = time.time()
-        print("described parts etc = " + str(t1e-t1s))
-        return music_segments
+    # key = instrument index, [part descriptions]
+    def describe_segment(self, start_bar, end_bar):
+        selected_instruments_descriptions = {}
+        for index, ins in enumerate(self.score.selected_instruments):
+            logger.debug(f"adding to selected_instruments_descriptions - index = {index} and ins = {ins}")
+            selected_instruments_descriptions[ins] = self.score.generate_part_descriptions(instrument=ins, start_bar=start_bar, end_bar=end_bar)
+        return selected_instruments_descriptions
+
+    # each segment only depends on the score, its options and timeSigs - so they can be described in other processes.
+    # Each worker loads the score from the parsed score cache, is given this formatter's options and fills timeSigs itself, then describes chunks of consecutive segments - the descriptions are yielded in order
+    def describe_segments_in_processes(self, bar_ranges):
+        workers = min(self.segment_workers, len(bar_ranges))
+        chunk_size = max(1, math.ceil(len(bar_ranges) / (workers * 4)))  # a few chunks per worker so a slow chunk doesn't hold everything up
+        chunks = [bar_ranges[i:i+chunk_size] for i in range(0, len(bar_ranges), chunk_size)]
+        described = 0
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_segment_worker, initargs=(self.score.filepath, self.score.cache_dir, self.score.options))
+        try:
+            # only a few chunks are submitted ahead of the one being yielded - so descriptions don't pile up in memory when the page is written slower than they are made
+            chunks = iter(chunks)
+            in_flight = collections.deque(executor.submit(_describe_segments, chunk) for chunk in itertools.islice(chunks, workers * 2))
+            while in_flight:
+                chunk_descriptions = in_flight.popleft().result()
+                for chunk in itertools.islice(chunks, 1):
+                    in_flight.append(executor.submit(_describe_segments, chunk))
+                described += len(chunk_descriptions)
+                self.report_progress("rendering", described, len(bar_ranges))
+                yield from chunk_descriptions
+        finally:
+            executor.shutdown(cancel_futures=True)  # eg the page stopped being rendered part way through
+
+
+# the HTMLTalkingScoreFormatter of a segment worker process - see HTMLTalkingScoreFormatter.describe_segments_in_processes
+_segment_formatter = None
+
+
+def _init_segment_worker(musicxml_filepath, cache_dir, options):
+    global _segment_formatter
+    # the main process's options rather than the .opts file - which could have been saved again since the page was started
+    _segment_formatter = HTMLTalkingScoreFormatter(Music21TalkingScore(musicxml_filepath, cache_dir), options=options)
+    _segment_formatter.score.get_instruments()
+    _segment_formatter.score.compare_parts_with_selected_instruments()
+    _segment_formatter.get_segment_bar_ranges()
+
+
+def _describe_segments(bar_ranges):
+    return [_segment_formatter.describe_segment(start_bar, end_bar) for start_bar, end_bar in bar_ranges]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,42 @@
+import os
+import logging
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from lib.fileUtils import atomic_write
+
+logger = logging.getLogger("TSScore")
+
+"""
+One Jinja environment for the process - so talkingscore.html etc are compiled the first time they are used rather than for every score that is rendered.
+auto_reload - a template is compiled again if its file's modification time has changed, so editing a template doesn't need a restart.
+
+use_bytecode_cache() keeps the compiled templates in a directory as well - so a new process (eg a job worker, or a batch re-render) loads them rather than compiling them.
+Jinja checks the template source still matches before using a cached copy.  precompile_templates() compiles them up front - eg when the web app starts.
+"""
+
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_NAMES = ('talkingscore.html', 'talkingscore_segment.html')
+
+
+# FileSystemBytecodeCache writes straight into the cache file - so another process could read half a file
+class _BytecodeCache(FileSystemBytecodeCache):
+    def dump_bytecode(self, bucket):
+        with atomic_write(self._get_cache_filename(bucket)) as fh:
+            bucket.write_bytecode(fh)
+
+
+template_environment = Environment(loader=FileSystemLoader(TEMPLATE_DIR), auto_reload=True)
+
+
+def use_bytecode_cache(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    template_environment.bytecode_cache = _BytecodeCache(cache_dir)
+
+
+def get_template(name):
+    return template_environment.get_template(name)
+
+
+def precompile_templates():
+    for name in TEMPLATE_NAMES:
+        get_template(name)
+    logger.info("Compiled templates %s" % ", ".join(TEMPLATE_NAMES))
@@ -0,0 +1,27 @@
+import bisect
+
+"""
+The tempos of a score in order - so "which tempos are used between these offsets" is a binary search rather than asking music21 for Score.metronomeMarkBoundaries() again, which looks through the whole score every time.
+Build one per score and keep it with the score - eg Music21TalkingScore.get_tempo_map() and ScoreTimeline.
+
+Each tempo is a tuple that starts (start offset, end offset, ...) - from_score() gives (start, end, MetronomeMark) like metronomeMarkBoundaries().
+The tempos follow on from each other so both the starts and the ends are in order.
+"""
+
+
+class TempoMap:
+    def __init__(self, tempos):
+        self.tempos = list(tempos)
+        self.starts = [t[0] for t in self.tempos]
+        self.ends = [t[1] for t in self.tempos]
+
+    @classmethod
+    def from_score(cls, score):
+        return cls(score.metronomeMarkBoundaries())
+
+    # the tempos that are used between offset and offset + length (quarter notes).  A tempo that ends at offset isn't included
+    def overlapping(self, offset, length):
+        first = bisect.bisect_right(self.ends, offset)
+        last = bisect.bisect_left(self.starts, offset + length)
+        return self.tempos[first:last]
+
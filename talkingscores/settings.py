@@ -125,4 +125,31 @@ STATIC_URL = '/static/'
 # Media root
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 STATIC_ROOT = 'staticfiles'
+# lock files held while a generated file is made (see lib/fileUtils.py)
+LOCK_DIR = os.path.join(MEDIA_ROOT, 'locks')
+
+# Number of processes used to analyse the parts of a score (see MusicAnalyser.setScore) - 1 analyses them one after another
+ANALYSIS_WORKERS = int(os.environ.get('TALKINGSCORES_ANALYSIS_WORKERS', 1))
+# Number of processes used to describe the segments (bars at a time) of a score (see HTMLTalkingScoreFormatter.get_music_segments) - 1 describes them one after another
+SEGMENT_WORKERS = int(os.environ.get('TALKINGSCORES_SEGMENT_WORKERS', 1))
+
+# Above 0, scores are processed by a queue of background jobs (see talkingscoresapp/jobs.py) - this is how many are processed at the same time.
+# 0 processes the score in the web request instead
+JOB_WORKERS = int(os.environ.get('TALKINGSCORES_JOB_WORKERS', 0))
+# start the job workers (as a detached process) when a score is queued if they aren't running - otherwise run them with "manage.py runjobworkers"
+JOB_WORKERS_AUTOSTART = os.environ.get('TALKINGSCORES_JOB_WORKERS_AUTOSTART', '0') == '1'
+
+# Only the midi file that is asked for is made.  With MIDI_PREFETCH the rest of the files for the same bars (other parts / tempos / click track) are then made in a background thread
+MIDI_PREFETCH = os.environ.get('TALKINGSCORES_MIDI_PREFETCH', '1') == '1'
+
+# The compiled talking score templates are kept here - so a new process doesn't compile them again (see lib/templateEnvironment.py).  Empty to only keep them in memory
+TEMPLATE_CACHE_DIR = os.environ.get('TALKINGSCORES_TEMPLATE_CACHE_DIR', os.path.join(BASE_DIR, 'tmp', 'template-cache'))
+# compile the talking score templates when the app starts rather than when the first score is rendered
+PRECOMPILE_TEMPLATES = os.environ.get('TALKINGSCORES_PRECOMPILE_TEMPLATES', '1') == '1'
+
+# A score with at least this many bars is sent without its segments (bars at a time) - the page fetches them as they are needed (see TSScore.segments()).  0 always puts every segment in the page
+LAZY_SEGMENTS_MIN_BARS = int(os.environ.get('TALKINGSCORES_LAZY_SEGMENTS_MIN_BARS', 200))
+
+# The generated html / midi files and pickled scores are deleted, least recently used first, to keep them within this many bytes (see talkingscoresapp/artefacts.py).  0 keeps them all
+ARTEFACT_CACHE_BYTES = int(os.environ.get('TALKINGSCORES_ARTEFACT_CACHE_BYTES', 5 * 1024 ** 3))
 
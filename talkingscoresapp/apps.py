@@ -1,5 +1,20 @@
+import logging
 from django.apps import AppConfig
 
+logger = logging.getLogger("TSScore")
+
 
 class TalkingscoresappConfig(AppConfig):
     name = 'talkingscoresapp'
+
+    # the talking score templates are compiled once per process - see lib/templateEnvironment.py
+    def ready(self):
+        from talkingscores.settings import TEMPLATE_CACHE_DIR, PRECOMPILE_TEMPLATES
+        from lib import templateEnvironment
+        if TEMPLATE_CACHE_DIR:
+            templateEnvironment.use_bytecode_cache(TEMPLATE_CACHE_DIR)
+        if PRECOMPILE_TEMPLATES:
+            try:
+                templateEnvironment.precompile_templates()
+            except Exception:
+                logger.exception("Unable to compile the talking score templates")  # they are compiled again when a score is rendered - which shows the error
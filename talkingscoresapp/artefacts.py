@@ -0,0 +1,172 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+from talkingscores.settings import BASE_DIR, MEDIA_ROOT, STATIC_ROOT, ARTEFACT_CACHE_BYTES
+from talkingscoresapp import sqlitedb
+
+logger = logging.getLogger("TSScore")
+
+"""
+Keeps the files made from the scores - the talking score html (and its compressed copies), the midi files and the pickled scores / timelines - within ARTEFACT_CACHE_BYTES by deleting the least recently used.
+They can all be made again from the uploaded .musicxml file and its .opts - which are never deleted.
+
+Each time a file is served touch() records it in memory.  touch() also schedules a background thread - at most every EVICT_INTERVAL seconds in each process - which writes those records to
+a SQLite table in MEDIA_ROOT and then evicts, if no other process is evicting.  Or run the evictartefacts management command.
+Files that haven't been served (eg prefetched midi files, pickles) are found by scanning the directories and count as used when they were last read or written.
+
+The records of a use are only in the memory of the process that served the file until its thread writes them - up to EVICT_INTERVAL seconds later.  Until then another process
+(or the management command) ranks the file by its last record in the table, or its access time.  So a file served in the last EVICT_INTERVAL seconds by another process can be deleted
+even though it was just used - the next request for it makes it again, and a file that has already been opened is still sent.  MIN_AGE only protects files whose use has been written.
+"""
+
+DATA_ROOT = os.path.join(BASE_DIR, STATIC_ROOT, 'data')
+ARTEFACTS_DB_PATH = os.path.join(MEDIA_ROOT, 'artefacts.sqlite3')
+ARTEFACTS_LOCK_PATH = os.path.join(MEDIA_ROOT, 'artefacts.lock')
+
+EVICT_INTERVAL = 60  # seconds
+MIN_AGE = 300  # seconds - a file used more recently than this isn't deleted, eg a midi file that is about to be sent
+LOW_WATER_MARK = 0.9  # evicting stops when the total is below this fraction of the budget - so it doesn't run for every new file
+
+_DATA_EXTENSIONS = ('.mid', '.html', '.html.gz', '.html.br')
+_MEDIA_EXTENSIONS = ('.p',)  # see lib/scoreCache.py and midiHandler.load_score_timeline()
+
+_last_evict = 0
+_evict_scheduled = False
+_evict_lock = threading.Lock()
+_accessed = {}  # path, when it was last served - waiting for _write_accessed()
+_accessed_lock = threading.Lock()
+
+
+def _connect():
+    return sqlitedb.connect(ARTEFACTS_DB_PATH, """CREATE TABLE IF NOT EXISTS artefacts (
+                            path TEXT PRIMARY KEY,
+                            size INTEGER NOT NULL,
+                            accessed_at REAL NOT NULL)""")
+
+
+# can the file be deleted and made again - ie is it in a score's directory in DATA_ROOT or MEDIA_ROOT with one of the extensions above
+def is_artefact(path):
+    path = os.path.realpath(path)
+    directory = os.path.dirname(os.path.dirname(path))
+    if directory == os.path.realpath(DATA_ROOT):
+        return path.endswith(_DATA_EXTENSIONS)
+    if directory == os.path.realpath(MEDIA_ROOT):
+        return path.endswith(_MEDIA_EXTENSIONS)
+    return False
+
+
+# records that the file has just been used.  Only in memory - so serving a file (even a 304) doesn't touch the database
+def touch(path):
+    if ARTEFACT_CACHE_BYTES <= 0:
+        return
+    path = os.path.realpath(path)
+    if is_artefact(path):
+        with _accessed_lock:
+            _accessed[path] = time.time()
+    evict_in_background()
+
+
+# writes the uses recorded by touch() in this process to the database
+def _write_accessed():
+    with _accessed_lock:
+        accessed = list(_accessed.items())
+        _accessed.clear()
+    rows = []
+    for path, accessed_at in accessed:
+        try:
+            rows.append((path, os.path.getsize(path), accessed_at))
+        except OSError:
+            pass  # deleted since it was served
+    if len(rows) == 0:
+        return
+    connection = _connect()
+    try:
+        connection.executemany("INSERT OR REPLACE INTO artefacts (path, size, accessed_at) VALUES (?, ?, ?)", rows)
+    finally:
+        connection.close()
+
+
+# {path: (size, last used)} of every artefact on disk
+def _scan():
+    files = {}
+    for root, extensions in ((DATA_ROOT, _DATA_EXTENSIONS), (MEDIA_ROOT, _MEDIA_EXTENSIONS)):
+        root = os.path.realpath(root)
+        if not os.path.isdir(root):
+            continue
+        for score_dir in os.scandir(root):
+            if not score_dir.is_dir():
+                continue
+            for entry in os.scandir(score_dir.path):
+                if entry.is_file() and entry.name.endswith(extensions):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, max(stat.st_atime, stat.st_mtime))
+    return files
+
+
+# deletes the least recently used artefacts until they fit in the budget.  Returns the number of bytes deleted - or None if another process is already evicting
+def evict(budget=None):
+    if budget is None:
+        budget = ARTEFACT_CACHE_BYTES
+    with open(ARTEFACTS_LOCK_PATH, 'w') as lock_fh:
+        try:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return None
+
+        files = _scan()
+        connection = _connect()
+        try:
+            recorded = dict(connection.execute("SELECT path, accessed_at FROM artefacts").fetchall())
+            # files that have gone (eg the score was deleted) are forgotten
+            connection.executemany("DELETE FROM artefacts WHERE path=?", [(path,) for path in recorded if path not in files])
+
+            total = sum(size for size, accessed_at in files.values())
+            if total <= budget:
+                return 0
+
+            target = budget * LOW_WATER_MARK
+            too_recent = time.time() - MIN_AGE
+            deleted = 0
+            for path, (size, accessed_at) in sorted(files.items(), key=lambda f: max(f[1][1], recorded.get(f[0], 0))):
+                if total <= target or max(accessed_at, recorded.get(path, 0)) > too_recent:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                connection.execute("DELETE FROM artefacts WHERE path=?", (path,))
+                total -= size
+                deleted += size
+            logger.info("Evicted %d bytes of generated files - %d bytes left" % (deleted, total))
+            return deleted
+        finally:
+            connection.close()
+
+
+def _evict_quietly():
+    global _last_evict, _evict_scheduled
+    with _evict_lock:
+        _last_evict = time.time()
+        _evict_scheduled = False
+    try:
+        _write_accessed()
+        evict()
+    except Exception:
+        logger.exception("Unable to evict generated files")
+
+
+# runs _write_accessed() then evict() in a daemon thread - straight away, or EVICT_INTERVAL seconds after this process last did if that was more recent.
+# So the uses recorded by touch() are written within EVICT_INTERVAL seconds even if nothing else is served
+def evict_in_background():
+    global _evict_scheduled
+    with _evict_lock:
+        if _evict_scheduled:
+            return
+        _evict_scheduled = True
+        delay = max(0, _last_evict + EVICT_INTERVAL - time.time())
+    timer = threading.Timer(delay, _evict_quietly)
+    timer.name = "talkingscores-evict"
+    timer.daemon = True
+    timer.start()
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import fcntl
+import sqlite3
+import logging
+import threading
+import subprocess
+import multiprocessing
+from talkingscores.settings import BASE_DIR, MEDIA_ROOT, JOB_WORKERS, JOB_WORKERS_AUTOSTART
+from talkingscoresapp import sqlitedb
+
+logger = logging.getLogger("TSScore")
+
+"""
+A local queue of scores waiting to be turned into a talking score - so the (sometimes very slow) processing happens in worker processes rather than in a web request.
+
+The queue is a table in a SQLite database in MEDIA_ROOT - so it doesn't need any other service.  The options page adds a job and the processing page polls get_status() until the job is done.
+The workers are started by the runjobworkers management command - or, with JOB_WORKERS_AUTOSTART, by the first enqueue() that finds them not running.
+Only one set of workers runs at a time - the process that starts them holds an exclusive lock on JOBS_LOCK_PATH.
+
+A job's status is one of the JOB_ constants.  While rendering, the job also records how many segments (ie bars at a time) have been done out of how many.
+A job records the worker process that claimed it and the worker updates it at least every _HEARTBEAT_SECONDS.  If the worker dies the job is queued again - by run_workers(), which starts
+another worker in its place, or by the next _claim_next() once the job hasn't been updated for JOB_TIMEOUT seconds.  A job that has lost its worker MAX_ATTEMPTS times (eg the score crashes it) fails.
+"""
+
+JOBS_DB_PATH = os.path.join(MEDIA_ROOT, 'jobs.sqlite3')
+JOBS_LOCK_PATH = os.path.join(MEDIA_ROOT, 'jobs.lock')
+
+JOB_QUEUED = "queued"
+JOB_PARSING = "parsing"
+JOB_ANALYSING = "analysing"
+JOB_RENDERING = "rendering"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+
+_RUNNING = (JOB_PARSING, JOB_ANALYSING, JOB_RENDERING)
+_POLL_SECONDS = 1  # how often an idle worker looks for a new job - and how often run_workers() checks the workers are still alive
+_HEARTBEAT_SECONDS = 30  # how often a busy worker updates its job
+JOB_TIMEOUT = 300  # seconds - a running job that hasn't been updated for this long has lost its worker
+MAX_ATTEMPTS = 2
+
+
+def _connect():
+    connection = sqlitedb.connect(JOBS_DB_PATH, """CREATE TABLE IF NOT EXISTS jobs (
+                            score_id TEXT NOT NULL,
+                            filename TEXT NOT NULL,
+                            status TEXT NOT NULL,
+                            segment INTEGER,
+                            segments INTEGER,
+                            error TEXT,
+                            queued_at REAL NOT NULL,
+                            updated_at REAL NOT NULL,
+                            worker INTEGER,
+                            attempts INTEGER NOT NULL DEFAULT 0,
+                            PRIMARY KEY (score_id, filename))""")
+    columns = [row['name'] for row in connection.execute("PRAGMA table_info(jobs)")]
+    if 'worker' not in columns:
+        # made before jobs recorded their worker
+        connection.execute("ALTER TABLE jobs ADD COLUMN worker INTEGER")
+        connection.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    return connection
+
+
+# add the score to the queue - unless it is already waiting or being processed
+def enqueue(score_id, filename):
+    now = time.time()
+    connection = _connect()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute("SELECT status FROM jobs WHERE score_id=? AND filename=?", (score_id, filename)).fetchone()
+        if row is None or row['status'] not in (JOB_QUEUED,) + _RUNNING:
+            connection.execute("INSERT OR REPLACE INTO jobs (score_id, filename, status, segment, segments, error, queued_at, updated_at, worker, attempts) VALUES (?, ?, ?, NULL, NULL, NULL, ?, ?, NULL, 0)",
+                               (score_id, filename, JOB_QUEUED, now, now))
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+    if JOB_WORKERS_AUTOSTART:
+        start_workers_if_needed()
+
+
+# {'status': JOB_..., 'segment': x, 'segments': y, 'position': place in the queue} or None if the score has never been queued
+def get_status(score_id, filename):
+    connection = _connect()
+    try:
+        row = connection.execute("SELECT * FROM jobs WHERE score_id=? AND filename=?", (score_id, filename)).fetchone()
+        if row is None:
+            return None
+        status = {'status': row['status'], 'segment': row['segment'], 'segments': row['segments'], 'position': None}
+        if row['status'] == JOB_QUEUED:
+            status['position'] = connection.execute("SELECT COUNT(*) FROM jobs WHERE status=? AND queued_at<=?", (JOB_QUEUED, row['queued_at'])).fetchone()[0]
+        return status
+    finally:
+        connection.close()
+
+
+# only changes the job while this process is its worker - so a worker that was given up on can't overwrite the job after it has been claimed again
+def _set_status(score_id, filename, status, segment=None, segments=None, error=None):
+    connection = _connect()
+    try:
+        connection.execute("UPDATE jobs SET status=?, segment=?, segments=?, error=?, updated_at=? WHERE score_id=? AND filename=? AND worker=?",
+                           (status, segment, segments, error, time.time(), score_id, filename, os.getpid()))
+    finally:
+        connection.close()
+
+
+# running jobs that match the condition (an SQL expression) have lost their worker - they are queued again, or fail if they have already been tried MAX_ATTEMPTS times
+def _requeue_abandoned(connection, condition, parameters=()):
+    now = time.time()
+    connection.execute("UPDATE jobs SET status=?, segment=NULL, segments=NULL, error=?, worker=NULL, updated_at=? WHERE status IN (?, ?, ?) AND attempts>=? AND " + condition,
+                       (JOB_ERROR, "The score stopped the worker processing it %d times" % MAX_ATTEMPTS, now) + _RUNNING + (MAX_ATTEMPTS,) + tuple(parameters))
+    abandoned = connection.execute("UPDATE jobs SET status=?, segment=NULL, segments=NULL, worker=NULL, updated_at=? WHERE status IN (?, ?, ?) AND " + condition,
+                                   (JOB_QUEUED, now) + _RUNNING + tuple(parameters)).rowcount
+    if abandoned > 0:
+        logger.warning("Queued %d jobs again that lost their worker" % abandoned)
+
+
+# marks the oldest queued job as being parsed by this process and returns (score_id, filename) - or None if nothing is queued.
+# Jobs that haven't been updated for JOB_TIMEOUT seconds are queued again first
+def _claim_next():
+    now = time.time()
+    connection = _connect()
+    try:
+        connection.execute("BEGIN IMMEDIATE")  # so two workers can't claim the same job
+        _requeue_abandoned(connection, "updated_at<?", (now - JOB_TIMEOUT,))
+        row = connection.execute("SELECT score_id, filename FROM jobs WHERE status=? ORDER BY queued_at LIMIT 1", (JOB_QUEUED,)).fetchone()
+        if row is not None:
+            connection.execute("UPDATE jobs SET status=?, updated_at=?, worker=?, attempts=attempts+1 WHERE score_id=? AND filename=?",
+                               (JOB_PARSING, now, os.getpid(), row['score_id'], row['filename']))
+        connection.execute("COMMIT")
+        return None if row is None else (row['score_id'], row['filename'])
+    finally:
+        connection.close()
+
+
+# updates the job every _HEARTBEAT_SECONDS until stopped - so a long stage (eg analysing a big score) doesn't look like a dead worker
+def _heartbeat(score_id, filename, stopped):
+    while not stopped.wait(_HEARTBEAT_SECONDS):
+        try:
+            connection = _connect()
+            try:
+                connection.execute("UPDATE jobs SET updated_at=? WHERE score_id=? AND filename=? AND worker=?", (time.time(), score_id, filename, os.getpid()))
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            logger.exception("Unable to update job %s/%s" % (score_id, filename))
+
+
+def process_job(score_id, filename):
+    from talkingscoresapp.models import TSScore
+
+    def progress(stage, current=None, total=None):
+        _set_status(score_id, filename, stage, current, total)
+
+    logger.info("Processing job %s/%s" % (score_id, filename))
+    stopped = threading.Event()
+    threading.Thread(target=_heartbeat, args=(score_id, filename, stopped), name="talkingscores-job-heartbeat", daemon=True).start()
+    try:
+        TSScore(id=score_id, filename=filename).html(progress=progress)
+        _set_status(score_id, filename, JOB_DONE)
+    except Exception as ex:
+        logger.exception("Unable to process score %s/%s" % (score_id, filename))
+        _set_status(score_id, filename, JOB_ERROR, error=str(ex))
+    finally:
+        stopped.set()
+
+
+def _work():
+    while True:
+        job = _claim_next()
+        if job is None:
+            time.sleep(_POLL_SECONDS)
+        else:
+            process_job(*job)
+
+
+def _start_worker(index):
+    # not a daemon - a daemon process can't start the processes used to analyse the parts / describe the segments
+    process = multiprocessing.Process(target=_work, name="talkingscores-job-worker-%d" % index)
+    process.start()
+    return process
+
+
+# runs the worker processes until killed - starting another in place of any that dies.  Returns False straight away if another process is already running the workers
+def run_workers(workers=JOB_WORKERS):
+    lock_fh = open(JOBS_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_fh.close()
+        return False
+
+    # jobs left running by workers that died with the last run_workers() are started again
+    connection = _connect()
+    try:
+        _requeue_abandoned(connection, "1")
+    finally:
+        connection.close()
+
+    logger.info("Starting %d job workers" % workers)
+    processes = [_start_worker(i) for i in range(workers)]
+    try:
+        while True:
+            time.sleep(_POLL_SECONDS)
+            for index, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                process.join()
+                logger.error("Job worker %s exited with code %s - starting another" % (process.name, process.exitcode))
+                connection = _connect()
+                try:
+                    _requeue_abandoned(connection, "worker=?", (process.pid,))
+                finally:
+                    connection.close()
+                processes[index] = _start_worker(index)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        lock_fh.close()
+
+
+# starts the runjobworkers command in the background if nothing holds the lock.
+# If two requests both start it - the second one can't get the lock and exits straight away
+def start_workers_if_needed():
+    with open(JOBS_LOCK_PATH, 'w') as lock_fh:
+        try:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return  # the workers are running
+        fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    logger.info("Job workers aren't running - starting them")
+    subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'manage.py'), 'runjobworkers'], cwd=BASE_DIR, start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from talkingscoresapp import artefacts
+
+
+# deletes the least recently used generated files until they fit in the budget - see talkingscoresapp/artefacts.py
+class Command(BaseCommand):
+    help = "Delete the least recently used generated files (html / midi / pickles) until they fit in the cache budget"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--budget', type=int, default=artefacts.ARTEFACT_CACHE_BYTES, help="bytes to keep")
+
+    def handle(self, *args, **options):
+        deleted = artefacts.evict(options['budget'])
+        if deleted is None:
+            self.stderr.write("Already evicting in another process")
+        else:
+            self.stdout.write("Deleted %d bytes" % deleted)
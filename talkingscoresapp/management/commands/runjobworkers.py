@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from talkingscoresapp import jobs
+
+
+# runs the worker processes that turn queued scores into talking scores - see talkingscoresapp/jobs.py
+class Command(BaseCommand):
+    help = "Run the worker processes for the score processing queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=jobs.JOB_WORKERS, help="number of scores to process at the same time")
+
+    def handle(self, *args, **options):
+        if not jobs.run_workers(options['workers']):
+            self.stderr.write("The job workers are already running")
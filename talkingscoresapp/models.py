@@ -1,19 +1,30 @@
 from django.db import models
 
 import os
+import glob
+import json
+import zlib
+import functools
 import errno
-import hashlib
 import requests
 import logging
 import logging.handlers
 import logging.config
-from talkingscores.settings import BASE_DIR, MEDIA_ROOT, STATIC_ROOT, STATIC_URL
+from talkingscores.settings import BASE_DIR, MEDIA_ROOT, STATIC_ROOT, STATIC_URL, ANALYSIS_WORKERS, SEGMENT_WORKERS, LAZY_SEGMENTS_MIN_BARS, LOCK_DIR
+from django.urls import reverse
 from urllib.parse import urlparse
 from urllib.request import url2pathname
 import tempfile
-from talkingscoreslib import Music21TalkingScore, HTMLTalkingScoreFormatter
+from talkingscoreslib import Music21TalkingScore, HTMLTalkingScoreFormatter, RenderOptions
+from lib.scoreCache import hash_file
+from lib.fileUtils import write_file, temporary_file_for, replace_file, path_lock
+from talkingscoresapp import artefacts
 # the musicxml file is saved with its original filename - so needs to be sanitized.  Also, we remove apostrophes
 from pathvalidate import sanitize_filename
+try:
+    import brotli  # optional - pip install brotli to send brotli compressed pages as well as gzip
+except ImportError:
+    brotli = None
 
 logger = logging.getLogger("TSScore")
 logger.setLevel(logging.DEBUG)  # set the minimum level for the logger to the level of the lowest handler or some events could be missed!
@@ -29,12 +40,94 @@ logger.addHandler(console_handler)
 logger.addHandler(file_handler)
 
 
-def hashfile(afile, hasher, blocksize=65536):
-    buf = afile.read(blocksize)
-    while len(buf) > 0:
-        hasher.update(buf)
-        buf = afile.read(blocksize)
-    return hasher.hexdigest()
+# the talking score html is big and repetitive - so compressed copies are written when it is made and sent to browsers that accept them.
+# (Content-Encoding, file extension, function returning a compressor) - in order of preference.  Brotli is only used if the brotli module is installed.
+# A compressor has compress(data) and flush() like a zlib compressobj - so a file can be compressed a chunk at a time
+COMPRESSED_HTML_ENCODINGS = []
+if brotli is not None:
+    class _BrotliCompressor:
+        def __init__(self):
+            self.compressor = brotli.Compressor(quality=11)
+
+        def compress(self, data):
+            return self.compressor.process(data)
+
+        def flush(self):
+            return self.compressor.finish()
+
+    COMPRESSED_HTML_ENCODINGS.append(('br', '.br', _BrotliCompressor))
+COMPRESSED_HTML_ENCODINGS.append(('gzip', '.gz', lambda: zlib.compressobj(9, zlib.DEFLATED, 31)))  # wbits 31 is the gzip format
+
+
+# writes files a chunk at a time - each to a temporary file which replaces it in commit() (see lib/fileUtils.py).  abort() deletes the temporary files
+# paths - {path: function returning a compressor (see COMPRESSED_HTML_ENCODINGS) or None to write the data as it is}
+class ChunkedFileWriter:
+    def __init__(self, paths):
+        self.files = []
+        try:
+            for path, make_compressor in paths.items():
+                fh = temporary_file_for(path)
+                self.files.append((path, None if make_compressor is None else make_compressor(), fh))
+        except BaseException:
+            self.abort()
+            raise
+
+    def write(self, data):
+        for path, compressor, fh in self.files:
+            fh.write(data if compressor is None else compressor.compress(data))
+
+    # the files replace their paths in the order they were given
+    def commit(self):
+        for path, compressor, fh in self.files:
+            if compressor is not None:
+                fh.write(compressor.flush())
+            fh.close()
+        for path, compressor, fh in self.files:
+            replace_file(fh.name, path)
+
+    def abort(self):
+        for path, compressor, fh in self.files:
+            fh.close()
+            if os.path.exists(fh.name):
+                os.remove(fh.name)
+
+
+# see TSScore.compress_html().  The copies are only looked at the first time this process sees the html with that modification time - so a page view doesn't stat each of them.
+# A copy deleted after that (eg evicted) isn't made again until the html changes - the page is sent uncompressed instead
+@functools.lru_cache(maxsize=1024)
+def _compress_html(html_path, html_mtime):
+    paths = {html_path + extension: make_compressor for encoding, extension, make_compressor in COMPRESSED_HTML_ENCODINGS
+             if not os.path.exists(html_path + extension) or os.stat(html_path + extension).st_mtime_ns < html_mtime}
+    if len(paths) == 0:
+        return
+    writer = ChunkedFileWriter(paths)
+    try:
+        with open(html_path, 'rb') as html_fh:
+            for data in iter(lambda: html_fh.read(65536), b''):
+                writer.write(data)
+        writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+MAX_SEGMENTS_PER_REQUEST = 16  # see TSScore.segments()
+HTML_CHUNK_CHARACTERS = 16 * 1024  # see join_chunks()
+
+
+# the template generates lots of small strings - they are joined into chunks of at least this many characters so they aren't written / sent one at a time
+def join_chunks(strings, size=HTML_CHUNK_CHARACTERS):
+    chunk = []
+    length = 0
+    for string in strings:
+        chunk.append(string)
+        length += len(string)
+        if length >= size:
+            yield "".join(chunk)
+            chunk = []
+            length = 0
+    if len(chunk) > 0:
+        yield "".join(chunk)
 
 
 class TSScoreState(object):
@@ -88,7 +181,7 @@ class TSScore(object):
     def store(self, src_filepath, filename):
 
         if self.id is None:
-            self.id = hashfile(open(src_filepath, 'rb'), hashlib.sha256())
+            self.id = hash_file(src_filepath)
         if self.filename is None:
             filename = filename.replace(".xml", ".musicxml")
             self.filename = filename
@@ -142,21 +235,123 @@ class TSScore(object):
         temporary_file.close()
         return temporary_file.name
 
-    def html(self):
-        data_path = self.get_data_file_path()
-        html_path = self.get_data_file_path(root=os.path.join(BASE_DIR, STATIC_ROOT, 'data')) + '.html'
-        web_path = os.path.dirname(self.get_data_file_path(root="/scores", createDirs=False))
+    def get_html_file_path(self):
+        return self.get_data_file_path(root=os.path.join(BASE_DIR, STATIC_ROOT, 'data')) + '.html'
+
+    def is_processed(self):
+        return os.path.exists(self.get_html_file_path())
+
+    # writes a compressed copy of the html for each of COMPRESSED_HTML_ENCODINGS - unless it is already up to date (see _compress_html)
+    def compress_html(self):
+        html_path = self.get_html_file_path()
+        _compress_html(html_path, os.stat(html_path).st_mtime_ns)
+
+    # (path, encoding) of the html to send for the Accept-Encoding header.  encoding is None for the uncompressed html
+    def get_html_file_path_for_encodings(self, accept_encoding):
+        html_path = self.get_html_file_path()
+        self.compress_html()  # eg the page was made before the compressed copies were
+        for encoding, extension, make_compressor in COMPRESSED_HTML_ENCODINGS:
+            if encoding in accept_encoding and os.path.exists(html_path + extension):
+                return html_path + extension, encoding
+        return html_path, None
+
+    def get_web_path(self):
+        return os.path.dirname(self.get_data_file_path(root="/scores", createDirs=False))
+
+    # what rendering the segments of a page sent without them needs - see segments()
+    def get_segments_context_path(self):
+        return self.get_html_file_path() + '.segments.json'
+
+    def get_segment_file_path(self, start_bar, end_bar):
+        return "%s.bars-%d-%d.html" % (os.path.splitext(self.get_html_file_path())[0], start_bar, end_bar)
+
+    # makes the talking score html if it hasn't been made - returns the path of the html file.
+    # progress - optional function(stage, current=None, total=None) - see HTMLTalkingScoreFormatter
+    def html(self, progress=None):
+        html_path = self.get_html_file_path()
         if not os.path.exists(html_path):
-            mxmlScore = Music21TalkingScore(data_path)
-            tsf = HTMLTalkingScoreFormatter(mxmlScore)
-            html = tsf.generateHTML(output_path=os.path.dirname(html_path), web_path=web_path)
-            with open(html_path, "w") as fh:
-                fh.write(html)
+            for chunk in self.stream_html(progress=progress):
+                pass
         else:
             self.logger.info("Score already processed, fetching existing HTML")
-            with open(html_path, 'r') as html_fh:
-                html = html_fh.read()
-        return html
+            artefacts.touch(html_path)
+        return html_path
+
+    # makes the talking score html - returns an iterator of chunks (utf-8 bytes) of it as it is rendered, so it can be sent while it is being made.
+    # The score is parsed and analysed before this returns - the segments are described as the chunks are asked for.
+    # The chunks (and the compressed copies - see COMPRESSED_HTML_ENCODINGS) are written to temporary files which replace the html files once the page is finished.
+    # If the iterator is closed first (eg the browser went away) nothing is saved.
+    # A score with at least LAZY_SEGMENTS_MIN_BARS bars is made without its segments - the page fetches them from segments()
+    def stream_html(self, progress=None):
+        html_path = self.get_html_file_path()
+        if progress is not None:
+            progress("parsing")
+        mxmlScore = Music21TalkingScore(self.get_data_file_path())
+        tsf = HTMLTalkingScoreFormatter(mxmlScore, analysis_workers=ANALYSIS_WORKERS, segment_workers=SEGMENT_WORKERS, progress=progress)
+        segments_url = None
+        if LAZY_SEGMENTS_MIN_BARS > 0 and mxmlScore.get_number_of_bars() >= LAZY_SEGMENTS_MIN_BARS:
+            segments_url = reverse('segments', args=[self.id, self.filename])
+        chunks = tsf.stream_html(output_path=os.path.dirname(html_path), web_path=self.get_web_path(), segments_url=segments_url)
+        return self._write_html_chunks(tsf, chunks, segments_url is not None)
+
+    def _write_html_chunks(self, tsf, chunks, lazy_segments):
+        html_path = self.get_html_file_path()
+        paths = {html_path: None}
+        paths.update((html_path + extension, make_compressor) for encoding, extension, make_compressor in COMPRESSED_HTML_ENCODINGS)
+        writer = ChunkedFileWriter(paths)
+        try:
+            for chunk in join_chunks(chunks):
+                data = chunk.encode('utf-8')
+                writer.write(data)
+                yield data
+
+            # segments rendered for the last page made from the score are out of date - the lock waits for any that are being rendered (see segments())
+            with path_lock(self.get_segments_context_path(), LOCK_DIR):
+                for segment_path in glob.glob(glob.escape(os.path.splitext(html_path)[0]) + '.bars-*.html'):
+                    os.remove(segment_path)
+                if lazy_segments:
+                    write_file(self.get_segments_context_path(), json.dumps(tsf.get_segment_context()).encode('utf-8'))
+                writer.commit()  # the html before its compressed copies - so they are newer than it
+        except BaseException:
+            writer.abort()
+            raise
+        artefacts.touch(html_path)
+
+    # for a page made without its segments (see html()) - returns ([(start bar, end bar, html)], start bar of the next segment or None)
+    # for the segments that start in bars from_bar to to_bar - at most MAX_SEGMENTS_PER_REQUEST of them.
+    # A segment is rendered the first time it is asked for and kept in a file - so the score is only loaded if one of them hasn't been rendered yet
+    def segments(self, from_bar, to_bar):
+        with open(self.get_segments_context_path(), 'r') as context_fh:
+            context = json.load(context_fh)
+        bar_ranges = [bar_range for bar_range in context['bar_ranges'] if from_bar <= bar_range[0] <= to_bar]
+        next_bar = bar_ranges[MAX_SEGMENTS_PER_REQUEST][0] if len(bar_ranges) > MAX_SEGMENTS_PER_REQUEST else None
+        bar_ranges = bar_ranges[:MAX_SEGMENTS_PER_REQUEST]
+
+        rendered = {}
+        missing = self._read_segments(bar_ranges, rendered)
+        if len(missing) > 0:
+            # one request at a time renders the score's segments - another request for them waits and then reads the files
+            with path_lock(self.get_segments_context_path(), LOCK_DIR):
+                missing = self._read_segments(missing, rendered)
+                if len(missing) > 0:
+                    tsf = HTMLTalkingScoreFormatter(Music21TalkingScore(self.get_data_file_path()), options=RenderOptions.from_dict(context['options']))
+                    for start_bar, end_bar, html in tsf.render_segments(missing, context, output_path=os.path.dirname(self.get_html_file_path()), web_path=self.get_web_path()):
+                        write_file(self.get_segment_file_path(start_bar, end_bar), html.encode('utf-8'))
+                        rendered[start_bar] = html
+        return [(start_bar, end_bar, rendered[start_bar]) for start_bar, end_bar in bar_ranges], next_bar
+
+    # reads the rendered segments of bar_ranges that have files into rendered {start bar, html} - returns the bar ranges that don't
+    def _read_segments(self, bar_ranges, rendered):
+        missing = []
+        for start_bar, end_bar in bar_ranges:
+            segment_path = self.get_segment_file_path(start_bar, end_bar)
+            try:
+                with open(segment_path, 'r') as segment_fh:
+                    rendered[start_bar] = segment_fh.read()
+                artefacts.touch(segment_path)
+            except FileNotFoundError:
+                missing.append([start_bar, end_bar])
+        return missing
 
     @classmethod
     def from_uploaded_file(cls, uploaded_file):
@@ -166,14 +361,15 @@ class TSScore(object):
             temporary_file.write(chunk)
         temporary_file.close()
 
-        # Validate this file is loadable
+        # Validate this file is loadable - the parsed score is cached in the directory the file will be stored in, so the options page etc don't parse it again
+        score_id = hash_file(temporary_file.name)
         try:
-            mxml_score = Music21TalkingScore(temporary_file.name)
+            mxml_score = Music21TalkingScore(temporary_file.name, cache_dir=os.path.join(MEDIA_ROOT, score_id))
         except Exception as ex:
             logger.exception("Unparsable file: %s" % temporary_file.name + " --- " + str(ex))
             raise ex
 
-        score = TSScore(filename=os.path.basename(sanitize_filename(uploaded_file.name.replace("'", "").replace("\"", ""))))
+        score = TSScore(id=score_id, filename=os.path.basename(sanitize_filename(uploaded_file.name.replace("'", "").replace("\"", ""))))
         score.store(temporary_file.name, score.filename)
 
         return score
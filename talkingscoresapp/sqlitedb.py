@@ -0,0 +1,15 @@
+import sqlite3
+
+"""
+The SQLite databases the app keeps in MEDIA_ROOT - the job queue (see jobs.py) and the record of when generated files were used (see artefacts.py).
+They are shared by every process, so they use write-ahead logging - readers don't block the writer.
+"""
+
+
+# a connection to the database at path - creating the table (create_table is a CREATE TABLE IF NOT EXISTS statement) the first time
+def connect(path, create_table):
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)  # autocommit - transactions are started explicitly
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(create_table)
+    return connection
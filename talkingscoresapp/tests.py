@@ -1,3 +1,790 @@
-from django.test import TestCase
+import io
+import os
+import glob
+import gzip
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import tempfile
+import contextlib
+from unittest import mock
+from django.test import SimpleTestCase, RequestFactory
+from django.urls import reverse
+from music21 import midi, converter, note, stream, tempo
 
-# Create your tests here.
+from lib.measureRepetition import make_measure_string, suffix_array, lcp_array, find_measure_groups, MeasureGroupIndex
+from lib import midiEncoder
+from lib.tempoMap import TempoMap
+from lib.scoreCache import ParsedScoreCache
+from talkingscores.settings import BASE_DIR, MEDIA_ROOT, STATIC_ROOT
+from talkingscoresapp.views import make_etag, get_accepted_encodings, score_html_response
+from talkingscoresapp.models import TSScore, MAX_SEGMENTS_PER_REQUEST
+from talkingscoresapp import artefacts, jobs
+from talkingscoreslib import Music21TalkingScore, HTMLTalkingScoreFormatter
+
+
+# indexes_all like AnalysePart.measure_analyse_indexes_all - from the unique measure used by each bar.  bars - {measure number, unique measure}
+def make_indexes_all(bars):
+    return {number: [unique, 0] for number, unique in bars.items()}
+
+
+class MeasureRepetitionTests(SimpleTestCase):
+    def test_suffix_array_matches_sorting_the_suffixes(self):
+        for symbols in ([3, 1, 2, 1, 2, 1], [0, 0, 0, 0], [5], [1, 2, 3, 1, 2, 3, 1, 2, 4, -1, 1, 2]):
+            expected = sorted(range(len(symbols)), key=lambda i: symbols[i:])
+            self.assertEqual(suffix_array(symbols), expected)
+
+    def test_lcp_array_matches_comparing_neighbouring_suffixes(self):
+        symbols = [1, 2, 3, 1, 2, 3, 1, 2, 4]
+        sa = suffix_array(symbols)
+        expected = [0]
+        for previous, current in zip(sa, sa[1:]):
+            length = 0
+            while current + length < len(symbols) and previous + length < len(symbols) and symbols[current + length] == symbols[previous + length]:
+                length += 1
+            expected.append(length)
+        self.assertEqual(lcp_array(symbols, sa), expected)
+
+    def test_smaller_group_inside_larger_group(self):
+        # bars 1 to 8 are played again at 9 to 16, then bars 1 to 4 again at 17 to 20
+        tune = [0, 1, 2, 3, 4, 5, 6, 7]
+        uniques = tune + tune + tune[:4] + [8, 9]
+        groups = find_measure_groups(make_indexes_all({number: unique for number, unique in enumerate(uniques, start=1)}))
+        self.assertEqual(groups, [[[1, 8], [9, 16]], [[1, 4], [17, 20]]])
+
+    def test_adjacent_repeat(self):
+        groups = find_measure_groups(make_indexes_all({1: 0, 2: 1, 3: 0, 4: 1, 5: 2}))
+        self.assertEqual(groups, [[[1, 2], [3, 4]]])
+
+    def test_overlapping_repeat_is_shortened(self):
+        # the same bar six times - 1 to 3 is used again at 4 to 6 rather than 1 to 5 at 2 to 6
+        groups = find_measure_groups(make_indexes_all({number: 0 for number in range(1, 7)}))
+        self.assertEqual(groups[0], [[1, 3], [4, 6]])
+
+    def test_repeats_dont_run_across_missing_measures(self):
+        # bar 3 isn't in the index (eg it has no notes)
+        bars = {1: 0, 2: 1, 4: 0, 5: 1, 6: 0, 7: 1}
+        measure_numbers, symbols = make_measure_string(make_indexes_all(bars))
+        self.assertEqual(measure_numbers, [1, 2, None, 4, 5, 6, 7])
+        self.assertEqual(find_measure_groups(make_indexes_all(bars)), [[[1, 2], [4, 5], [6, 7]]])
+
+    def test_no_groups_without_repeats(self):
+        self.assertEqual(find_measure_groups(make_indexes_all({1: 0, 2: 1, 3: 2, 4: 3})), [])
+        self.assertEqual(find_measure_groups({}), [])
+
+    def test_measure_group_index(self):
+        index = MeasureGroupIndex([[[1, 8], [9, 16]], [[1, 4], [17, 20]]])
+        self.assertTrue(index.contains(1))
+        self.assertTrue(index.contains(20))
+        self.assertFalse(index.contains(21))
+        self.assertTrue(index.contains_both(6, 2))
+        self.assertFalse(index.contains_both(8, 9))
+        self.assertFalse(index.contains_both(16, 17))
+        self.assertFalse(MeasureGroupIndex([]).contains(1))
+
+
+# the events of each track of a midi file as read by music21 - [(tick, event type name, channel, data)] where data is (pitch, velocity) for notes
+def read_midi_events(midi_data):
+    midi_file = midi.MidiFile()
+    midi_file.readstr(midi_data)
+    tracks = []
+    for track in midi_file.tracks:
+        tick = 0
+        events = []
+        for event in track.events:
+            if event.isDeltaTime():
+                tick += event.time
+            elif event.isNoteOn() or event.isNoteOff():
+                events.append((tick, event.type.name, event.channel, (event.pitch, event.velocity)))
+            else:
+                events.append((tick, event.type.name, event.channel, event.data))
+        tracks.append(events)
+    return midi_file, tracks
+
+
+# two notes of a part and a click - at quarter_bpm
+def make_midi_file(quarter_bpm=120):
+    tempo_track = [(0, midiEncoder.EVENT_TIME_SIGNATURE, (3, 4)), midiEncoder.tempo_event(0, quarter_bpm)]
+    # given out of order - the same pitch is played again straight away so its note off must come first
+    part_track = midiEncoder.note_events(10080, 20160, 0, 62, 90) + midiEncoder.note_events(0, 10080, 0, 62, 80)
+    part_track += [(0, midiEncoder.EVENT_PROGRAM, (0, 73)), (0, midiEncoder.EVENT_TRACK_NAME, "Flauto")]
+    click_track = midiEncoder.note_events(0, 5040, midiEncoder.CLICK_CHANNEL, midiEncoder.CLICK_FIRST_BEAT_PITCH, midiEncoder.CLICK_VELOCITY)
+    return midiEncoder.encode_midi_file([tempo_track, part_track, click_track])
+
+
+class ParsedScoreCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.path = os.path.join(self.directory, 'flute.musicxml')
+        shutil.copy(os.path.join(BASE_DIR, 'test_scores', 'G1A1-flute-part.xml'), self.path)
+
+    def test_loads_from_the_pickle(self):
+        first = ParsedScoreCache().load(self.path)
+        pickles = [f for f in os.listdir(self.directory) if f.endswith('.p')]
+        self.assertEqual(len(pickles), 1)
+        with mock.patch('lib.scoreCache.converter.parse') as parse:
+            second = ParsedScoreCache().load(self.path)
+        parse.assert_not_called()
+        self.assertIsNot(first, second)
+        self.assertEqual(len(second.parts), len(first.parts))
+
+    def test_damaged_pickle_is_parsed_again(self):
+        ParsedScoreCache().load(self.path)
+        pickle_path = os.path.join(self.directory, [f for f in os.listdir(self.directory) if f.endswith('.p')][0])
+        with open(pickle_path, 'wb') as fh:
+            fh.write(b'not a pickle')
+        with self.assertLogs("TSScore", level='ERROR'):
+            score = ParsedScoreCache().load(self.path)
+        self.assertEqual(len(score.parts), 1)
+        with open(pickle_path, 'rb') as fh:
+            self.assertNotEqual(fh.read(), b'not a pickle')  # replaced
+
+
+class MidiEncoderTests(SimpleTestCase):
+
+    def test_round_trip_through_music21(self):
+        midi_file, tracks = read_midi_events(make_midi_file())
+        self.assertEqual(midi_file.format, 1)
+        self.assertEqual(midi_file.ticksPerQuarterNote, midiEncoder.TICKS_PER_QUARTER)
+        self.assertEqual(len(tracks), 3)
+        # 500000 microseconds per quarter note = 120 bpm.  music21 channels are 1 based
+        self.assertEqual(tracks[0], [(0, 'SET_TEMPO', None, (500000).to_bytes(3, 'big')), (0, 'TIME_SIGNATURE', None, bytes((3, 2, 24, 8))), (0, 'END_OF_TRACK', None, b'')])
+        self.assertEqual(tracks[1], [(0, 'SEQUENCE_TRACK_NAME', None, b'Flauto'),
+                                     (0, 'PROGRAM_CHANGE', 1, 73),
+                                     (0, 'NOTE_ON', 1, (62, 80)),
+                                     (10080, 'NOTE_OFF', 1, (62, 0)),
+                                     (10080, 'NOTE_ON', 1, (62, 90)),
+                                     (20160, 'NOTE_OFF', 1, (62, 0)),
+                                     (20160, 'END_OF_TRACK', None, b'')])
+        self.assertEqual(tracks[2][:2], [(0, 'NOTE_ON', 10, (midiEncoder.CLICK_FIRST_BEAT_PITCH, midiEncoder.CLICK_VELOCITY)), (5040, 'NOTE_OFF', 10, (midiEncoder.CLICK_FIRST_BEAT_PITCH, 0))])
+
+    def test_notes_read_back_as_a_stream(self):
+        score = converter.parse(make_midi_file(), format='midi')
+        notes = list(score.parts[0].flatten().getElementsByClass(note.Note))
+        self.assertEqual([(n.pitch.midi, float(n.offset), float(n.quarterLength)) for n in notes], [(62, 0.0, 1.0), (62, 1.0, 1.0)])
+        self.assertEqual(score.metronomeMarkBoundaries()[0][2].number, 120)
+
+    def test_long_delta_times_and_names(self):
+        # a delta time that needs the longest (4 byte) variable length quantity and a name that isn't ascii
+        track = [(0, midiEncoder.EVENT_TRACK_NAME, "Flûte")] + midiEncoder.note_events(0, 200000000, 0, 60, 64)
+        midi_file, tracks = read_midi_events(midiEncoder.encode_midi_file([[midiEncoder.tempo_event(0, 60)], track]))
+        self.assertEqual(tracks[1][0][3], "Flûte".encode('utf-8'))
+        self.assertEqual(tracks[1][2], (200000000, 'NOTE_OFF', 1, (60, 0)))
+
+    def test_values_are_clamped(self):
+        track = midiEncoder.note_events(0, 10, 0, 130, 0)
+        midi_file, tracks = read_midi_events(midiEncoder.encode_midi_file([[], track]))
+        self.assertEqual(tracks[1][0], (0, 'NOTE_ON', 1, (127, 1)))  # velocity 0 would be a note off
+
+
+class ScaleTempoTests(SimpleTestCase):
+    def test_only_the_tempo_changes(self):
+        original = make_midi_file()
+        scaled = midiEncoder.scale_tempo(original, 0.5)
+        self.assertEqual(len(scaled), len(original))
+        original_tracks = read_midi_events(original)[1]
+        scaled_tracks = read_midi_events(scaled)[1]
+        self.assertEqual(scaled_tracks[0][0], (0, 'SET_TEMPO', None, (1000000).to_bytes(3, 'big')))
+        self.assertEqual(scaled_tracks[0][1:], original_tracks[0][1:])
+        self.assertEqual(scaled_tracks[1:], original_tracks[1:])
+
+    def test_same_as_encoding_at_the_new_tempo(self):
+        for scale, quarter_bpm in ((0.5, 60), (1.5, 180), (4, 480)):
+            self.assertEqual(midiEncoder.scale_tempo(make_midi_file(120), scale), make_midi_file(quarter_bpm))
+
+    def test_running_status_and_tempo_changes_within_a_track(self):
+        # written by hand - the note offs are note ons with velocity 0 using running status, the tempo changes after the first note and there is a sysex event
+        events = bytes((0x00, 0xC0, 0x00,
+                        0x00, 0x90, 60, 64,
+                        0x60, 60, 0,
+                        0x00, 0xFF, 0x51, 0x03)) + (500000).to_bytes(3, 'big') + bytes((
+                        0x00, 0x90, 62, 64,
+                        0x60, 62, 0,
+                        0x00, 0xF0, 0x02, 0x7E, 0xF7,
+                        0x00, 0xFF, 0x2F, 0x00))
+        original = b'MThd' + bytes((0, 0, 0, 6, 0, 0, 0, 1, 0, 96)) + b'MTrk' + len(events).to_bytes(4, 'big') + events
+        scaled = midiEncoder.scale_tempo(original, 2)
+        self.assertEqual(scaled, original.replace((500000).to_bytes(3, 'big'), (250000).to_bytes(3, 'big')))
+        self.assertEqual([e for e in read_midi_events(scaled)[1][0] if e[1] == 'NOTE_ON'], [(0, 'NOTE_ON', 1, (60, 64)), (96, 'NOTE_ON', 1, (60, 0)), (96, 'NOTE_ON', 1, (62, 64)), (192, 'NOTE_ON', 1, (62, 0))])
+
+    def test_tempo_added_when_there_isnt_one(self):
+        original = midiEncoder.encode_midi_file([[(0, midiEncoder.EVENT_TIME_SIGNATURE, (4, 4))], midiEncoder.note_events(0, 10080, 0, 60, 64)])
+        scaled = midiEncoder.scale_tempo(original, 2)
+        tracks = read_midi_events(scaled)[1]
+        # a file without a tempo plays at 120 bpm - 500000 microseconds per quarter note
+        self.assertEqual(tracks[0][0], (0, 'SET_TEMPO', None, (250000).to_bytes(3, 'big')))
+        self.assertEqual(tracks[0][1:], read_midi_events(original)[1][0])
+        self.assertEqual(tracks[1], read_midi_events(original)[1][1])
+
+    def test_not_a_midi_file(self):
+        with self.assertRaises(ValueError):
+            midiEncoder.scale_tempo(b'RIFF0000', 2)
+
+
+class TempoMapTests(SimpleTestCase):
+    TEMPOS = [(0.0, 8.0, 'a'), (8.0, 20.0, 'b'), (20.0, 40.0, 'c')]
+
+    def test_boundaries(self):
+        tempo_map = TempoMap(self.TEMPOS)
+
+        def names(offset, length):
+            return [t[2] for t in tempo_map.overlapping(offset, length)]
+
+        self.assertEqual(names(2, 4), ['a'])
+        self.assertEqual(names(4, 4), ['a'])  # ends where b starts
+        self.assertEqual(names(8, 4), ['b'])  # starts where a ends
+        self.assertEqual(names(7.5, 1), ['a', 'b'])
+        self.assertEqual(names(0, 40), ['a', 'b', 'c'])
+        self.assertEqual(names(-4, 4), [])
+        self.assertEqual(names(40, 4), [])
+        self.assertEqual(TempoMap([]).overlapping(0, 4), [])
+
+    def test_same_as_looking_through_every_tempo(self):
+        tempo_map = TempoMap(self.TEMPOS)
+        for offset in range(-2, 44):
+            for length in (0.5, 1, 4, 12, 50):
+                expected = [t for t in self.TEMPOS if t[1] > offset and t[0] < offset + length]
+                self.assertEqual(tempo_map.overlapping(offset, length), expected, (offset, length))
+
+    def test_from_score(self):
+        part = stream.Part()
+        part.insert(0, tempo.MetronomeMark(number=60))
+        part.insert(4, tempo.MetronomeMark(number=90))
+        part.insert(0, note.Note('C4', quarterLength=8))
+        tempo_map = TempoMap.from_score(part)
+        self.assertEqual([(start, end, mm.number) for start, end, mm in tempo_map.tempos], [(0.0, 4.0, 60), (4.0, 8.0, 90)])
+        self.assertEqual([mm.number for start, end, mm in tempo_map.overlapping(3, 2)], [60, 90])
+
+
+class AcceptedEncodingsTests(SimpleTestCase):
+    def get(self, accept_encoding):
+        return get_accepted_encodings(RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding))
+
+    def test_encodings(self):
+        self.assertEqual(self.get("gzip, deflate, br"), {'gzip', 'deflate', 'br'})
+        self.assertEqual(self.get("GZip;q=0.5 ,  br;q=1.0"), {'gzip', 'br'})
+        self.assertEqual(self.get(""), set())
+        self.assertEqual(get_accepted_encodings(RequestFactory().get('/')), set())
+
+    def test_q_0_is_not_acceptable(self):
+        self.assertEqual(self.get("gzip;q=0, br"), {'br'})
+        self.assertEqual(self.get("gzip; q=0.0, br;q=0.000"), set())
+        self.assertEqual(self.get("gzip;q=0.001"), {'gzip'})
+        self.assertEqual(self.get("gzip;q=abc"), {'gzip'})  # an invalid q is ignored
+
+
+# a score in MEDIA_ROOT made from one of test_scores - removed again after the tests
+class MidiViewTests(SimpleTestCase):
+    SCORE = os.path.join(BASE_DIR, 'test_scores', 'G1A1-flute-part.xml')
+    QUERY = "sel=all&start=1&end=4&c=n&bsi=3&bpi=8"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.id = "test-" + uuid.uuid4().hex
+        os.makedirs(os.path.join(MEDIA_ROOT, cls.id))
+        os.makedirs(os.path.join(BASE_DIR, STATIC_ROOT, 'data', cls.id))
+        shutil.copy(cls.SCORE, os.path.join(MEDIA_ROOT, cls.id, 'flute.musicxml'))
+        cls.prefetch = mock.patch('lib.midiHandler.MIDI_PREFETCH', False)
+        cls.prefetch.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.prefetch.stop()
+        shutil.rmtree(os.path.join(MEDIA_ROOT, cls.id), ignore_errors=True)
+        shutil.rmtree(os.path.join(BASE_DIR, STATIC_ROOT, 'data', cls.id), ignore_errors=True)
+        super().tearDownClass()
+
+    def get(self, query, **headers):
+        return self.client.get('/midis/%s/flute.mid?%s' % (self.id, query), **headers)
+
+    def test_etag_and_conditional_get(self):
+        response = self.get(self.QUERY + "&t=100")
+        self.assertEqual(response.status_code, 200)
+        midi_data = b''.join(response.streaming_content)
+        self.assertEqual(midi_data[:4], b'MThd')
+        etag = response['ETag']
+        self.assertRegex(etag, r'^"[0-9a-f]{32}"$')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.get(self.QUERY + "&t=100", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.get(self.QUERY + "&t=50", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_is_from_the_query_string(self):
+        response = self.get(self.QUERY + "&t=100")
+        etag = response['ETag']
+        midi_data = b''.join(response.streaming_content)
+        self.assertEqual(self.get("t=100&bpi=8&bsi=3&c=n&end=4&start=1&sel=all")['ETag'], etag)  # the same query in another order
+        self.assertNotEqual(self.get(self.QUERY.replace("bpi=8", "bpi=12") + "&t=100")['ETag'], etag)  # the same file name
+
+        # made again after being deleted - the same file and the same ETag
+        midi_paths = glob.glob(os.path.join(BASE_DIR, STATIC_ROOT, 'data', self.id, '*sel-alls1e4cnt100.mid'))
+        self.assertEqual(len(midi_paths), 1)
+        os.remove(midi_paths[0])
+        with mock.patch('lib.midiHandler.MidiHandler.get_or_make_midi_file') as get_or_make_midi_file:
+            self.assertEqual(self.get(self.QUERY + "&t=100", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        get_or_make_midi_file.assert_not_called()
+        self.assertFalse(os.path.exists(midi_paths[0]))
+        response = self.get(self.QUERY + "&t=100")
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(b''.join(response.streaming_content), midi_data)
+
+    def test_bad_query_strings(self):
+        for query in (self.QUERY + "&t=fast", self.QUERY + "&t=1000", "sel=all&start=1&end=4&c=n&bpi=8", "sel=all&start=one&end=4&c=n&bsi=3&bpi=8",
+                      "sel=all&start=1&end=4&c=n&bsi=1&bpi=8", "part=5&start=1&end=4&c=n&bsi=3&bpi=8", "start=1&end=4&c=n&bsi=3&bpi=8"):
+            with self.subTest(query=query):
+                self.assertEqual(self.get(query).status_code, 400)
+
+    def test_other_errors_arent_bad_requests(self):
+        with mock.patch('lib.midiHandler.ScoreTimeline.make_midi', side_effect=ValueError("a fault")):
+            with self.assertRaises(ValueError):
+                self.get(self.QUERY + "&t=100&part=0")
+
+    def test_make_etag(self):
+        self.assertEqual(make_etag('id', 'name.mid', [('t', ['100'])]), make_etag('id', 'name.mid', [('t', ['100'])]))
+        self.assertNotEqual(make_etag('id', 'name.mid', [('t', ['100'])]), make_etag('id', 'name.mid', [('t', ['50'])]))
+
+
+# .opts for the render tests - between them they use each choice on the options page
+RENDER_OPTIONS = {
+    'default': {"bars_at_a_time": 4, "play_all": True, "play_selected": True, "play_unselected": True, "instruments": [1, 2, 3, 4, 5, 6, 7, 8],
+                "pitch_description": "noteName", "rhythm_description": "british", "dot_position": "before", "rhythm_announcement": "onChange",
+                "octave_description": "name", "octave_position": "before", "octave_announcement": "onChange",
+                "colour_position": "none", "colour_pitch": False, "colour_rhythm": False, "colour_octave": False},
+    'coloured': {"bars_at_a_time": 2, "play_all": True, "play_selected": True, "play_unselected": True, "instruments": [1],
+                 "pitch_description": "colourNotes", "rhythm_description": "american", "dot_position": "after", "rhythm_announcement": "everyNote",
+                 "octave_description": "number", "octave_position": "after", "octave_announcement": "everyNote",
+                 "colour_position": "background", "colour_pitch": True, "colour_rhythm": True, "colour_octave": True},
+    'phonetic': {"bars_at_a_time": 8, "play_all": False, "play_selected": True, "play_unselected": False, "instruments": [1, 2, 3, 4, 5, 6, 7, 8],
+                 "pitch_description": "phonetic", "rhythm_description": "none", "dot_position": "before", "rhythm_announcement": "onChange",
+                 "octave_description": "name", "octave_position": "before", "octave_announcement": "brailleRules",
+                 "colour_position": "text", "colour_pitch": True, "colour_rhythm": False, "colour_octave": False},
+}
+
+
+# The talking scores of test_scores/*.xml with each of RENDER_OPTIONS must stay byte for byte the same when the rendering is only meant to get faster -
+# eg describing the segments in processes, streaming the page, the render profiles and the slotted events.
+# RENDERED_HTML_PATH has the sha256 of each page (made with the music21 version in requirements.txt).  If a change is meant to change the pages, the failures give the new digests
+class RenderRegressionTests(SimpleTestCase):
+    RENDERED_HTML_PATH = os.path.join(BASE_DIR, 'test_scores', 'rendered_html_sha256.json')
+    SCORES_DIR = os.path.join(BASE_DIR, 'test_scores')
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.temporary_dir = tempfile.mkdtemp()
+        with open(cls.RENDERED_HTML_PATH) as fh:
+            cls.rendered_html = json.load(fh)
+        cls.logger = logging.getLogger("TSScore")
+        cls.logger_level = cls.logger.level
+        cls.logger.setLevel(logging.WARNING)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.logger.setLevel(cls.logger_level)
+        shutil.rmtree(cls.temporary_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def render(self, score_filename, options_name, **workers):
+        directory = os.path.join(self.temporary_dir, options_name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, score_filename)
+        shutil.copy(os.path.join(self.SCORES_DIR, score_filename), path)
+        with open(path + '.opts', 'w') as fh:
+            json.dump(RENDER_OPTIONS[options_name], fh)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return HTMLTalkingScoreFormatter(Music21TalkingScore(path), **workers).generateHTML(output_path=directory, web_path='/static/data/regression')
+
+    def test_rendered_html_is_unchanged(self):
+        for score_filename, digests in sorted(self.rendered_html.items()):
+            for options_name, digest in sorted(digests.items()):
+                with self.subTest(score=score_filename, options=options_name):
+                    html = self.render(score_filename, options_name)
+                    self.assertEqual(hashlib.sha256(html.encode('utf-8')).hexdigest(), digest)
+
+    def test_every_test_score_is_checked(self):
+        scores = sorted(f for f in os.listdir(self.SCORES_DIR) if f.endswith('.xml'))
+        self.assertEqual(sorted(self.rendered_html), scores)
+        for digests in self.rendered_html.values():
+            self.assertEqual(sorted(digests), sorted(RENDER_OPTIONS))
+
+    def test_processes_render_the_same_html(self):
+        score_filename = 'macdowell-to-a-wild-rose.xml'
+        for options_name in ('default', 'coloured'):
+            with self.subTest(options=options_name):
+                html = self.render(score_filename, options_name, analysis_workers=2, segment_workers=2)
+                self.assertEqual(hashlib.sha256(html.encode('utf-8')).hexdigest(), self.rendered_html[score_filename][options_name])
+
+    # the worker processes describe the segments with the options the page was started with - not the .opts file saved again since
+    def test_processes_use_the_options_of_the_page(self):
+        score_filename = 'macdowell-to-a-wild-rose.xml'
+        directory = os.path.join(self.temporary_dir, 'saved-again')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, score_filename)
+        shutil.copy(os.path.join(self.SCORES_DIR, score_filename), path)
+        with open(path + '.opts', 'w') as fh:
+            json.dump(RENDER_OPTIONS['coloured'], fh)
+        tsf = HTMLTalkingScoreFormatter(Music21TalkingScore(path), segment_workers=2)
+        with open(path + '.opts', 'w') as fh:
+            json.dump(RENDER_OPTIONS['phonetic'], fh)
+        with contextlib.redirect_stdout(io.StringIO()):
+            html = tsf.generateHTML(output_path=directory, web_path='/static/data/regression')
+        self.assertEqual(hashlib.sha256(html.encode('utf-8')).hexdigest(), self.rendered_html[score_filename]['coloured'])
+
+    # the page streamed by TSScore while it is made is the same as the file it writes - and the same as rendering it all at once
+    def test_streamed_page(self):
+        id = "test-" + uuid.uuid4().hex
+        filename = 'flute.musicxml'
+        score_dir = os.path.join(MEDIA_ROOT, id)
+        data_dir = os.path.join(BASE_DIR, STATIC_ROOT, 'data', id)
+        os.makedirs(score_dir)
+        self.addCleanup(shutil.rmtree, score_dir, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, data_dir, ignore_errors=True)
+        shutil.copy(os.path.join(self.SCORES_DIR, 'G1A1-flute-part.xml'), os.path.join(score_dir, filename))
+        with open(os.path.join(score_dir, filename + '.opts'), 'w') as fh:
+            json.dump(RENDER_OPTIONS['coloured'], fh)
+
+        score = TSScore(id=id, filename=filename)
+        with contextlib.redirect_stdout(io.StringIO()):
+            chunks = list(score.stream_html())
+            html = HTMLTalkingScoreFormatter(Music21TalkingScore(os.path.join(score_dir, filename))).generateHTML(output_path=data_dir, web_path=score.get_web_path())
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), html.encode('utf-8'))
+        with open(score.get_html_file_path(), 'rb') as fh:
+            self.assertEqual(fh.read(), html.encode('utf-8'))
+
+
+# a long score made without its segments (see TSScore.stream_html) - they are fetched from the segments view
+class SegmentsViewTests(SimpleTestCase):
+    SCORE = os.path.join(BASE_DIR, 'test_scores', 'macdowell-to-a-wild-rose.xml')
+    FILENAME = 'macdowell.musicxml'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.logger = logging.getLogger("TSScore")
+        cls.logger_level = cls.logger.level
+        cls.logger.setLevel(logging.WARNING)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.logger.setLevel(cls.logger_level)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.id = "test-" + uuid.uuid4().hex
+        self.score = TSScore(id=self.id, filename=self.FILENAME)
+        score_dir = os.path.join(MEDIA_ROOT, self.id)
+        self.addCleanup(shutil.rmtree, score_dir, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, os.path.join(BASE_DIR, STATIC_ROOT, 'data', self.id), ignore_errors=True)
+
+    # makes the page without its segments - returns the page made with all of them, with the same options
+    def make_page(self, options_name):
+        os.makedirs(os.path.join(MEDIA_ROOT, self.id))
+        path = os.path.join(MEDIA_ROOT, self.id, self.FILENAME)
+        shutil.copy(self.SCORE, path)
+        with open(path + '.opts', 'w') as fh:
+            json.dump(RENDER_OPTIONS[options_name], fh)
+        with contextlib.redirect_stdout(io.StringIO()), mock.patch('talkingscoresapp.models.LAZY_SEGMENTS_MIN_BARS', 1):
+            for chunk in self.score.stream_html():
+                pass
+            return HTMLTalkingScoreFormatter(Music21TalkingScore(path)).generateHTML(output_path=os.path.dirname(self.score.get_html_file_path()), web_path=self.score.get_web_path())
+
+    def get(self, **query):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.client.get(reverse('segments', args=[self.id, self.FILENAME]), query)
+
+    # every segment of the page - following next
+    def get_all_segments(self):
+        segments = []
+        query = {'from': 0}
+        while True:
+            response = self.get(**query)
+            self.assertEqual(response.status_code, 200)
+            result = response.json()
+            self.assertLessEqual(len(result['segments']), MAX_SEGMENTS_PER_REQUEST)
+            segments += result['segments']
+            if result['next'] is None:
+                return segments
+            self.assertEqual(result['next'], result['segments'][-1]['to'] + 1)
+            query = {'from': result['next']}
+
+    def test_segments_are_the_same_as_the_page_made_with_them(self):
+        eager_html = self.make_page('coloured')
+        with open(self.score.get_segments_context_path()) as fh:
+            bar_ranges = json.load(fh)['bar_ranges']
+        self.assertGreater(len(bar_ranges), MAX_SEGMENTS_PER_REQUEST)  # so there is a next page
+        segments = self.get_all_segments()
+        self.assertEqual([[s['from'], s['to']] for s in segments], bar_ranges)
+        for segment in segments:
+            self.assertIn(segment['html'], eager_html)
+        # the second time they are read from the files
+        with mock.patch('talkingscoresapp.models.Music21TalkingScore') as talking_score:
+            self.assertEqual(self.get_all_segments(), segments)
+        talking_score.assert_not_called()
+
+    def test_segments_use_the_options_of_the_page(self):
+        eager_html = self.make_page('coloured')
+        with open(self.score.get_data_file_path() + '.opts', 'w') as fh:
+            json.dump(RENDER_OPTIONS['phonetic'], fh)  # saved again - but the page hasn't been made again yet
+        result = self.get(**{'from': 3, 'to': 6}).json()
+        self.assertEqual([(s['from'], s['to']) for s in result['segments']], [(3, 4), (5, 6)])
+        self.assertIsNone(result['next'])
+        for segment in result['segments']:
+            self.assertIn(segment['html'], eager_html)
+
+    def test_html_format(self):
+        eager_html = self.make_page('coloured')
+        response = self.get(**{'from': 0, 'format': 'html'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Robots-Tag'], "noindex")
+        html = response.content.decode('utf-8')
+        segments = self.get(**{'from': 0}).json()
+        for segment in segments['segments']:
+            self.assertIn(segment['html'], html)
+            self.assertIn(segment['html'], eager_html)
+        self.assertIn('?from=%d&amp;format=html' % segments['next'], html)
+
+    def test_bars_must_be_numbers(self):
+        self.make_page('coloured')
+        self.assertEqual(self.get(**{'from': 'one'}).status_code, 400)
+        self.assertEqual(self.get(**{'from': 1, 'to': '4.5'}).status_code, 400)
+
+    def test_no_segments(self):
+        self.assertEqual(self.get(**{'from': 0}).status_code, 404)
+
+
+# the generated files in a temporary DATA_ROOT / MEDIA_ROOT - each file is 100 bytes
+class ArtefactsTests(SimpleTestCase):
+    def setUp(self):
+        directory = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.data_root = os.path.join(directory, 'data')
+        self.media_root = os.path.join(directory, 'media')
+        for name, value in (('DATA_ROOT', self.data_root), ('MEDIA_ROOT', self.media_root), ('ARTEFACTS_DB_PATH', os.path.join(directory, 'artefacts.sqlite3')),
+                            ('ARTEFACTS_LOCK_PATH', os.path.join(directory, 'artefacts.lock'))):
+            patcher = mock.patch.object(artefacts, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for patcher in (mock.patch.object(artefacts, 'evict_in_background'), mock.patch.dict(artefacts._accessed, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.now = time.time()
+
+    # a file last used age seconds ago
+    def make_file(self, root, name, age=10000):
+        path = os.path.join(root, 'score', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(b'x' * 100)
+        os.utime(path, (self.now - age, self.now - age))
+        return path
+
+    def remaining(self, paths):
+        return [os.path.basename(path) for path in paths if os.path.exists(path)]
+
+    def test_is_artefact(self):
+        for name in ('a.html', 'a.html.gz', 'a.html.br', 'a.bars-1-4.html', 'a.mid'):
+            self.assertTrue(artefacts.is_artefact(self.make_file(self.data_root, name)), name)
+        self.assertTrue(artefacts.is_artefact(self.make_file(self.media_root, 'a.musicxml.p')))
+        for name in ('a.musicxml', 'a.musicxml.opts', 'a.html.segments.json'):
+            self.assertFalse(artefacts.is_artefact(self.make_file(self.data_root, name)), name)
+            self.assertFalse(artefacts.is_artefact(self.make_file(self.media_root, name)), name)
+        self.assertFalse(artefacts.is_artefact(self.make_file(self.media_root, 'a.html')))
+        self.assertFalse(artefacts.is_artefact(os.path.join(self.data_root, 'a.html')))  # not in a score's directory
+
+    def test_least_recently_used_are_deleted_until_below_the_low_water_mark(self):
+        paths = [self.make_file(self.data_root, '%d.mid' % age, age=age) for age in (5000, 9000, 6000, 8000, 7000)]
+        sources = [self.make_file(self.media_root, name) for name in ('a.musicxml', 'a.musicxml.opts')]
+        self.assertEqual(artefacts.evict(budget=500), 0)
+        self.assertEqual(len(self.remaining(paths)), 5)
+        # 500 bytes in a budget of 350 - deleted down to 315
+        self.assertEqual(artefacts.evict(budget=350), 200)
+        self.assertEqual(self.remaining(paths), ['5000.mid', '6000.mid', '7000.mid'])
+        self.assertEqual(len(self.remaining(sources)), 2)
+
+    def test_recently_used_files_are_kept(self):
+        paths = [self.make_file(self.data_root, '%d.mid' % age, age=age) for age in (artefacts.MIN_AGE * 2, artefacts.MIN_AGE // 2, 10)]
+        self.assertEqual(artefacts.evict(budget=0), 100)
+        self.assertEqual(self.remaining(paths), ['%d.mid' % (artefacts.MIN_AGE // 2), '10.mid'])
+
+    def test_served_files_are_ranked_by_their_records(self):
+        paths = [self.make_file(self.data_root, '%d.mid' % age, age=age) for age in (9000, 8000, 7000)]
+        with mock.patch('talkingscoresapp.artefacts.time.time', return_value=self.now - 6000):
+            artefacts.touch(paths[0])
+        artefacts._write_accessed()
+        self.assertEqual(artefacts._accessed, {})
+        self.assertEqual(artefacts.evict(budget=250), 100)
+        self.assertEqual(self.remaining(paths), ['9000.mid', '7000.mid'])
+        # records of files that have gone are forgotten
+        os.remove(paths[0])
+        artefacts.evict(budget=1000)
+        connection = artefacts._connect()
+        self.addCleanup(connection.close)
+        self.assertEqual(connection.execute("SELECT path FROM artefacts").fetchall(), [])
+
+    def test_touch_only_records_artefacts(self):
+        source = self.make_file(self.media_root, 'a.musicxml')
+        html = self.make_file(self.data_root, 'a.html')
+        artefacts.touch(source)
+        artefacts.touch(html)
+        self.assertEqual(list(artefacts._accessed), [html])
+
+
+# the job queue in a temporary JOBS_DB_PATH - the functions the workers use are called directly, so this process is the worker
+class JobQueueTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        for patcher in (mock.patch.object(jobs, 'JOBS_DB_PATH', os.path.join(directory, 'jobs.sqlite3')), mock.patch.object(jobs, 'JOB_WORKERS_AUTOSTART', False)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_job(self, score_id='a'):
+        connection = jobs._connect()
+        try:
+            return dict(connection.execute("SELECT * FROM jobs WHERE score_id=?", (score_id,)).fetchone())
+        finally:
+            connection.close()
+
+    def update_job(self, sql, parameters=(), score_id='a'):
+        connection = jobs._connect()
+        try:
+            connection.execute("UPDATE jobs SET " + sql + " WHERE score_id=?", tuple(parameters) + (score_id,))
+        finally:
+            connection.close()
+
+    # as if the worker stopped updating the job JOB_TIMEOUT seconds ago
+    def abandon(self, score_id='a'):
+        self.update_job("updated_at=?", (time.time() - jobs.JOB_TIMEOUT - 1,), score_id)
+
+    def test_claimed_in_the_order_queued(self):
+        jobs.enqueue('a', 'a.musicxml')
+        jobs.enqueue('b', 'b.musicxml')
+        self.assertEqual(jobs.get_status('b', 'b.musicxml'), {'status': jobs.JOB_QUEUED, 'segment': None, 'segments': None, 'position': 2})
+        self.assertEqual(jobs._claim_next(), ('a', 'a.musicxml'))
+        job = self.get_job()
+        self.assertEqual((job['status'], job['worker'], job['attempts']), (jobs.JOB_PARSING, os.getpid(), 1))
+        self.assertEqual(jobs.get_status('b', 'b.musicxml')['position'], 1)
+        self.assertEqual(jobs._claim_next(), ('b', 'b.musicxml'))
+        self.assertIsNone(jobs._claim_next())
+        self.assertIsNone(jobs.get_status('c', 'c.musicxml'))
+
+    def test_enqueue_doesnt_reset_a_queued_or_running_job(self):
+        jobs.enqueue('a', 'a.musicxml')
+        queued_at = self.get_job()['queued_at']
+        jobs.enqueue('a', 'a.musicxml')
+        self.assertEqual(self.get_job()['queued_at'], queued_at)
+        jobs._claim_next()
+        jobs._set_status('a', 'a.musicxml', jobs.JOB_RENDERING, 3, 10)
+        jobs.enqueue('a', 'a.musicxml')
+        job = self.get_job()
+        self.assertEqual((job['status'], job['segment'], job['segments'], job['worker'], job['attempts']), (jobs.JOB_RENDERING, 3, 10, os.getpid(), 1))
+
+    def test_enqueue_queues_a_finished_job_again(self):
+        for status in (jobs.JOB_DONE, jobs.JOB_ERROR):
+            with self.subTest(status=status):
+                jobs.enqueue('a', 'a.musicxml')
+                jobs._claim_next()
+                jobs._set_status('a', 'a.musicxml', status, error="failed")
+                jobs.enqueue('a', 'a.musicxml')
+                job = self.get_job()
+                self.assertEqual((job['status'], job['error'], job['worker'], job['attempts']), (jobs.JOB_QUEUED, None, None, 0))
+
+    def test_abandoned_job_is_claimed_again(self):
+        jobs.enqueue('a', 'a.musicxml')
+        jobs._claim_next()
+        jobs._set_status('a', 'a.musicxml', jobs.JOB_ANALYSING)
+        self.assertIsNone(jobs._claim_next())  # still being updated
+        self.abandon()
+        with self.assertLogs("TSScore", level='WARNING'):
+            self.assertEqual(jobs._claim_next(), ('a', 'a.musicxml'))
+        job = self.get_job()
+        self.assertEqual((job['status'], job['attempts']), (jobs.JOB_PARSING, 2))
+
+    def test_job_fails_after_max_attempts(self):
+        jobs.enqueue('a', 'a.musicxml')
+        for attempt in range(jobs.MAX_ATTEMPTS):
+            with self.assertLogs("TSScore", level='WARNING') if attempt > 0 else contextlib.nullcontext():
+                self.assertEqual(jobs._claim_next(), ('a', 'a.musicxml'))
+            self.abandon()
+        self.assertIsNone(jobs._claim_next())
+        job = self.get_job()
+        self.assertEqual((job['status'], job['worker'], job['attempts']), (jobs.JOB_ERROR, None, jobs.MAX_ATTEMPTS))
+        self.assertIn(str(jobs.MAX_ATTEMPTS), job['error'])
+
+    def test_requeue_abandoned_by_worker(self):
+        jobs.enqueue('a', 'a.musicxml')
+        jobs.enqueue('b', 'b.musicxml')
+        jobs._claim_next()
+        jobs._claim_next()
+        self.update_job("worker=?", (os.getpid() + 1,), 'b')
+        connection = jobs._connect()
+        try:
+            with self.assertLogs("TSScore", level='WARNING'):
+                jobs._requeue_abandoned(connection, "worker=?", (os.getpid() + 1,))
+        finally:
+            connection.close()
+        self.assertEqual(self.get_job('a')['status'], jobs.JOB_PARSING)
+        job = self.get_job('b')
+        self.assertEqual((job['status'], job['worker'], job['attempts']), (jobs.JOB_QUEUED, None, 1))
+
+    def test_replaced_worker_cant_change_the_job(self):
+        jobs.enqueue('a', 'a.musicxml')
+        jobs._claim_next()
+        self.update_job("worker=?", (os.getpid() + 1,))  # given up on and claimed by another worker
+        jobs._set_status('a', 'a.musicxml', jobs.JOB_DONE)
+        job = self.get_job()
+        self.assertEqual((job['status'], job['worker']), (jobs.JOB_PARSING, os.getpid() + 1))
+
+
+# the page of a score that has been made - sent from the html file or its compressed copy
+class ScoreHtmlResponseTests(SimpleTestCase):
+    HTML = b"<html>" + b"<p>Bar 1 - C quarter</p>" * 1000 + b"</html>"
+
+    def setUp(self):
+        self.id = "test-" + uuid.uuid4().hex
+        self.addCleanup(shutil.rmtree, os.path.join(MEDIA_ROOT, self.id), ignore_errors=True)
+        self.addCleanup(shutil.rmtree, os.path.join(BASE_DIR, STATIC_ROOT, 'data', self.id), ignore_errors=True)
+        self.score = TSScore(id=self.id, filename='flute.musicxml')
+        with open(self.score.get_data_file_path() + '.opts', 'w') as fh:
+            json.dump(RENDER_OPTIONS['default'], fh)
+        self.html_path = self.score.get_html_file_path()
+        self.write_html(self.HTML, time.time() - 100)
+
+    def write_html(self, html, mtime):
+        with open(self.html_path, 'wb') as fh:
+            fh.write(html)
+        os.utime(self.html_path, (mtime, mtime))
+
+    def get(self, accept_encoding):
+        response = score_html_response(RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding), self.score)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        return response.get('Content-Encoding'), b''.join(response.streaming_content)
+
+    def test_gzip_when_it_is_accepted(self):
+        encoding, content = self.get("gzip, deflate")
+        self.assertEqual(encoding, 'gzip')
+        self.assertLess(len(content), len(self.HTML))
+        self.assertEqual(gzip.decompress(content), self.HTML)
+        self.assertEqual(self.get("gzip;q=0, deflate"), (None, self.HTML))
+        self.assertEqual(self.get(""), (None, self.HTML))
+
+    def test_out_of_date_copies_are_written_again(self):
+        self.get("gzip")
+        html = self.HTML.replace(b"C quarter", b"D half")
+        self.write_html(html, time.time())  # made again - eg the options changed
+        encoding, content = self.get("gzip")
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(gzip.decompress(content), html)
+        self.assertGreaterEqual(os.stat(self.html_path + '.gz').st_mtime_ns, os.stat(self.html_path).st_mtime_ns)
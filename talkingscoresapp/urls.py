@@ -8,8 +8,10 @@ urlpatterns = [
     path('contact-us', views.contact_us, name='contact-us'),
     path('privacy-policy', views.privacy_policy, name='privacy-policy'),
     path('score/<id>/<filename>', views.score, name='score'),
+    path('score/<id>/<filename>/segments', views.segments, name='segments'),
     path('score_options/<id>/<filename>', views.options, name='options'),
     path('process/<id>/<filename>', views.process, name='process'),
+    path('process_status/<id>/<filename>', views.process_status, name='process_status'),
     path('oops/<id>/<filename>', views.error, name='error'),
     path('midis/<id>/<filename>',views.midi, name="midi" ),
     path("robots.txt", TemplateView.as_view(template_name="robots.txt", content_type="text/plain"), ),
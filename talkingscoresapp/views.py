@@ -1,21 +1,29 @@
 from django import forms
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
 from django.http import FileResponse
+from django.http import StreamingHttpResponse
+from django.http import JsonResponse
+from django.http import Http404
 from django.template import loader
 from django.shortcuts import redirect
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
 from django.urls import reverse
 import os
 import sys
 import json
+import hashlib
 import logging
 import logging.handlers
 import logging.config
-from talkingscores.settings import BASE_DIR, MEDIA_ROOT
+from talkingscores.settings import BASE_DIR, MEDIA_ROOT, JOB_WORKERS
 from lib.midiHandler import *
 
 from talkingscoreslib import Music21TalkingScore
 
 from talkingscoresapp.models import TSScore, TSScoreState
+from talkingscoresapp import jobs
+from talkingscoresapp import artefacts
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -23,6 +31,8 @@ import smtplib
 
 logger = logging.getLogger("TSScore")
 
+MIDI_MAX_AGE = 365 * 24 * 60 * 60  # seconds - see midi()
+
 
 class MusicXMLSubmissionForm(forms.Form):
     filename = forms.FileField(label='MusicXML file', widget=forms.ClearableFileInput(attrs={'class': 'form-control'}),
@@ -80,9 +90,41 @@ def send_error_email(error_message):
 
 def process(request, id, filename):
     template = loader.get_template('processing.html')
-    context = {'id': id, 'filename': filename}
+    context = {'id': id, 'filename': filename, 'use_job_queue': JOB_WORKERS > 0}
     return HttpResponse(template.render(context, request))
 
+
+# JSON for processing.html to poll - {'status': queued / parsing / analysing / rendering / done / error, 'segment': x, 'segments': y, 'position': place in queue, 'message': for screen readers etc}
+def process_status(request, id, filename):
+    score = TSScore(id=id, filename=filename)
+    if score.is_processed():
+        status = {'status': jobs.JOB_DONE, 'segment': None, 'segments': None, 'position': None}
+    else:
+        status = jobs.get_status(id, filename)
+        if status is None:
+            # never queued (eg the options haven't been saved) - the score view will queue it or ask for the options
+            return JsonResponse({'status': None, 'segment': None, 'segments': None, 'position': None, 'message': "Starting", 'url': reverse('score', args=[id, filename])})
+
+    if status['status'] == jobs.JOB_QUEUED:
+        status['message'] = "Waiting to be processed"
+        if status['position'] is not None and status['position'] > 1:
+            status['message'] += " - " + str(status['position'] - 1) + " scores ahead of this one"
+    elif status['status'] == jobs.JOB_PARSING:
+        status['message'] = "Reading the score"
+    elif status['status'] == jobs.JOB_ANALYSING:
+        status['message'] = "Analysing the parts"
+    elif status['status'] == jobs.JOB_RENDERING:
+        status['message'] = "Describing the music"
+        if status['segments']:
+            status['message'] += " - section " + str(status['segment']) + " of " + str(status['segments'])
+    elif status['status'] == jobs.JOB_DONE:
+        status['message'] = "Done"
+        status['url'] = reverse('score', args=[id, filename])
+    else:
+        status['message'] = "There was a problem processing the score"
+        status['url'] = reverse('error', args=[id, filename])
+    return JsonResponse(status)
+
 # View for the a particular score
 def score(request, id, filename):
     score = TSScore(id=id, filename=filename)
@@ -95,10 +137,18 @@ def score(request, id, filename):
         #     # FIXME - don't do this inline here, no really
 
         # context = RequestContext(request, {})
+    elif JOB_WORKERS > 0 and not score.is_processed():
+        # processed by a job worker - see talkingscoresapp/jobs.py
+        status = jobs.get_status(id, filename)
+        if status is not None and status['status'] == jobs.JOB_ERROR:
+            return redirect('error', id, filename)
+        jobs.enqueue(id, filename)
+        return redirect('process', id, filename)
     else:
         try:
-            html = score.html()
-            return HttpResponse(html)
+            if not score.is_processed():
+                return score_streaming_response(score)
+            return score_html_response(request, score)
         except:
             logger.exception("Unable to process score:  http://%s%s " % (request.get_host(), reverse('score', args=[id, filename])))
             return redirect('error', id, filename)
@@ -107,16 +157,107 @@ def score(request, id, filename):
 
     return HttpResponse(template.render(context, request))
 
+# The segments (bars at a time) of a page that was made without them - see TSScore.segments().
+# ?from=x&to=y - the segments that start in bars x to y (to the end of the score if there isn't a to).  JSON for the page to put in - or with &format=html a page of them, for browsers without javascript
+def segments(request, id, filename):
+    score = TSScore(id=id, filename=filename)
+    try:
+        from_bar = int(request.GET.get('from', 0))
+        to_bar = int(request.GET['to']) if 'to' in request.GET else sys.maxsize
+    except ValueError:
+        return HttpResponseBadRequest("Bars must be whole numbers")
+    try:
+        rendered, next_bar = score.segments(from_bar, to_bar)
+    except FileNotFoundError:  # not processed yet - or made with all its segments
+        raise Http404("No segments for this score")
+
+    if request.GET.get('format') == 'html':
+        template = loader.get_template('segments.html')
+        context = {'id': id, 'filename': filename, 'segments': [html for start_bar, end_bar, html in rendered], 'next_bar': next_bar}
+        response = HttpResponse(template.render(context, request))
+    else:
+        response = JsonResponse({'segments': [{'from': start_bar, 'to': end_bar, 'html': html} for start_bar, end_bar, html in rendered], 'next': next_bar})
+    response['X-Robots-Tag'] = "noindex"
+    return response
+
 # View for midi files to serve with CORS header
 # use GET query string to generate the correct midi file
 def midi(request, id, filename):
-    mh = MidiHandler(request.GET, id, filename)
-    midiname = mh.get_or_make_midi_file()
-    fr = FileResponse(open(os.path.join(BASE_DIR, "staticfiles", "data", id, midiname), "rb"))
+    # the id is the hash of the musicxml - so the midi file for an id and query string never changes, even if it is deleted and made again.
+    # The ETag is from the whole query string (in order of name) as eg bsi / bpi aren't in the file's name but change what it plays
+    etag = make_etag(id, filename, sorted(request.GET.lists()))
+    fr = get_conditional_response(request, etag=etag)  # 304 if the browser already has it - without making the file again
+    if fr is None:
+        mh = MidiHandler(request.GET, id, filename)
+        try:
+            midiname = mh.get_or_make_midi_file()
+        except InvalidMidiRequest as ex:  # eg a tempo that isn't a number
+            return HttpResponseBadRequest(str(ex))
+        midi_filepath = os.path.join(BASE_DIR, "staticfiles", "data", id, midiname)
+        artefacts.touch(midi_filepath)
+        fr = FileResponse(open(midi_filepath, "rb"))
+    fr['ETag'] = etag
+    patch_cache_control(fr, public=True, max_age=MIDI_MAX_AGE, immutable=True)
     fr['Access-Control-Allow-Origin'] = '*'
     fr['X-Robots-Tag'] = "noindex"
     return fr
 
+
+# a strong ETag for a generated file - from what it was made from, eg the score id (the hash of the musicxml) and the options
+def make_etag(*parts):
+    return '"%s"' % hashlib.sha256("\n".join(str(p) for p in parts).encode('utf-8')).hexdigest()[:32]
+
+
+# the content codings in an Accept-Encoding header - except any with q=0
+def get_accepted_encodings(request):
+    encodings = set()
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = coding.partition(';')
+        q = params.strip().replace(' ', '')
+        try:
+            if q.startswith('q=') and float(q[2:]) == 0:
+                continue  # not acceptable
+        except ValueError:
+            pass
+        if name.strip():
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+# the talking score page - streamed from the file, or one of its compressed copies if the browser accepts it.
+# The options can be changed and the page made again - so the browser checks it is up to date each time (and usually gets a 304)
+def score_html_response(request, score):
+    html_path, encoding = score.get_html_file_path_for_encodings(get_accepted_encodings(request))
+    stat = os.stat(html_path)
+    with open(score.get_data_file_path() + '.opts', 'r') as options_fh:
+        options = options_fh.read()
+    etag = make_etag(score.id, score.filename, options, encoding, stat.st_size, stat.st_mtime_ns)
+    artefacts.touch(score.get_html_file_path())
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = FileResponse(open(html_path, "rb"), content_type="text/html; charset=utf-8")
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    patch_cache_control(response, no_cache=True)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+# the talking score page while it is being made - it is sent as it is rendered rather than when it is finished (see TSScore.stream_html).
+# An error once the page has started can't be shown as the error page - so it is logged and the page stops
+def score_streaming_response(score):
+    chunks = score.stream_html()
+
+    def send_chunks():
+        try:
+            yield from chunks
+        except Exception:
+            logger.exception("Unable to finish score %s/%s" % (score.id, score.filename))
+
+    response = StreamingHttpResponse(send_chunks(), content_type="text/html; charset=utf-8")
+    patch_cache_control(response, no_cache=True)
+    return response
+
 # View for a particular score
 def error(request, id, filename):
     template = loader.get_template('error.html')
@@ -200,6 +341,8 @@ def options(request, id, filename):
 
             with open(options_path, "w") as options_fh:
                 json.dump(options, options_fh)
+            if JOB_WORKERS > 0:
+                jobs.enqueue(id, filename)
             return redirect('process', id, filename)
         else:
             logger.warn("Invalid form..." + str(form.errors))